@@ -1,5 +1,7 @@
 # import ml.machine_learning.prediction.sent_prediction as sp
 import ml.models as m_models
+import ml.nlp.doc_store as doc_store
+import ml.nlp.spacy_registry as spacy_registry
 from spacy.symbols import nsubj
 import services.loggers as loggers
 logger = loggers.Loggers(__name__).get_logger()
@@ -19,9 +21,15 @@ class ShallowDependency(object):
 
 	Employing NLP preprocessing can significantly improve docvec sentence
 	prediction.
+
+	Sentences are taken from the review docs NLPreprocessor already parsed 
+	(see doc_store.DocStore); the model is only loaded for sentences whose 
+	review has no valid stored parse.
 	'''
 	def __init__(self, **kwargs):
 		self.frsku = kwargs.get('frsku')
+		self.nlp = None
+		self.stored_sents = None
 		self.sent_set = self._get_documents()
 
 	def _initialize_nlp(self):
@@ -29,10 +37,41 @@ class ShallowDependency(object):
 		Load spaCy NLP module and process documents.
 
 		Loading these modules takes a while so we only want to load
-		them if we really need them.
+		them if we really need them. The pipeline is shared with every other
+		stage of the current process through spacy_registry.
+		'''
+		self.nlp = spacy_registry.get_pipeline()
+
+	def _load_stored_sents(self):
+		'''
+		Return a dictionary of (review_id, sentence): Span for all the 
+		sentences of FRSKU's reviews found in the parsed doc store.
+		'''
+		key = 'review_raw__crawl_cache__crawl_queue__product_raw__product'
+		key += '__frsku'
+		fields = ('id', 'review_raw__review_body')
+		review_set = m_models.AnalysisCorpus.objects.filter(**{key: self.frsku})
+		texts = dict(review_set.values_list(*fields))
+		docs = doc_store.DocStore(corpus='analysis').get_docs(texts)
+		stored_sents = {}
+		for review_id, doc in docs.items():
+			for span in doc.sents:
+				stored_sents[(review_id, span.text)] = span
+		return stored_sents
+
+	def _parse_sentence(self, sent_obj):
+		'''
+		Return the parsed sentence of a SentenceTable object, from the doc 
+		store if possible and from the model otherwise.
 		'''
-		import spacy
-		self.nlp = spacy.load('en_core_web_md')
+		if self.stored_sents is None:
+			self.stored_sents = self._load_stored_sents()
+		span = self.stored_sents.get((sent_obj.review_id, sent_obj.sentence))
+		if span is not None:
+			return span
+		if self.nlp is None:
+			self._initialize_nlp()
+		return self.nlp(sent_obj.sentence)
 
 	def _get_documents(self, d2v_training=False):
 		'''
@@ -87,7 +126,7 @@ class ShallowDependency(object):
 			# and whose parent review has at least MIN_LENGTH of words 
 			word_count = sent_obj.review.word_count
 			if word_count >= MIN_LENGTH:
-				doc = self.nlp(sent_obj.sentence)
+				doc = self._parse_sentence(sent_obj)
 				for token in doc:
 					if token.pos_ in ['NOUN', 'PRON', 'PROPN']:
 						NOUN_SUBJECT = True
@@ -1,10 +1,19 @@
-from collections import namedtuple
 from datetime import timedelta
+from django.db.models import Max
 from gensim.models.doc2vec import Doc2Vec
+import fooreviews.models as fr_models
 import ml.discourse.dependency as dep
-# import ml.models as m_models
+import io
+import json
+import ml.machine_learning.modeling.lda_registry as lda_registry
+import ml.machine_learning.modeling.tagged_corpus as tagged_corpus
+import ml.machine_learning.prediction.query_vectors as query_vectors
+import ml.machine_learning.prediction.retrieval as retrieval
+import ml.models as m_models
+import ml.nlp.token_corpus as token_corpus
+from multiprocessing import cpu_count
+import numpy as np
 import os
-import random
 from time import time
 import services.common_helper as ch
 import services.loggers as loggers
@@ -13,8 +22,44 @@ logger = loggers.Loggers(__name__).get_logger()
 class Document2Vector(dep.ShallowDependency):
 	'''
 	Performs doc2vec modeling using gensim's doc2vec implementation.
+
+	Training modes (mode):
+		epochs: the default; a single train call. gensim runs the iter 
+				epochs itself and decays the learning rate from alpha to 
+				min_alpha linearly.
+		corpus_file: same schedule, but the sentences are written to a
+				LineSentence file (one sentence per line, space-separated
+				words) that gensim's workers read in parallel without the 
+				GIL. gensim tags corpus_file documents by line number, so the
+				sentence tags are saved next to the model (see _line_tags_path)
+				and mapped back in infer_vectors.
+	compare_training also times the original schedule (loop), which called
+	d2v_model.train once per epoch while every call ran d2v_model.iter 
+	epochs itself, i.e. iter * iter passes. It's kept for comparison only.
+	workers is the number of gensim worker threads (default: cpu_count()).
+	approximate answers sentence queries from an approximate index instead
+	of scoring every sentence (see retrieval.SentenceIndex; by default only
+	for very large models).
+
+	Domain models:
+		With training=True, domain and subdomain, a single model is trained
+		on the domain's TrainingCorpus reviews instead of a product's 
+		sentences. The highest review id it was trained on is saved next 
+		to it (<model>.meta.json); train_d2v_model(new_model=True) retrains
+		it once the domain has newer reviews, or always with retrain=True.
+		With domain_model=True, a product uses the model of its
+		TrainingDomain: train_d2v_model infers its sentence vectors in 
+		batches across workers processes (infer_steps passes each) instead
+		of training a model, and topic queries are inferred and cached 
+		against the domain model, so every product of the domain shares 
+		them. The inferred vectors are saved next to the domain model and 
+		inferred again when the domain model is retrained.
 	'''
 	def __init__(self, **kwargs):
+		# read by _get_documents, which ShallowDependency calls
+		self.training = kwargs.get('training')
+		self.domain = kwargs.get('domain')
+		self.subdomain = kwargs.get('subdomain')
 		super(Document2Vector, self).__init__(**kwargs)
 		self.nlp = None
 		self.d2v_model = None
@@ -22,18 +67,68 @@ class Document2Vector(dep.ShallowDependency):
 		self.iterations = 20
 		self.min_count = 20
 		self.doc_list = []
+		self.seed = kwargs.get('seed') or 0
+		self.mode = kwargs.get('mode') or 'epochs'
+		if self.mode not in ('epochs', 'corpus_file'):
+			msg = 'Unknown doc2vec training mode={}; using mode=epochs'
+			logger.info(msg.format(self.mode))
+			self.mode = 'epochs'
+		self.workers = kwargs.get('workers') or cpu_count()
+		self.approximate = kwargs.get('approximate')
+		self.domain_model = kwargs.get('domain_model')
+		self.retrain = kwargs.get('retrain')
+		self.infer_steps = kwargs.get('infer_steps') or 100
+		if self.domain_model and not self.training:
+			self._set_product_domain()
+		self.line_tags = None
+		self.sentence_index = None
 		self.d2v_model_path = self._get_path()
+		self.vectors_path = self._get_vectors_path()
 		self.training_params = self._get_training_params()
 	
+	def _set_product_domain(self):
+		'''
+		Set the domain and subdomain of FRSKU's TrainingDomain. Products 
+		without one fall back to a model of their own.
+		'''
+		try:
+			product = fr_models.Product.objects.filter(frsku=self.frsku)[0]
+			domain_obj = product.product_domain
+			self.domain = domain_obj.domain
+			self.subdomain = domain_obj.subdomain
+		except Exception as e:
+			msg = 'Failed to get Training Domain for FRSKU={}. Using a '
+			msg += 'product doc2vec model instead.'
+			logger.exception(msg.format(self.frsku))
+			self.domain_model = False
+
 	def _get_path(self):
 		root = 'ml/trained_models/doc2vec/'
-		filename = 'doc2vec_MODEL_{}_size{}_iter{}_min{}'
-		filename = filename.format(self.frsku, self.size, self.iterations, \
-									self.min_count)
+		if self.training or self.domain_model:
+			filename = 'doc2vec_DOMAIN_{}_{}_size{}_iter{}_min{}'
+			filename = filename.format(self.domain, self.subdomain, self.size, \
+										self.iterations, self.min_count)
+		else:
+			filename = 'doc2vec_MODEL_{}_size{}_iter{}_min{}'
+			filename = filename.format(self.frsku, self.size, self.iterations, \
+										self.min_count)
 		path = root + filename
 		ch.make_directory(logger, root)
 		return path
 
+	def _get_vectors_path(self):
+		'''
+		Return the path of FRSKU's sentence vectors inferred with the domain
+		model, or None if the product doesn't use one.
+		'''
+		if not self.domain_model or self.training:
+			return None
+		root = 'ml/trained_models/doc2vec/'
+		filename = 'doc2vec_VECTORS_{}_size{}_iter{}_min{}'
+		filename = filename.format(self.frsku, self.size, self.iterations, \
+									self.min_count)
+		return root + filename
+
 	def _get_training_params(self):
 		'''
 		Set doc2vec training parameters.
@@ -61,47 +156,89 @@ class Document2Vector(dep.ShallowDependency):
 			'iter': iterations,
 			'negative': negative,
 			'min_count': min_count,
-
+			'workers': self.workers,
+			'alpha': 0.025,
+			'min_alpha': 0.001,
 		}
 		return params
 	
 	def _tagged_docs(self, doc_set):
 		'''
-		Return a tagged list of sentences tokenized into words.
+		Return a restartable iterable of tagged sentences tokenized into 
+		words.
 
 		Each senteces has a unique UUID tag. These tags are later used
 		for reverse sentence lookup.  
+
+		The words come from the sentence token corpus NLPreprocessor wrote;
+		sentences missing from it are tokenized once, without the parser, and 
+		added to it (see tagged_corpus.TaggedCorpus).
+		'''
+		if self.training:
+			params = {
+				'path': token_corpus.corpus_path('reviews', domain=self.domain, \
+												subdomain=self.subdomain),
+				'fields': ('id', 'review_raw__review_body'),
+				'seed': self.seed,
+			}
+			return tagged_corpus.TaggedCorpus(doc_set, None, **params)
+		return tagged_corpus.TaggedCorpus(doc_set, self.frsku, seed=self.seed)
+
+	def _get_documents(self, d2v_training=False):
+		'''
+		Return the domain's unique training reviews when training a domain 
+		model and FRSKU's sentences otherwise.
 		'''
-		TaggedDocuments = namedtuple('TaggedDocuments', 'words tags')
-		tagged_docs =[]
-		for sent in doc_set.iterator():
-			doc = self.nlp(sent.sentence)
-			words = []
-			# tokenize the sentence/s into words and remove any punctuations
-			for s in doc.sents:
-				for token in s:
-					if not token.is_punct:
-						words.append(token.lower_)
-			tagged_docs.append(TaggedDocuments(words=words, tags=[sent.tag]))
-		return tagged_docs
+		if self.training:
+			params = {
+				'unique': True,
+				'review_raw__domain': self.domain,
+				'review_raw__subdomain': self.subdomain,
+			}
+			return m_models.TrainingCorpus.objects.filter(**params)
+		return super(Document2Vector, self)._get_documents(d2v_training)
 
 	def train_d2v_model(self, path=False, new_model=False):
 		'''
 		Load doc2vec models if they've already been trained for a given 
 		FRSKU or train a new set otherwise.
 		'''
+		if self.vectors_path:
+			self._load_domain_vectors(new_model=new_model)
+			return
 		then = time()
 		NEW_MODEL = False
 		d2v_model = None
-		try:
-			d2v_model = Doc2Vec.load(self.d2v_model_path)
-			msg = 'Loaded existing doc2vec model for FRSKU={}'
-			msg = msg.format(self.frsku)
-		except IOError:
+		review_id_max = None
+		STALE = False
+		if self.training and new_model:
+			review_id_max = self._get_review_id_max()
+			STALE = self._domain_model_stale(review_id_max)
+		if STALE:
+			msg = 'Domain doc2vec model for domain={} subdomain={} is out of '
+			msg += 'date. Retraining it...'
+			logger.info(msg.format(self.domain, self.subdomain))
+		else:
+			try:
+				d2v_model = Doc2Vec.load(self.d2v_model_path)
+				self.line_tags = self._load_line_tags(self.d2v_model_path)
+				msg = 'Loaded existing doc2vec model for FRSKU={}'
+				msg = msg.format(self.frsku)
+			except IOError:
+				pass
+		if d2v_model is None:
 			if new_model:
-				self._initialize_nlp()
 				doc_set = self._get_documents(d2v_training=True)
-				if not doc_set:
+				if not doc_set.exists() and self.training:
+					# dependency() parses a product's sentences; a domain has
+					# nothing to fall back on
+					msg = 'No unique TrainingCorpus reviews to train a doc2vec '
+					msg += 'model on for domain={} subdomain={}'
+					logger.info(msg.format(self.domain, self.subdomain))
+					self.d2v_model = None
+					self.sentence_index = None
+					return
+				if not doc_set.exists():
 					self.dependency()
 					doc_set = self._get_documents(d2v_training=True)
 				self.doc_list = self._tagged_docs(doc_set)
@@ -109,6 +246,8 @@ class Document2Vector(dep.ShallowDependency):
 				logger.info(msg.format(self.frsku))
 				d2v_model = self._train()
 				NEW_MODEL = True
+				if self.training:
+					self._save_domain_meta(review_id_max)
 			else:
 				msg = 'doc2vec model does not exist for FRSKU={}. '
 				msg += 'Call train_d2v_model with new_model=True to proceed.'
@@ -120,27 +259,154 @@ class Document2Vector(dep.ShallowDependency):
 			msg = msg.format(self.frsku, timedelta(seconds=diff))
 		logger.info(msg)
 		self.d2v_model = d2v_model
+		self.sentence_index = None
+
+	def _get_review_id_max(self):
+		review_set = self._get_documents(d2v_training=True)
+		return review_set.aggregate(id_max=Max('id')).get('id_max') or 0
 
-	def _train(self):
+	def _domain_meta_path(self):
+		return self.d2v_model_path + '.meta.json'
+
+	def _domain_model_stale(self, review_id_max):
 		'''
-		Train a doc2vec model using the PV-DBOW (probability vectors - 
-		distributed bag of words) algorithm. 
+		Return True if the saved domain model should be retrained: retrain 
+		is set, or the domain has reviews newer than the model's high-water
+		mark. Models without the mark are retrained too.
+		'''
+		if not os.path.exists(self.d2v_model_path):
+			return False
+		if self.retrain:
+			return True
+		meta = {}
+		try:
+			with open(self._domain_meta_path()) as meta_in:
+				meta = json.load(meta_in)
+		except IOError:
+			pass
+		return meta.get('review_id_max', -1) < review_id_max
 
-		We set dm=0 to disable distributed memory alogrithm. 
-		dm=1 gave us vector inferences that made no sense. However,
-		PV-DBOW gives us exactly what we want even though the actual 
-		probability of the predicitons is 0.60 - 0.65. Predictions up to 0.90
-		are possible with optimized, i.e. less ambiguous, match query.
+	def _save_domain_meta(self, review_id_max):
+		with open(self._domain_meta_path(), 'w') as meta_out:
+			json.dump({'review_id_max': review_id_max}, meta_out)
+
+	def _load_domain_vectors(self, new_model=False):
 		'''
-		params = self._get_training_params()
+		Load the domain model and FRSKU's sentence vectors, inferring the
+		vectors first if they're missing or older than the model.
+		'''
+		then = time()
+		try:
+			# memory-mapped; inference never writes to the model's arrays
+			self.d2v_model = Doc2Vec.load(self.d2v_model_path, mmap='r')
+		except IOError:
+			msg = 'Domain doc2vec model does not exist for domain={} '
+			msg += 'subdomain={}. Train it with training=True to proceed.'
+			logger.info(msg.format(self.domain, self.subdomain))
+			return
+		self.sentence_index = None
+		vectors_path = self.vectors_path
+		if os.path.exists(vectors_path) and os.path.getmtime(vectors_path) >= \
+				os.path.getmtime(self.d2v_model_path):
+			self.line_tags = self._load_line_tags(vectors_path)
+			msg = 'Loaded domain doc2vec sentence vectors for FRSKU={}'
+			logger.info(msg.format(self.frsku))
+		elif new_model:
+			doc_set = self._get_documents(d2v_training=True)
+			if not doc_set.exists():
+				self.dependency()
+				doc_set = self._get_documents(d2v_training=True)
+			self.doc_list = self._tagged_docs(doc_set)
+			self._infer_sentence_vectors()
+			msg = 'Inferred {} sentence vectors for FRSKU={} with the domain '
+			msg += 'doc2vec model in {}'
+			logger.info(msg.format(len(self.line_tags), self.frsku, \
+									timedelta(seconds=time() - then)))
+		else:
+			msg = 'doc2vec sentence vectors do not exist for FRSKU={}. '
+			msg += 'Call train_d2v_model with new_model=True to proceed.'
+			logger.info(msg.format(self.frsku))
+
+	def _infer_sentence_vectors(self):
+		'''
+		Infer the vectors of the sentences in doc_list with the domain model
+		and save them, and their tags in the same order, to vectors_path.
+
+		Other processes may have the vectors memory-mapped (see 
+		retrieval.InferredDocvecs), so they are written to a temporary path
+		and renamed into place, after their tags, instead of rewritten.
+		'''
+		line_tags = []
+		documents = []
+		for tagged_doc in self.doc_list:
+			line_tags.append(tagged_doc.tags[0])
+			documents.append(tagged_doc.words)
+		params = {
+			'steps': self.infer_steps,
+			'workers': self.workers,
+		}
+		vectors = query_vectors.infer_documents(self.d2v_model, \
+								self.d2v_model_path, documents, **params)
+		self._write_line_tags(self.vectors_path, line_tags)
+		tmp_path = '{}.tmp{}'.format(self.vectors_path, os.getpid())
+		# np.save would append .npy to a path without it
+		with open(tmp_path, 'wb') as vectors_out:
+			np.save(vectors_out, vectors)
+		os.rename(tmp_path, self.vectors_path)
+		self.line_tags = line_tags
+
+	def _line_tags_path(self, path):
+		return path + '.tags'
+
+	def _write_line_tags(self, path, line_tags):
+		tags_path = self._line_tags_path(path)
+		tmp_path = '{}.tmp{}'.format(tags_path, os.getpid())
+		with io.open(tmp_path, 'w', encoding='utf-8') as tags_out:
+			for tag in line_tags:
+				tags_out.write(u'{}\n'.format(tag))
+		os.rename(tmp_path, tags_path)
+
+	def _load_line_tags(self, path):
+		'''
+		Return the sentence tags of a model trained in corpus_file mode by 
+		line number, or None for models trained from tagged documents.
+		'''
+		line_tags = None
+		if os.path.exists(self._line_tags_path(path)):
+			with io.open(self._line_tags_path(path), encoding='utf-8') as tags_in:
+				line_tags = [line.rstrip(u'\n') for line in tags_in]
+		return line_tags
+
+	def _write_corpus_file(self, path):
+		'''
+		Write the training sentences to a LineSentence file and their tags,
+		in the same order, to the line tags file. Sentences without words 
+		are left out.
+		'''
+		corpus_path = path + '.corpus.txt'
+		line_tags = []
+		with io.open(corpus_path, 'w', encoding='utf-8') as corpus_out:
+			for tagged_doc in self.doc_list:
+				words = [word for word in tagged_doc.words if word.strip()]
+				if not words:
+					continue
+				corpus_out.write(u' '.join(words) + u'\n')
+				line_tags.append(tagged_doc.tags[0])
+		self._write_line_tags(path, line_tags)
+		return corpus_path, line_tags
+
+	def _train_loop(self, params):
+		# the original schedule ran with gensim's default thread count
+		params = dict(params)
+		params.pop('workers')
 		d2v_model = Doc2Vec(**params)
 		d2v_model.build_vocab(self.doc_list)
 		EPOCHS = params.get('iter')
-		alpha = 0.025
-		min_alpha = 0.001
+		alpha = params.get('alpha')
+		min_alpha = params.get('min_alpha')
 		alpha_delta = (alpha - min_alpha) / EPOCHS
 		for epoch in range(EPOCHS):
-			random.shuffle(self.doc_list)
+			self.doc_list.shuffle()
 			d2v_model.alpha, d2v_model.min_alpha = alpha, alpha
 			train_params = {
 					'total_examples': d2v_model.corpus_count,
@@ -148,13 +414,95 @@ class Document2Vector(dep.ShallowDependency):
 			}
 			d2v_model.train(self.doc_list, **train_params)
 			alpha -= alpha_delta
+		return d2v_model
+
+	def _train_epochs(self, params):
+		d2v_model = Doc2Vec(**params)
+		d2v_model.build_vocab(self.doc_list)
+		self.doc_list.shuffle()
+		train_params = {
+				'total_examples': d2v_model.corpus_count,
+				'epochs': params.get('iter'),
+		}
+		d2v_model.train(self.doc_list, **train_params)
+		return d2v_model
+
+	def _train_corpus_file(self, params, path):
+		self.doc_list.shuffle()
+		corpus_path, self.line_tags = self._write_corpus_file(path)
+		d2v_model = Doc2Vec(**params)
+		d2v_model.build_vocab(corpus_file=corpus_path)
+		train_params = {
+				'corpus_file': corpus_path,
+				'total_examples': d2v_model.corpus_count,
+				'total_words': d2v_model.corpus_total_words,
+				'epochs': params.get('iter'),
+		}
+		d2v_model.train(**train_params)
+		os.remove(corpus_path)
+		return d2v_model
+
+	def _train(self, mode=None, path=None, save=True):
+		'''
+		Train a doc2vec model using the PV-DBOW (probability vectors - 
+		distributed bag of words) algorithm. 
+
+		We set dm=0 to disable distributed memory alogrithm. 
+		dm=1 gave us vector inferences that made no sense. However,
+		PV-DBOW gives us exactly what we want even though the actual 
+		probability of the predicitons is 0.60 - 0.65. Predictions up to 0.90
+		are possible with optimized, i.e. less ambiguous, match query.
+		'''
+		mode = mode or self.mode
+		path = path or self.d2v_model_path
+		params = self._get_training_params()
+		self.line_tags = None
+		if mode != 'corpus_file' and os.path.exists(self._line_tags_path(path)):
+			# left over from an earlier corpus_file model at this path
+			os.remove(self._line_tags_path(path))
+		then = time()
+		if mode == 'corpus_file':
+			d2v_model = self._train_corpus_file(params, path)
+		elif mode == 'loop':
+			d2v_model = self._train_loop(params)
+		else:
+			d2v_model = self._train_epochs(params)
+		msg = 'Trained doc2vec model for FRSKU={} in mode={} with workers={} '
+		msg += 'in {:.1f}s'
+		logger.info(msg.format(self.frsku, mode, self.workers, time() - then))
 
 		# save the model to disk
-		d2v_model.save(self.d2v_model_path)
-		msg = 'Saved new doc2vec models for FRSKU={}'
-		logger.info(msg.format(self.frsku))
+		if save:
+			# products may have the saved model memory-mapped
+			lda_registry.save_model(d2v_model, path)
+			msg = 'Saved new doc2vec models for FRSKU={}'
+			logger.info(msg.format(self.frsku))
 		return d2v_model
 
+	def compare_training(self, modes=('loop', 'epochs', 'corpus_file')):
+		'''
+		Train the FRSKU's doc2vec model once in every mode and return the 
+		training time of each in seconds. The models are thrown away; the 
+		saved model is left untouched.
+		'''
+		doc_set = self._get_documents(d2v_training=True)
+		self.doc_list = self._tagged_docs(doc_set)
+		# tokenize missing sentences up front so it isn't timed
+		self.doc_list.prepare()
+		path = self.d2v_model_path + '_compare'
+		timings = {}
+		for mode in modes:
+			then = time()
+			self._train(mode=mode, path=path, save=False)
+			timings[mode] = round(time() - then, 1)
+		if os.path.exists(self._line_tags_path(path)):
+			os.remove(self._line_tags_path(path))
+		self.line_tags = self._load_line_tags(self.d2v_model_path)
+		msg = 'doc2vec training time for FRSKU={} ({} sentences, workers={}): {}'
+		logger.info(msg.format(self.frsku, len(self.doc_list), self.workers, \
+								timings))
+		return timings
+
 	def infer_vectors(self, topic, topn=5, steps=100000):
 		'''
 		Query the trained model to infer vectors for an unseen sentence 
@@ -172,7 +520,62 @@ class Document2Vector(dep.ShallowDependency):
 		'''
 		msg = 'Sentence vector inference in progress'
 		logger.info(msg)
-		topic_words = topic.split()
-		inference = self.d2v_model.infer_vector(topic_words,steps=steps)
-		sims = self.d2v_model.docvecs.most_similar([inference], topn=topn)
-		return sims
\ No newline at end of file
+		inference = self.query_vectors([topic], steps=steps).get(topic)
+		return self.similar_sentences(inference, topn=topn)
+
+	def similar_sentences(self, vector, topn=5):
+		'''
+		Return the tags and similarities of the topn sentences closest to an
+		inferred vector.
+		'''
+		return self.similar_sentences_batch([vector], topn=topn)[0]
+
+	def similar_sentences_batch(self, vectors, topn=5):
+		'''
+		Return a list of the topn (tag, similarity) of every vector in
+		vectors. All the vectors are scored against the model's normalized
+		sentence vectors at once (see retrieval.SentenceIndex).
+		'''
+		if self.sentence_index is None:
+			docvecs, path = self.d2v_model.docvecs, self.d2v_model_path
+			if self.vectors_path:
+				docvecs = retrieval.InferredDocvecs(self.vectors_path)
+				path = self.vectors_path
+			self.sentence_index = retrieval.SentenceIndex(docvecs, path, \
+												approximate=self.approximate)
+		results = self.sentence_index.most_similar(vectors, topn=topn)
+		if self.line_tags:
+			results = [[(self.line_tags[int(line)], prob) for line, prob in sims] \
+						for sims in results]
+		return results
+
+	def query_vectors(self, queries, steps=100000):
+		'''
+		Return a dictionary of query: inferred vector for a list of queries.
+
+		Vectors are cached by model, query and steps (see 
+		query_vectors.QueryVectorCache); the queries missing from the cache
+		are inferred in parallel across workers processes.
+		'''
+		queries = set(queries)
+		cache = query_vectors.QueryVectorCache()
+		model = query_vectors.model_id(self.d2v_model_path)
+		params = query_vectors.params_key(steps=steps)
+		vectors = cache.get(model, queries, params)
+		missing = [query for query in queries if query not in vectors]
+		if missing:
+			then = time()
+			params_infer = {
+				'steps': steps,
+				'workers': self.workers,
+			}
+			inferred = query_vectors.infer_queries(self.d2v_model, \
+									self.d2v_model_path, missing, **params_infer)
+			cache.put(model, inferred, params)
+			vectors.update(inferred)
+			msg = 'Inferred {} query vectors in {:.1f}s'
+			logger.info(msg.format(len(missing), time() - then))
+		msg = 'Query vectors for FRSKU={}: {} cached, {} inferred'
+		logger.info(msg.format(self.frsku, len(queries) - len(missing), \
+								len(missing)))
+		return vectors
\ No newline at end of file
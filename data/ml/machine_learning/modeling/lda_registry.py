@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import gensim
+import os
+import threading
+from time import time
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+# arrays larger than this many bytes are saved to their own .npy files
+SEP_LIMIT = 1024
+# number of models kept open per process
+MAX_MODELS = 4
+
+_models = OrderedDict()
+_lock = threading.Lock()
+
+def save_model(lda, path):
+	'''
+	Save an LDA model with every large array (topic-word matrices, the
+	sufficient statistics of its state) in a separate .npy file so that
+	get_model can memory-map them. Works for any gensim model; doc2vec 
+	models, which products memory-map too, are saved with it.
+
+	Saving over a model in place would truncate and rewrite .npy files 
+	that other processes have memory-mapped. The model is saved under a 
+	temporary base path instead and every file is renamed into place, the
+	main file last: readers keep their mapping of the old files, and a
+	model whose main file changed already has all of its new arrays.
+	'''
+	tmp_path = '{}.tmp{}'.format(path, os.getpid())
+	lda.save(tmp_path, sep_limit=SEP_LIMIT)
+	directory = os.path.dirname(tmp_path) or '.'
+	prefix = os.path.basename(tmp_path) + '.'
+	for name in os.listdir(directory):
+		if name.startswith(prefix):
+			suffix = name[len(prefix) - 1:]
+			os.rename(os.path.join(directory, name), path + suffix)
+	os.rename(tmp_path, path)
+
+def get_model(lda_name, path, max_models=MAX_MODELS):
+	'''
+	Return the LDA model saved at path, loading it on first use.
+
+	The arrays are memory-mapped read-only (mmap='r'), so processes that
+	load the same model share its pages through the OS page cache instead
+	of each holding a copy, and a load only reads the small pickled part.
+	Models stay open in a per-process LRU keyed by lda_name; a model whose
+	file changed since it was opened (retrained or updated) is reloaded.
+	Models saved before save_model was used have their arrays pickled
+	inline and are loaded fully.
+
+	Memory-mapped models are read-only; load the model directly to update
+	it. Raises IOError if there is no model at path.
+	'''
+	mtime = os.path.getmtime(path)
+	with _lock:
+		cached = _models.get(lda_name)
+		if cached and cached[1] == path and cached[2] == mtime:
+			_models.move_to_end(lda_name)
+			return cached[0]
+		then = time()
+		lda = gensim.models.LdaMulticore.load(path, mmap='r')
+		_models[lda_name] = (lda, path, mtime)
+		_models.move_to_end(lda_name)
+		while len(_models) > max_models:
+			evicted, _ = _models.popitem(last=False)
+			logger.info('Closed LDA model={}'.format(evicted))
+		msg = 'Loaded LDA model={} from {} in {:.3f}s'
+		logger.info(msg.format(lda_name, path, time() - then))
+	return lda
+
+def clear():
+	with _lock:
+		_models.clear()
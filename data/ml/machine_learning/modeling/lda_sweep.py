@@ -0,0 +1,226 @@
+import csv
+from django.db import connection
+import gensim
+import itertools
+import ml.machine_learning.modeling.topic_modeling as tm
+from multiprocessing import cpu_count
+import os
+import resource
+from time import time
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+# TrainingDomain fields a sweep can vary, plus the keep_n filter parameter
+GRID_FIELDS = ['topic_count', 'iteration', 'chunksize', 'minimum', 'maximum',
+				'keep_n']
+RESULT_FIELDS = GRID_FIELDS + ['vocab_size', 'coherence', 'score', 'seconds',
+								'memory_mb']
+
+class RemappedCorpus(object):
+	'''
+	Streams a bag-of-words corpus with its token ids translated through
+	remap; tokens missing from remap are dropped. Restartable, so LDA can
+	make several passes over it.
+	'''
+	def __init__(self, corpus, remap):
+		self.corpus = corpus
+		self.remap = remap
+
+	def __iter__(self):
+		for doc in self.corpus:
+			yield [(self.remap[token_id], count) for token_id, count in doc \
+					if token_id in self.remap]
+
+	def __len__(self):
+		return len(self.corpus)
+
+def _filter_corpus(id2word_dict, corpus, minimum, maximum, keep_n=None):
+	'''
+	Apply filter_extremes to id2word_dict (in place) and return the corpus
+	remapped to the filtered ids.
+	'''
+	old_ids = dict(id2word_dict.token2id)
+	params = {
+		'no_below': float(minimum),
+		'no_above': float(maximum),
+		'keep_n': keep_n,
+	}
+	id2word_dict.filter_extremes(**params)
+	remap = dict((old_ids.get(token), new_id) \
+				for token, new_id in id2word_dict.token2id.items())
+	return RemappedCorpus(corpus, remap)
+
+def _bow_texts(corpus, id2word_dict):
+	'''
+	Rebuild token lists from a bag-of-words corpus for the sliding-window
+	coherence measures. BoW documents are lists of nouns, so the word order
+	lost here carries little information.
+	'''
+	texts = []
+	for doc in corpus:
+		words = []
+		for token_id, count in doc:
+			words.extend([id2word_dict[token_id]] * int(count))
+		texts.append(words)
+	return texts
+
+def _peak_memory():
+	'''
+	Return the peak resident memory in MB of this process and of its 
+	finished child processes, LdaMulticore's workers included.
+	'''
+	usage = [resource.getrusage(who).ru_maxrss for who in \
+				(resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+	return max(usage) / 1024.0
+
+def _train_candidate(candidate, path_corpus, path_dict, coherence, **kwargs):
+	'''
+	Train and score one candidate on the shared serialized corpus with 
+	LdaMulticore, the same trainer production uses.
+	'''
+	then = time()
+	id2word_dict = gensim.corpora.Dictionary.load(path_dict)
+	corpus = gensim.corpora.MmCorpus(path_corpus)
+	corpus = _filter_corpus(id2word_dict, corpus, candidate.get('minimum'), \
+							candidate.get('maximum'), candidate.get('keep_n'))
+	params = {
+		'corpus': corpus,
+		'id2word': id2word_dict,
+		'num_topics': candidate.get('topic_count'),
+		'passes': candidate.get('iteration'),
+		'chunksize': candidate.get('chunksize'),
+		'random_state': kwargs.get('seed'),
+		'workers': kwargs.get('workers'),
+	}
+	lda = gensim.models.LdaMulticore(**params)
+	cm_params = {
+		'model': lda,
+		'dictionary': id2word_dict,
+		'coherence': coherence,
+	}
+	if coherence == 'u_mass':
+		cm_params['corpus'] = corpus
+	else:
+		cm_params['texts'] = _bow_texts(corpus, id2word_dict)
+	score = gensim.models.CoherenceModel(**cm_params).get_coherence()
+	result = dict(candidate)
+	result.update({
+		'vocab_size': len(id2word_dict),
+		'coherence': coherence,
+		'score': score,
+		'seconds': round(time() - then, 1),
+		'memory_mb': round(_peak_memory(), 1),
+	})
+	return result
+
+class LDASweep(tm.TopicModeling):
+	'''
+	Trains LDA candidates over a grid of TrainingDomain parameters and scores
+	each by topic coherence.
+
+	The domain's training BoW is serialized once, unfiltered, as an MmCorpus
+	with its full dictionary; every candidate streams that shared file and 
+	applies its own minimum/maximum/keep_n filtering, so the db is read once
+	no matter how many candidates there are. Candidates are trained one 
+	after the other with LdaMulticore across worker processes, the trainer
+	and filter parameters _model_lda uses for the production model, so a 
+	candidate's score and cost carry over to the model trained with its 
+	parameters. memory_mb is the 
+	peak resident memory of the sweep and its LDA workers up to and 
+	including a candidate.
+
+	grid maps any of GRID_FIELDS to a list of values; fields left out keep
+	the domain's current value. coherence is 'u_mass' (fast, corpus-based)
+	or 'c_v' (slower, usually tracks human judgement better). Results are
+	written, best score first, to ml/lda_topics/trials/<lda_name>_sweep.csv.
+	Nothing is written to the db; copy the chosen parameters to the
+	TrainingDomain and train the model as usual.
+
+	Usage:
+		sweep = LDASweep(domain='electronics', subdomain='headphones',
+						grid={'topic_count': [20, 30, 40], 'maximum': [0.3, 0.5]})
+		results = sweep.run()
+	'''
+	def __init__(self, **kwargs):
+		kwargs['training'] = True
+		super(LDASweep, self).__init__(**kwargs)
+		self.grid = kwargs.get('grid') or {}
+		self.coherence = kwargs.get('coherence') or 'u_mass'
+		# LdaMulticore's own default
+		self.workers = kwargs.get('workers') or max(1, cpu_count() - 1)
+		dir_trials = 'ml/lda_topics/trials/'
+		if not os.path.exists(dir_trials):
+			os.makedirs(dir_trials)
+		self.path_results = dir_trials + self.lda_name + '_sweep.csv'
+		self.path_sweep_corpus = self.path_corpus.replace('.mm', '_sweep.mm')
+		self.path_sweep_dict = self.path_sweep_corpus + '.dict'
+
+	def _get_candidates(self):
+		defaults = {
+			'topic_count': self.TOPIC_COUNT,
+			'iteration': self.passes,
+			'chunksize': self.chunksize,
+			'minimum': self.num_below,
+			'maximum': self.num_above,
+			'keep_n': self.keep_n,
+		}
+		values = [self.grid.get(field) or [defaults.get(field)] \
+					for field in GRID_FIELDS]
+		return [dict(zip(GRID_FIELDS, combo)) for combo in itertools.product(*values)]
+
+	def _serialize_sweep_corpus(self):
+		'''
+		Write the unfiltered training BoW and its dictionary to disk.
+		'''
+		msg = 'Serializing LDA sweep corpus for Domain={} Subdomain={} to {}'
+		logger.info(msg.format(self.domain, self.subdomain, self.path_sweep_corpus))
+		docs = self._get_streamed_docs()
+		id2word_dict = gensim.corpora.Dictionary(docs())
+		corpus_bow = (id2word_dict.doc2bow(tokens) for tokens in docs())
+		gensim.corpora.MmCorpus.serialize(self.path_sweep_corpus, corpus_bow, \
+											id2word=id2word_dict)
+		id2word_dict.save(self.path_sweep_dict)
+
+	def _results_to_csv(self, results):
+		with open(self.path_results, 'w') as csv_out:
+			writer = csv.DictWriter(csv_out, fieldnames=RESULT_FIELDS)
+			writer.writeheader()
+			for result in results:
+				writer.writerow(result)
+		msg = 'LDA sweep results saved to {}'.format(self.path_results)
+		logger.info(msg)
+
+	def run(self):
+		'''
+		Train and score every candidate and return the results, best first.
+		'''
+		results = []
+		if not self.domain_obj:
+			msg = 'Could not run LDA sweep. Training domain does not exist for '
+			msg += 'Domain={} Subdomain={}'
+			logger.info(msg.format(self.domain, self.subdomain))
+			return results
+		then = time()
+		self._serialize_sweep_corpus()
+		candidates = self._get_candidates()
+		msg = 'Training {} LDA candidates with {} workers'
+		logger.info(msg.format(len(candidates), self.workers))
+		# forked LDA workers must not share the parent's db socket
+		connection.close()
+		params = {
+			'seed': self.seed,
+			'workers': self.workers,
+		}
+		for candidate in candidates:
+			result = _train_candidate(candidate, self.path_sweep_corpus, \
+								self.path_sweep_dict, self.coherence, **params)
+			msg = 'LDA candidate {} scored {}={:.4f} in {}s'
+			logger.info(msg.format(dict((field, result.get(field)) \
+						for field in GRID_FIELDS), self.coherence, \
+						result.get('score'), result.get('seconds')))
+			results.append(result)
+		results.sort(key=lambda result: result.get('score'), reverse=True)
+		self._results_to_csv(results)
+		msg = 'Finished LDA sweep of {} candidates in {:.0f}s'
+		logger.info(msg.format(len(results), time() - then))
+		return results
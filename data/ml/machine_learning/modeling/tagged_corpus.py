@@ -0,0 +1,131 @@
+from gensim.models.doc2vec import TaggedDocument
+import ml.nlp.spacy_registry as spacy_registry
+import ml.nlp.token_corpus as token_corpus
+import random
+from time import time
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+def tokenize(texts, batch_size=1000):
+	'''
+	Yield the doc2vec words of every text: lower-cased tokens without
+	punctuation and whitespace, as nlp_engine.get_words returns for a parsed
+	sentence.
+	'''
+	tokenizer = spacy_registry.get_tokenizer()
+	for doc in tokenizer.pipe(texts, batch_size=batch_size):
+		yield [token.lower_ for token in doc \
+				if not (token.is_punct or token.is_space)]
+
+class TaggedCorpus(object):
+	'''
+	Restartable iterable of the TaggedDocuments doc2vec trains on: one per
+	sentence in doc_set, tagged with its SentenceTable tag.
+
+	Other corpora can be read by passing the token corpus path and the
+	(tag, text) fields of doc_set, e.g. the training reviews of a domain
+	model. Integer tags, like review ids, are tagged as strings: gensim
+	would otherwise allocate a vector for every integer up to the largest.
+
+	Words are read from the product's sentence token corpus (see
+	token_corpus). The first time the corpus is prepared, sentences missing
+	from it are tokenized in batches with a tokenizer-only pipeline and
+	added to it as a new segment, so every pass over the corpus (build_vocab
+	and each training epoch) reads memory-mapped token ids and nothing is
+	tokenized twice. Only the tags are held in memory.
+
+	If seed is given, the sentence order is shuffled with it once prepared;
+	shuffle() reshuffles it between passes.
+	'''
+	def __init__(self, doc_set, frsku, **kwargs):
+		self.doc_set = doc_set
+		self.path = kwargs.get('path') or \
+					token_corpus.corpus_path('sentences', frsku=frsku)
+		self.fields = kwargs.get('fields') or ('tag', 'sentence')
+		self.batch_size = kwargs.get('batch_size') or 1000
+		self.seed = kwargs.get('seed')
+		self.random = random.Random(self.seed)
+		self.tags = None
+		self.corpus = None
+
+	def _rows(self):
+		'''
+		Yield the (tag, text) fields of doc_set, read batch_size rows at a 
+		time by id range.
+		'''
+		last_id = 0
+		while True:
+			rows = self.doc_set.filter(id__gt=last_id).order_by('id')
+			rows = list(rows.values_list('id', *self.fields)[:self.batch_size])
+			for row in rows:
+				yield row[1:]
+			if len(rows) < self.batch_size:
+				break
+			last_id = rows[-1][0]
+
+	def _write_batch(self, writer, batch):
+		'''
+		Tokenize a list of (tag, sentence) and add them to the token corpus.
+		'''
+		sentences = [sentence for _, sentence in batch]
+		for (tag, _), words in zip(batch, tokenize(sentences, self.batch_size)):
+			writer.add(tag, words)
+
+	def prepare(self):
+		'''
+		Read the sentence tags and make sure every sentence is in the token
+		corpus. Called by the first pass over the corpus.
+
+		Sentences missing from the corpus are tokenized and written 
+		batch_size at a time as the rows are read, so only the tags and one 
+		batch of sentences are ever held in memory.
+		'''
+		then = time()
+		corpus = token_corpus.TokenCorpus(self.path)
+		tags = []
+		writer = None
+		batch = []
+		missing = 0
+		try:
+			for tag, sentence in self._rows():
+				tags.append(tag)
+				if tag in corpus:
+					continue
+				if writer is None:
+					writer = token_corpus.TokenCorpusWriter(self.path)
+				batch.append((tag, sentence))
+				missing += 1
+				if len(batch) == self.batch_size:
+					self._write_batch(writer, batch)
+					batch = []
+			if batch:
+				self._write_batch(writer, batch)
+		finally:
+			if writer is not None:
+				writer.close()
+		if missing:
+			token_corpus.compact(self.path)
+			corpus = token_corpus.TokenCorpus(self.path)
+			msg = 'Tokenized {} sentences missing from the token corpus in {:.1f}s'
+			logger.info(msg.format(missing, time() - then))
+		if self.seed is not None:
+			self.random.shuffle(tags)
+		self.tags = tags
+		self.corpus = corpus
+
+	def shuffle(self):
+		if self.tags is None:
+			self.prepare()
+		self.random.shuffle(self.tags)
+
+	def __iter__(self):
+		if self.tags is None:
+			self.prepare()
+		for tag in self.tags:
+			doctag = str(tag) if isinstance(tag, int) else tag
+			yield TaggedDocument(words=self.corpus.words(tag), tags=[doctag])
+
+	def __len__(self):
+		if self.tags is None:
+			self.prepare()
+		return len(self.tags)
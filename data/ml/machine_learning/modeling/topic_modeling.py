@@ -1,12 +1,19 @@
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import csv
+from django.db.models import Count, Max, Sum
 import fooreviews.models as fr_models
 import gensim 
+import hashlib
+import json
 import logging 
+import ml.machine_learning.modeling.lda_registry as lda_registry
 import ml.models as m_models
+import ml.nlp.token_corpus as token_corpus
+import numpy as np
 import pandas as pd
 import os
 import random
+from time import time
 import services.loggers as loggers
 logger = loggers.Loggers(__name__).get_logger()
 
@@ -33,15 +40,30 @@ class TopicModeling(object):
 					microwave, etc. Type is float.
 		keep_n: Absolute number of tokens to keep after all trimming. None means 
 				keep all; Type can be float or integer (unverified).
+
+	Training options:
+		streaming: serialize the filtered BoW corpus to a gensim MmCorpus on
+				disk and train from it instead of from an in-memory list; 
+				only chunksize documents are held in memory at a time.
+		seed: seed of the document shuffle so that training runs on the 
+				same corpus see the documents in the same order.
+		stable_overlap: share of a topic's top words that must survive an
+				incremental update (see update_lda_model) for its LDATopic
+				label to stay in use.
 	'''
 	def __init__(self, **kwargs):
 		self.frsku = kwargs.get('frsku')
 		self.domain = kwargs.get('domain')
 		self.subdomain = kwargs.get('subdomain')
 		self.training = kwargs.get('training')
+		self.streaming = kwargs.get('streaming')
+		self.seed = kwargs.get('seed') or 0
+		self.stable_overlap = kwargs.get('stable_overlap') or 0.5
 		self.product = self._get_product()
 		self.domain_obj = self._get_domain_obj()
 		self.MODEL_DOES_NOT_EXIST = 'Model Does Not Exist'
+		# highest BagofWords id of the rows the last corpus was read from
+		self.bow_id_read = 0
 
 		# default modeling parameters
 		self.TOPIC_COUNT = 0
@@ -56,6 +78,9 @@ class TopicModeling(object):
 		self.lda_topics = ''
 		self.path_model = ''
 		self.path_topics = ''
+		self.path_corpus = ''
+		self.path_meta = ''
+		self.dir_prediction = ''
 		self._set_lda_params()
 		self._set_lda_names()
 
@@ -67,12 +92,21 @@ class TopicModeling(object):
 			self.lda_topics = self.product.predicted_topics_name
 		dir_model = 'ml/trained_models/lda/'
 		dir_topics =  'ml/lda_topics/'
+		dir_corpus = 'ml/trained_models/lda_corpus/'
+		dir_prediction = 'ml/trained_models/lda_prediction/'
 		if not os.path.exists(dir_model):
 			os.makedirs(dir_model)
 		if not os.path.exists(dir_topics):
 			os.makedirs(dir_topics)
+		if not os.path.exists(dir_corpus):
+			os.makedirs(dir_corpus)
+		if not os.path.exists(dir_prediction):
+			os.makedirs(dir_prediction)
 		self.path_model =  dir_model + self.lda_name
 		self.path_topics = dir_topics + self.lda_topics
+		self.path_corpus = dir_corpus + self.lda_name + '.mm'
+		self.path_meta = self.path_model + '.meta.json'
+		self.dir_prediction = os.path.join(dir_prediction, str(self.frsku))
 
 	def _get_domain_obj(self):
 		'''
@@ -150,15 +184,18 @@ class TopicModeling(object):
 
 	def _save_trained_model(self, trained_model):
 		'''
-		Serialize the trained model and save it to disk.
+		Serialize the trained model and save it to disk. Return True if it 
+		was saved.
 		'''
 		try:
-			trained_model.save(self.path_model)
+			lda_registry.save_model(trained_model, self.path_model)
 			msg = 'Saved a new LDA model with name={}'.format(self.lda_name)
 			logger.info(msg)
+			return True
 		except Exception as e:
 			msg = '{}: {}'.format(type(e).__name__, e.args[0])
 			logger.exception(msg)
+		return False
 
 	def train_lda_model(self, new_model=False):
 		'''
@@ -170,7 +207,7 @@ class TopicModeling(object):
 			try:
 				msg = 'Attempting to load model at {}'.format(self.path_model)
 				logger.info(msg)
-				lda_model = gensim.models.LdaMulticore.load(self.path_model)
+				lda_model = lda_registry.get_model(self.lda_name, self.path_model)
 				break
 			except IOError:
 				if new_model:
@@ -311,6 +348,76 @@ class TopicModeling(object):
 		nested_tokens = [[word for word in doc.lower().split()] for doc in bow_docs]
 		return nested_tokens
 
+	def _shuffle(self, items):
+		'''
+		Return items as a list shuffled with our seed. Items are sorted first
+		so that the order doesn't depend on the order they were read in.
+		'''
+		items = sorted(items)
+		random.Random(self.seed).shuffle(items)
+		return items
+
+	def _get_token_corpus(self, bow_set):
+		'''
+		Return the token corpus NLPreprocessor wrote for our BoW set (see 
+		token_corpus) if it has the review of every BagofWords row, None 
+		otherwise. Documents of reviews that are no longer in the set are 
+		left out of the returned corpus.
+		'''
+		scope = {'domain': self.domain, 'subdomain': self.subdomain}
+		field = 't_review__id'
+		if not self.training:
+			scope['frsku'] = self.frsku
+			field = 'a_review__id'
+		corpus = token_corpus.TokenCorpus(token_corpus.corpus_path('bow', **scope))
+		if not corpus.exists():
+			return None
+		rows = list(bow_set.values_list('id', field))
+		review_ids = set(review_id for _, review_id in rows)
+		if not review_ids <= set(corpus.doc_ids()):
+			return None
+		corpus.restrict(review_ids)
+		self.bow_id_read = max([bow_id for bow_id, _ in rows] or [0])
+		return corpus
+
+	def _doc2bow(self, token_ids):
+		'''
+		Return the sorted (token_id, count) list of an array of token ids.
+		'''
+		ids, counts = np.unique(token_ids, return_counts=True)
+		return list(zip(ids.tolist(), counts.tolist()))
+
+	def _get_memmap_bow(self, corpus):
+		'''
+		Same as _get_lda_bow(training=True) but built straight from the 
+		memory-mapped token ids: no BagofWords strings are loaded and nothing
+		is re-tokenized.
+
+		The dictionary is built from the corpus' own vocabulary. 
+		filter_extremes compacts the ids, so the token ids of every document 
+		are remapped with a lookup array and the filtered tokens (-1) dropped.
+		'''
+		doc_ids = self._shuffle(corpus.doc_ids())
+		raw_bow = [self._doc2bow(corpus.token_ids(i)) for i in doc_ids]
+		id2word = dict(enumerate(corpus.vocab))
+		id2word_dict = gensim.corpora.Dictionary.from_corpus(raw_bow, \
+															id2word=id2word)
+		params = {
+		'no_below': float(self.num_below),
+		 'no_above': float(self.num_above), 
+		 'keep_n': self.keep_n,
+		}
+		id2word_dict.filter_extremes(**params)
+		old_ids = dict((token, i) for i, token in id2word.items())
+		remap = np.full(len(corpus.vocab), -1, dtype=np.int64)
+		for token, new_id in id2word_dict.token2id.items():
+			remap[old_ids.get(token)] = new_id
+		corpus_bow = []
+		for doc_id in doc_ids:
+			token_ids = remap[corpus.token_ids(doc_id)]
+			corpus_bow.append(self._doc2bow(token_ids[token_ids >= 0]))
+		return id2word_dict, corpus_bow
+
 	def _get_lda_bow(self, training=False, prediction=False):
 		msg = 'Getting LDA BoW for {}...'
 		if training:
@@ -321,9 +428,15 @@ class TopicModeling(object):
 		logger.info(msg)
 
 		bow_set = self._get_bow_set()
-		bow_docs = [obj.bow for obj in bow_set]
-		for i in range(100):
-			random.shuffle(bow_docs)
+		if training:
+			# prediction converts documents with the trained model's own 
+			# dictionary instead (see _get_prediction_corpus)
+			corpus = self._get_token_corpus(bow_set)
+			if corpus:
+				return self._get_memmap_bow(corpus)
+		rows = list(bow_set.values_list('id', 'bow'))
+		self.bow_id_read = max([bow_id for bow_id, _ in rows] or [0])
+		bow_docs = self._shuffle(bow for _, bow in rows)
 		nested_tokens = self._tokenize(bow_docs)
 		id2word_dict = gensim.corpora.Dictionary(nested_tokens)
 		if prediction:
@@ -339,8 +452,247 @@ class TopicModeling(object):
 			corpus_bow = [id2word_dict.doc2bow(token) for token in nested_tokens]
 			return id2word_dict, corpus_bow
 
+	def _stream_bow(self, bow_set, bow_ids):
+		'''
+		Yield the tokens of every BagofWords row in bow_ids, in that order,
+		fetching chunksize rows at a time.
+		'''
+		chunk_size = self.chunksize or 2000
+		for start in range(0, len(bow_ids), chunk_size):
+			chunk = bow_ids[start:start + chunk_size]
+			bows = dict(bow_set.filter(id__in=chunk).values_list('id', 'bow'))
+			for bow_id in chunk:
+				yield bows.get(bow_id, '').lower().split()
+
+	def _get_streamed_docs(self):
+		'''
+		Return a function that yields the shuffled training documents as token 
+		lists every time it's called. Only the document ids are shuffled and 
+		held in memory; the tokens come from the token corpus if it covers the
+		BoW set and from the db otherwise.
+		'''
+		bow_set = self._get_bow_set()
+		corpus = self._get_token_corpus(bow_set)
+		if corpus:
+			doc_ids = self._shuffle(corpus.doc_ids())
+			return lambda: (corpus.words(doc_id) for doc_id in doc_ids)
+		bow_ids = self._shuffle(bow_set.values_list('id', flat=True))
+		self.bow_id_read = max(bow_ids or [0])
+		return lambda: self._stream_bow(bow_set, bow_ids)
+
+	def _serialize_lda_bow(self):
+		'''
+		Streaming counterpart of _get_lda_bow(training=True). 
+
+		The documents are read twice: once to build the dictionary and once to
+		write the filtered bag-of-words corpus to path_corpus in Matrix Market
+		format. Return the dictionary and the MmCorpus, which LdaMulticore 
+		streams from disk chunksize documents at a time.
+		'''
+		msg = 'Serializing LDA training BoW for Domain={} Subdomain={} to {}'
+		logger.info(msg.format(self.domain, self.subdomain, self.path_corpus))
+		docs = self._get_streamed_docs()
+		id2word_dict = gensim.corpora.Dictionary(docs())
+		params = {
+		'no_below': float(self.num_below),
+		 'no_above': float(self.num_above), 
+		 'keep_n': self.keep_n,
+		}
+		id2word_dict.filter_extremes(**params)
+		corpus_bow = (id2word_dict.doc2bow(tokens) for tokens in docs())
+		gensim.corpora.MmCorpus.serialize(self.path_corpus, corpus_bow, \
+											id2word=id2word_dict)
+		return id2word_dict, gensim.corpora.MmCorpus(self.path_corpus)
+
+	def _corpus_fingerprint(self, bow_set):
+		'''
+		Return a fingerprint of the BoW set and the trained model.
+
+		BagofWords rows are never edited in place (reprocessed reviews get new
+		rows), so the row count and the sum and maximum of the row ids change
+		whenever the set does. The model file's modification time covers 
+		models retrained under the same name.
+		'''
+		stats = bow_set.aggregate(count=Count('id'), id_sum=Sum('id'), \
+									id_max=Max('id'))
+		model_time = 0
+		if os.path.exists(self.path_model):
+			model_time = os.path.getmtime(self.path_model)
+		key = '{}:{}:{}:{}'.format(stats.get('count'), stats.get('id_sum'), \
+									stats.get('id_max'), model_time)
+		return hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+
+	def _stream_prediction_docs(self, bow_set):
+		'''
+		Yield the tokens of every document in the BoW set from the token 
+		corpus if it covers the set and from the db otherwise.
+		'''
+		corpus = self._get_token_corpus(bow_set)
+		if corpus:
+			for doc_id in sorted(corpus.doc_ids()):
+				yield corpus.words(doc_id)
+		else:
+			# read in id ranges so that the rows are never all in memory
+			chunk_size = 2000
+			last_id = 0
+			while True:
+				rows = bow_set.filter(id__gt=last_id).order_by('id')
+				rows = list(rows.values_list('id', 'bow')[:chunk_size])
+				for bow_id, bow in rows:
+					yield bow.lower().split()
+				if len(rows) < chunk_size:
+					break
+				last_id = rows[-1][0]
+
+	def _get_prediction_corpus(self, lda_model):
+		'''
+		Return the product's BoW corpus in the trained model's token ids.
+
+		Documents are converted with lda_model.id2word (tokens the model has
+		never seen are dropped) rather than a dictionary of their own, whose
+		ids wouldn't line up with the model's topics. The converted corpus is
+		cached as an MmCorpus under dir_prediction, named after the model and 
+		the corpus fingerprint, so later predictions for the same FRSKU, 
+		model and BoW set skip tokenization and conversion. Stale cache files 
+		for the FRSKU and model are removed.
+		'''
+		bow_set = self._get_bow_set()
+		prefix = '{}_'.format(self.lda_name)
+		name = '{}{}.mm'.format(prefix, self._corpus_fingerprint(bow_set))
+		path = os.path.join(self.dir_prediction, name)
+		if os.path.exists(path):
+			msg = 'Loading cached LDA prediction corpus for FRSKU={} from {}'
+			logger.info(msg.format(self.frsku, path))
+			return list(gensim.corpora.MmCorpus(path))
+		if not os.path.exists(self.dir_prediction):
+			os.makedirs(self.dir_prediction)
+		for cached in os.listdir(self.dir_prediction):
+			# <lda_name>_<fingerprint>.mm and its .mm.index
+			fingerprint = cached[len(prefix):].split('.')[0]
+			if cached.startswith(prefix) and len(fingerprint) == 16:
+				os.remove(os.path.join(self.dir_prediction, cached))
+		id2word_dict = lda_model.id2word
+		corpus_bow = [id2word_dict.doc2bow(tokens) \
+						for tokens in self._stream_prediction_docs(bow_set)]
+		gensim.corpora.MmCorpus.serialize(path, corpus_bow, id2word=id2word_dict)
+		msg = 'Cached LDA prediction corpus for FRSKU={} with {} documents at {}'
+		logger.info(msg.format(self.frsku, len(corpus_bow), path))
+		return corpus_bow
+
+	def _get_model_meta(self):
+		'''
+		Return the metadata saved next to the trained model: its version and
+		the highest BagofWords id it has been trained on (high-water mark).
+		Models trained before the metadata existed have none.
+		'''
+		meta = {}
+		try:
+			with open(self.path_meta) as meta_in:
+				meta = json.load(meta_in)
+		except IOError:
+			pass
+		return meta
+
+	def _save_model_meta(self, version, bow_id_max):
+		meta = {
+			'version': version,
+			'bow_id_max': bow_id_max,
+		}
+		with open(self.path_meta, 'w') as meta_out:
+			json.dump(meta, meta_out)
+
+	def _get_bow_id_max(self):
+		return self._get_bow_set().aggregate(id_max=Max('id')).get('id_max') or 0
+
+	def _get_new_bow(self, lda, id_from, id_to):
+		'''
+		Return the BagofWords rows with id_from < id <= id_to in the model's 
+		token ids. The vocabulary of a trained model is fixed, so tokens it has never
+		seen are dropped.
+		'''
+		bow_set = self._get_bow_set().filter(id__gt=id_from, id__lte=id_to)
+		bow_ids = self._shuffle(bow_set.values_list('id', flat=True))
+		return [lda.id2word.doc2bow(tokens) \
+				for tokens in self._stream_bow(bow_set, bow_ids)]
+
+	def _refresh_topics(self, old_topics, new_topics):
+		'''
+		Update the LDATopic rows of the model after an incremental update.
+
+		Every topic gets its new raw_topic. A topic keeps its label, query and
+		coherence flag if at least stable_overlap of its top words survived the
+		update; otherwise it has drifted: its label and query, which described
+		the old words, are reset to their defaults like a newly trained 
+		topic's, and it is flagged incoherent, which keeps it out of 
+		predictions until it is labelled again (see topics_to_csv and 
+		update_db_topics). Return the drifted topic nums.
+		'''
+		drifted = []
+		topics_set = m_models.LDATopic.objects.filter(lda_model_name=self.lda_name)
+		cleared = dict((field, m_models.LDATopic._meta.get_field(field).\
+						get_default()) for field in ('label', 'query'))
+		for topic_num, topic in new_topics.items():
+			old_words = set(old_topics.get(topic_num, '').split())
+			new_words = set(topic.split())
+			overlap = len(old_words & new_words) / float(len(new_words) or 1)
+			params = {'raw_topic': topic}
+			if overlap < self.stable_overlap:
+				params['coherent'] = False
+				params.update(cleared)
+				drifted.append(topic_num)
+			topics_set.filter(topic_num=topic_num).update(**params)
+		return drifted
+
+	def update_lda_model(self):
+		'''
+		Update the trained model with the BagofWords rows added since it was
+		last trained or updated instead of retraining it from scratch.
+
+		The current model is kept as <path_model>.v<version> before the new
+		rows are streamed through lda.update() and the updated model is saved
+		as the next version in its place. Return the updated model, or None if
+		there is nothing to update.
+		'''
+		meta = self._get_model_meta()
+		if not meta:
+			msg = 'No training high-water mark for LDA model={}. Retrain it with '
+			msg += 'train_lda_model(new_model=True) before updating.'
+			logger.info(msg.format(self.lda_name))
+			return None
+		try:
+			# fully loaded; the registry's memory-mapped copy is read-only
+			lda = gensim.models.LdaMulticore.load(self.path_model)
+		except IOError:
+			msg = 'Model does not exist at {}'.format(self.path_model)
+			logger.info(msg)
+			return None
+		version = meta.get('version', 1)
+		bow_id_max = self._get_bow_id_max()
+		corpus_bow = self._get_new_bow(lda, meta.get('bow_id_max', 0), bow_id_max)
+		if not corpus_bow:
+			msg = 'No new training BoW for LDA model={} since version {}'
+			logger.info(msg.format(self.lda_name, version))
+			return None
+		then = time()
+		old_topics = self._get_topics(lda)
+		lda_registry.save_model(lda, '{}.v{}'.format(self.path_model, version))
+		lda.update(corpus_bow)
+		if not self._save_trained_model(lda):
+			# keep the high-water mark so the next update retries these rows
+			return None
+		self._save_model_meta(version + 1, bow_id_max)
+		drifted = self._refresh_topics(old_topics, self._get_topics(lda))
+		msg = 'Updated LDA model={} to version {} with {} new documents in '
+		msg += '{:.0f}s; drifted topics flagged incoherent: {}'
+		logger.info(msg.format(self.lda_name, version + 1, len(corpus_bow), \
+								time() - then, drifted))
+		return lda
+
 	def _model_lda(self):
-		id2word_dict, corpus_bow = self._get_lda_bow(training=True)
+		if self.streaming:
+			id2word_dict, corpus_bow = self._serialize_lda_bow()
+		else:
+			id2word_dict, corpus_bow = self._get_lda_bow(training=True)
 		params = {
 				'corpus': corpus_bow,
 				'id2word': id2word_dict,
@@ -349,5 +701,8 @@ class TopicModeling(object):
 				'chunksize': self.chunksize, 
 		}
 		lda = gensim.models.LdaMulticore(**params)
-		self._save_trained_model(lda)
+		if self._save_trained_model(lda):
+			# the mark is the newest row the corpus was read from; rows added 
+			# since are picked up by the next update
+			self._save_model_meta(1, self.bow_id_read)
 		return lda
\ No newline at end of file
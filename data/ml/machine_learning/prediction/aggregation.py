@@ -0,0 +1,202 @@
+import numpy as np
+import random
+from time import time
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+# gensim's get_document_topics drops topics below this probability
+MIN_PROB = 0.01
+
+def dense_predictions(doc_topics, num_topics):
+	'''
+	Return a (documents, num_topics) matrix of the (topic_num, prob) lists
+	get_document_topics returns. Topics gensim left out are 0.
+	'''
+	probs = np.zeros((len(doc_topics), num_topics))
+	lengths = [len(predictions) for predictions in doc_topics]
+	flat = [pred for predictions in doc_topics for pred in predictions]
+	if flat:
+		flat = np.array(flat)
+		rows = np.repeat(np.arange(len(doc_topics)), lengths)
+		probs[rows, flat[:, 0].astype(np.int64)] = flat[:, 1]
+	return probs
+
+def select_predictions(probs, coherent, min_prob=MIN_PROB):
+	'''
+	Return the topic numbers and probabilities every document of a
+	(documents, topics) probability matrix predicts.
+
+	Incoherent topics (False in the boolean coherent vector) and topics
+	below min_prob are masked out, and a document predicts the topics tied
+	at its highest remaining probability. Like the list-based _adjacent_probs
+	did, the first of these is predicted twice.
+	'''
+	valid = coherent & (probs >= min_prob)
+	masked = np.where(valid, probs, -1.0)
+	ties = valid & (masked == masked.max(axis=1)[:, None])
+	docs, topic_nums = np.nonzero(ties)
+	has_pred = np.flatnonzero(ties.any(axis=1))
+	first = masked[has_pred].argmax(axis=1)
+	topic_nums = np.concatenate([topic_nums, first])
+	docs = np.concatenate([docs, has_pred])
+	return topic_nums, probs[docs, topic_nums]
+
+def group_predictions(topic_nums, values, num_topics):
+	'''
+	Return the number of predictions, the sum of their probabilities per
+	topic and the total number of predictions.
+	'''
+	freq = np.bincount(topic_nums, minlength=num_topics)
+	prob_sum = np.bincount(topic_nums, weights=values, minlength=num_topics)
+	return freq, prob_sum, len(topic_nums)
+
+def freq_mean(freq, prob_sum, total):
+	'''
+	Return {topic_num: [freq, w_avg]} for every predicted topic, where w_avg
+	is the topic's mean probability weighted by its share of the
+	predictions (freq/total * prob_sum/freq = prob_sum/total).
+	'''
+	freq_mean_dict = {}
+	for topic_num in np.flatnonzero(freq):
+		freq_mean_dict[int(topic_num)] = [int(freq[topic_num]), \
+											prob_sum[topic_num]/float(total)]
+	return freq_mean_dict
+
+def new_accumulator(num_topics):
+	'''
+	Return the preallocated per-topic totals of the prediction iterations:
+	rows are the frequency total, the probability total and the number of
+	iterations that predicted the topic.
+	'''
+	return np.zeros((3, num_topics))
+
+def append_freq_mean(freq_mean_dict, accumulator):
+	if not freq_mean_dict:
+		return
+	topic_nums = np.fromiter(freq_mean_dict.keys(), dtype=np.int64)
+	freq_probs = np.array(list(freq_mean_dict.values()), dtype=float)
+	accumulator[0, topic_nums] += freq_probs[:, 0]
+	accumulator[1, topic_nums] += freq_probs[:, 1]
+	accumulator[2, topic_nums] += 1
+
+def final_pred_avg(accumulator):
+	'''
+	Return {topic_num: [avg_freq, avg_prob]} over the iterations that
+	predicted each topic.
+	'''
+	averaged = {}
+	for topic_num in np.flatnonzero(accumulator[2]):
+		count = accumulator[2, topic_num]
+		averaged[int(topic_num)] = [accumulator[0, topic_num]/count, \
+									accumulator[1, topic_num]/count]
+	return averaged
+
+def sort_predictions(pred_list, col_num=1, regression_probs=False):
+	'''
+	Sort rows of (topic_num, value, ...) on col_num in descending order and
+	return them as lists: [topic_num, prob] or, with regression_probs,
+	[topic_num, freq, prob_old, prob_new].
+	'''
+	pred_array = np.array(pred_list, dtype=float)
+	if not len(pred_array):
+		return []
+	pred_array = pred_array[np.argsort(-pred_array[:, col_num], kind='stable')]
+	topic_nums = pred_array[:, 0].astype(int).tolist()
+	if regression_probs:
+		freqs = pred_array[:, 1].astype(int).tolist()
+		return [[topic_num, freq, prob_old, prob_new] for topic_num, freq, \
+				prob_old, prob_new in zip(topic_nums, freqs, \
+				pred_array[:, 2].tolist(), pred_array[:, 3].tolist())]
+	return [[topic_num, prob] for topic_num, prob in \
+			zip(topic_nums, pred_array[:, 1].tolist())]
+
+def _legacy_iteration(doc_topics, incoherent, master_dict):
+	'''
+	One iteration of the list-based aggregation TopicPrediction used before
+	these helpers, kept for the benchmark.
+	'''
+	raw_predictions = []
+	for predictions in doc_topics:
+		pred_array = np.array(predictions)
+		pred_array = pred_array[np.argsort(-pred_array[:, 1])]
+		predictions_list = [[int(p[0]), p[1]] for p in pred_array]
+		index = -1
+		for i in range(len(predictions_list)):
+			if predictions_list[i][0] not in incoherent:
+				index = i
+				break
+		if index < 0:
+			continue
+		highest = round(predictions_list[index][1], 17)
+		valid_preds = [predictions_list[index]]
+		for i in range(len(predictions_list)):
+			try:
+				pred = predictions_list[index + i]
+				if round(pred[1], 17) == highest and pred[0] not in incoherent:
+					valid_preds.append(pred)
+			except IndexError:
+				pass
+		raw_predictions.extend(valid_preds)
+	pred_dict = {}
+	for topic_num, prob in raw_predictions:
+		pred_dict.setdefault(topic_num, []).append(prob)
+	for topic_num, probs in pred_dict.items():
+		freq = len(probs)
+		w_avg = freq/float(len(raw_predictions)) * sum(probs)/float(freq)
+		master_dict.setdefault(topic_num, []).append([freq, w_avg])
+
+def _synthetic_predictions(doc_count, num_topics, seed=0):
+	'''
+	Return get_document_topics-like output: a few topics above MIN_PROB per
+	document.
+	'''
+	gen = np.random.RandomState(seed)
+	doc_topics = []
+	for _ in range(doc_count):
+		probs = gen.dirichlet(np.full(num_topics, 0.1))
+		topic_nums = np.flatnonzero(probs >= MIN_PROB)
+		doc_topics.append(list(zip(topic_nums.tolist(), probs[topic_nums].tolist())))
+	return doc_topics
+
+def benchmark(doc_count=2000, num_topics=50, iterations=20):
+	'''
+	Compare the per-iteration aggregation cost of the list-based helpers with
+	the array-based ones on a synthetic product.
+
+	Usage (from the project root):
+		python -m ml.machine_learning.prediction.aggregation
+	'''
+	doc_topics = _synthetic_predictions(doc_count, num_topics)
+	incoherent = random.Random(0).sample(range(num_topics), num_topics // 5)
+	coherent = np.ones(num_topics, dtype=bool)
+	coherent[incoherent] = False
+
+	then = time()
+	master_dict = {}
+	for _ in range(iterations):
+		_legacy_iteration(doc_topics, incoherent, master_dict)
+	legacy_time = (time() - then) / iterations
+
+	then = time()
+	accumulator = new_accumulator(num_topics)
+	for _ in range(iterations):
+		probs = dense_predictions(doc_topics, num_topics)
+		topic_nums, values = select_predictions(probs, coherent)
+		freq, prob_sum, total = group_predictions(topic_nums, values, num_topics)
+		append_freq_mean(freq_mean(freq, prob_sum, total), accumulator)
+	array_time = (time() - then) / iterations
+
+	legacy = dict((num, [sum(v[0] for v in vals)/float(len(vals)), \
+				sum(v[1] for v in vals)/float(len(vals))]) \
+				for num, vals in master_dict.items())
+	array = final_pred_avg(accumulator)
+	agree = sorted(legacy) == sorted(array) and all(np.allclose(legacy[num], \
+				array[num]) for num in legacy)
+
+	msg = 'Aggregated {} documents over {} topics: lists {:.2f}ms/iteration, '
+	msg += 'arrays {:.2f}ms/iteration; results agree: {}'
+	logger.info(msg.format(doc_count, num_topics, legacy_time * 1000, \
+							array_time * 1000, agree))
+
+if __name__ == '__main__':
+	benchmark()
@@ -0,0 +1,105 @@
+import math
+from time import time
+
+class ConvergenceMonitor(object):
+	'''
+	Keeps running statistics of the topic prediction iterations and decides
+	when further iterations stop changing the ranking.
+
+	Every iteration adds a {topic_num: [freq, w_avg]} dictionary (see
+	TopicPrediction._freq_mean). Means and variances of both values are kept
+	per topic with Welford's online algorithm, so nothing is recomputed from
+	the full history. Topics are ranked by mean frequency, then mean
+	probability, which is the order the regression ranking reproduces.
+
+	The ranking has converged once
+		1. at least min_iterations iterations have run,
+		2. the order of the top_k topics has been the same for patience
+			consecutive iterations, and
+		3. the confidence interval (z standard errors) of every top_k topic's
+			mean frequency and probability is within ci_tolerance of the mean.
+	Convergence only stops the iterations if early_stop is set; max_seconds,
+	if set, stops them once the wall-clock budget is spent either way.
+	'''
+	def __init__(self, **kwargs):
+		self.early_stop = kwargs.get('early_stop')
+		self.top_k = kwargs.get('top_k') or 5
+		self.patience = kwargs.get('patience') or 20
+		self.min_iterations = kwargs.get('min_iterations') or 50
+		self.ci_tolerance = kwargs.get('ci_tolerance') or 0.05
+		self.z = kwargs.get('z') or 1.96
+		self.max_seconds = kwargs.get('max_seconds')
+		self.started = time()
+		self.iterations = 0
+		# topic_num: [count, freq mean, freq M2, prob mean, prob M2]
+		self.stats = {}
+		self.top = ()
+		self.stable_for = 0
+		self.stopped_by = None
+
+	def update(self, freq_mean):
+		self.iterations += 1
+		for topic_num, freq_prob in freq_mean.items():
+			stats = self.stats.setdefault(topic_num, [0, 0.0, 0.0, 0.0, 0.0])
+			stats[0] += 1
+			count = stats[0]
+			for i, value in ((1, freq_prob[0]), (3, freq_prob[1])):
+				delta = value - stats[i]
+				stats[i] += delta / count
+				stats[i + 1] += delta * (value - stats[i])
+		top = tuple(self._ranked()[:self.top_k])
+		if top == self.top:
+			self.stable_for += 1
+		else:
+			self.top = top
+			self.stable_for = 0
+
+	def _ranked(self):
+		key = lambda topic_num: (self.stats[topic_num][1], self.stats[topic_num][3])
+		return sorted(self.stats, key=key, reverse=True)
+
+	def _relative_ci(self, count, mean, m2):
+		if count < 2:
+			return float('inf')
+		if not mean:
+			return 0.0 if not m2 else float('inf')
+		std_err = math.sqrt(m2 / (count - 1) / count)
+		return self.z * std_err / abs(mean)
+
+	def max_relative_ci(self):
+		'''
+		Return the widest relative confidence interval among the top_k topics.
+		'''
+		widths = [0.0]
+		for topic_num in self.top:
+			count, freq, freq_m2, prob, prob_m2 = self.stats.get(topic_num)
+			widths.append(self._relative_ci(count, freq, freq_m2))
+			widths.append(self._relative_ci(count, prob, prob_m2))
+		return max(widths)
+
+	def converged(self):
+		return self.iterations >= self.min_iterations \
+				and self.stable_for >= self.patience \
+				and self.max_relative_ci() <= self.ci_tolerance
+
+	def should_stop(self):
+		if self.max_seconds and time() - self.started >= self.max_seconds:
+			self.stopped_by = 'time_budget'
+		elif self.early_stop and self.converged():
+			self.stopped_by = 'converged'
+		return bool(self.stopped_by)
+
+	def summary(self):
+		'''
+		Return the number of iterations run and the final stability metrics.
+		'''
+		summary = {
+			'iterations': self.iterations,
+			'stopped_by': self.stopped_by or 'max_iterations',
+			'seconds': round(time() - self.started, 1),
+			'top_k': list(self.top),
+			'stable_for': self.stable_for,
+			'max_relative_ci': self.max_relative_ci(),
+			'converged': self.converged(),
+		}
+		return summary
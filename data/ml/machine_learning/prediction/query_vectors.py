@@ -0,0 +1,140 @@
+from django.db import connection
+from gensim.models.doc2vec import Doc2Vec
+import hashlib
+from multiprocessing import Pool
+import numpy as np
+import os
+import sqlite3
+import services.common_helper as ch
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+# doc2vec model of the current worker process; set by _init_worker
+_d2v_model = None
+
+def model_id(path):
+	'''
+	Return an id for the doc2vec model saved at path that changes whenever
+	the model is saved again.
+	'''
+	key = '{}:{}'.format(os.path.abspath(path), os.path.getmtime(path))
+	return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+def params_key(**params):
+	'''
+	Return a canonical string of inference parameters, e.g. 'steps=100000'.
+	'''
+	return ','.join('{}={}'.format(key, params[key]) for key in sorted(params))
+
+class QueryVectorCache(object):
+	'''
+	Stores inferred query vectors by model id, query and inference
+	parameters in a sqlite file under root/.
+
+	Products whose sentence predictions use the same doc2vec model share the
+	vectors of the LDA topic queries they have in common; vectors inferred
+	by a per-product model are only reused by later runs of that product.
+	A model that's saved again gets a new id, so stale vectors are never
+	served.
+	'''
+	def __init__(self, **kwargs):
+		root = kwargs.get('root') or 'ml/d2v_query_cache/'
+		ch.make_directory(logger, root)
+		self.path = os.path.join(root, 'query_vectors.sqlite3')
+		with self._connect() as conn:
+			query = 'CREATE TABLE IF NOT EXISTS vectors (model_id TEXT, '
+			query += 'query TEXT, params TEXT, vector BLOB, '
+			query += 'PRIMARY KEY (model_id, query, params))'
+			conn.execute(query)
+
+	def _connect(self):
+		return sqlite3.connect(self.path)
+
+	def get(self, model, queries, params):
+		'''
+		Return a dictionary of query: vector for the queries in the cache.
+		'''
+		vectors = {}
+		queries = list(queries)
+		# stay below sqlite's limit on the number of query parameters
+		CHUNK = 500
+		with self._connect() as conn:
+			for start in range(0, len(queries), CHUNK):
+				chunk = queries[start:start + CHUNK]
+				query = 'SELECT query, vector FROM vectors WHERE model_id = ? '
+				query += 'AND params = ? AND query IN ({})'
+				query = query.format(', '.join('?' * len(chunk)))
+				for text, vector in conn.execute(query, [model, params] + chunk):
+					vectors[text] = np.frombuffer(vector, dtype=np.float32)
+		return vectors
+
+	def put(self, model, vectors, params):
+		rows = [(model, text, params, sqlite3.Binary(np.asarray(vector, \
+					dtype=np.float32).tobytes())) for text, vector in vectors.items()]
+		with self._connect() as conn:
+			query = 'INSERT OR REPLACE INTO vectors VALUES (?, ?, ?, ?)'
+			conn.executemany(query, rows)
+
+def _init_worker(path):
+	global _d2v_model
+	# memory-mapped so that the workers share the model's arrays
+	_d2v_model = Doc2Vec.load(path, mmap='r')
+
+def _infer(task):
+	query, steps = task
+	return query, _d2v_model.infer_vector(query.split(), steps=steps)
+
+def _infer_words(task):
+	words, steps = task
+	return _d2v_model.infer_vector(words, steps=steps)
+
+def infer_documents(d2v_model, path, documents, steps=100, workers=1, \
+					chunksize=100):
+	'''
+	Return a float32 matrix of the inferred vectors of documents (lists of
+	words), in order.
+
+	Like infer_queries, more than one worker spreads the documents across a
+	pool of processes that load the model saved at path read-only.
+	'''
+	vectors = np.zeros((len(documents), d2v_model.vector_size), dtype=np.float32)
+	workers = min(workers, len(documents))
+	if workers <= 1:
+		for i, words in enumerate(documents):
+			vectors[i] = d2v_model.infer_vector(words, steps=steps)
+		return vectors
+	# forked workers must not share the parent's db socket
+	connection.close()
+	pool = Pool(workers, initializer=_init_worker, initargs=(path,))
+	try:
+		tasks = ((words, steps) for words in documents)
+		inferred = pool.imap(_infer_words, tasks, chunksize=chunksize)
+		for i, vector in enumerate(inferred):
+			vectors[i] = vector
+	finally:
+		pool.terminate()
+		pool.join()
+	return vectors
+
+def infer_queries(d2v_model, path, queries, steps=100000, workers=1):
+	'''
+	Return a dictionary of query: inferred vector for every query.
+
+	With more than one worker and query, the queries are spread across a
+	pool of worker processes that load the model saved at path read-only;
+	otherwise they're inferred with d2v_model in this process.
+	'''
+	queries = list(queries)
+	workers = min(workers, len(queries))
+	if workers <= 1:
+		return dict((query, d2v_model.infer_vector(query.split(), steps=steps)) \
+					for query in queries)
+	# forked workers must not share the parent's db socket
+	connection.close()
+	pool = Pool(workers, initializer=_init_worker, initargs=(path,))
+	try:
+		tasks = [(query, steps) for query in queries]
+		return dict(pool.imap_unordered(_infer, tasks))
+	finally:
+		pool.terminate()
+		pool.join()
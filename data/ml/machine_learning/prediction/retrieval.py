@@ -0,0 +1,197 @@
+from gensim import matutils
+import numpy as np
+import os
+from time import time
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+# sentence count from which the approximate index is used by default
+APPROX_THRESHOLD = 500000
+# rows normalized at a time when the matrix is built
+CHUNK = 100000
+
+class InferredDocvecs(object):
+	'''
+	Sentence vectors inferred with a doc2vec model and saved as a .npy file
+	at path, read like a model's docvecs. Sentences are indexed by their
+	position in the file.
+	'''
+	def __init__(self, path):
+		self.vectors_docs = np.load(path, mmap_mode='r')
+
+	def index_to_doctag(self, index):
+		return int(index)
+
+class SentenceIndex(object):
+	'''
+	Answers top-n sentence queries against the document vectors of a doc2vec
+	model (docvecs), or against InferredDocvecs. path is the file the
+	vectors were saved to.
+
+	The L2-normalized document vectors are built once per saved file and
+	kept next to it as a float32 .npy file (<path>.docvecs_norm.npy) that
+	is memory-mapped read-only, so nothing is normalized or copied per
+	query and processes using the same vectors share the pages. All the
+	queries of a product are scored with one matrix multiply, and the top n
+	of every query are picked with argpartition.
+
+	Exact mode reproduces docvecs.most_similar: queries are normalized with
+	the same gensim helper, and the top n are selected and ordered the way
+	matutils.argsort does, so the same sentences come back in the same
+	order. (The similarities themselves can differ from most_similar's in
+	the last float32 bit, since a matrix product may sum in another order.)
+
+	With approximate=True, or by default from APPROX_THRESHOLD sentences,
+	queries are answered from an inverted file index instead: the vectors
+	are clustered with spherical k-means into nlist clusters and a query is
+	scored exactly against the sentences of its nprobe closest clusters
+	only. Results are approximate; raise nprobe to trade speed for recall.
+	'''
+	def __init__(self, docvecs, path, **kwargs):
+		self.path = path
+		self.docvecs = docvecs
+		count = len(self.docvecs.vectors_docs)
+		approximate = kwargs.get('approximate')
+		if approximate is None:
+			approximate = count >= APPROX_THRESHOLD
+		self.approximate = approximate
+		self.nlist = kwargs.get('nlist') or int(np.sqrt(count)) or 1
+		self.nprobe = kwargs.get('nprobe') or max(1, self.nlist // 10)
+		self.matrix = self._load_matrix()
+		self.centroids = None
+		self.order = None
+		self.offsets = None
+		if self.approximate:
+			self._load_ivf()
+
+	def _is_current(self, file_path):
+		return os.path.exists(file_path) and \
+				os.path.getmtime(file_path) >= os.path.getmtime(self.path)
+
+	def _tmp_path(self, file_path):
+		'''
+		Return a per-process path to build file_path under. It keeps the 
+		file's extension since np.savez appends .npz to paths without it.
+		'''
+		root, ext = os.path.splitext(file_path)
+		return '{}.tmp{}{}'.format(root, os.getpid(), ext)
+
+	def _load_matrix(self):
+		'''
+		Return the memory-mapped normalized vectors, building them first if
+		the vectors were saved after they were.
+
+		Other processes may have the matrix mapped, so it is built under a
+		temporary path and renamed into place instead of rewritten; readers 
+		keep their mapping of the old file.
+		'''
+		matrix_path = self.path + '.docvecs_norm.npy'
+		if not self._is_current(matrix_path):
+			then = time()
+			vectors = self.docvecs.vectors_docs
+			shape = vectors.shape
+			tmp_path = self._tmp_path(matrix_path)
+			matrix = np.lib.format.open_memmap(tmp_path, mode='w+', \
+												dtype=np.float32, shape=shape)
+			for start in range(0, shape[0], CHUNK):
+				chunk = vectors[start:start + CHUNK]
+				# same arithmetic as gensim's init_sims
+				norms = np.sqrt((chunk ** 2).sum(-1))[..., np.newaxis]
+				matrix[start:start + CHUNK] = (chunk / norms).astype(np.float32)
+			matrix.flush()
+			del matrix
+			os.rename(tmp_path, matrix_path)
+			msg = 'Built normalized doc2vec matrix of {} sentences in {:.1f}s'
+			logger.info(msg.format(shape[0], time() - then))
+		return np.load(matrix_path, mmap_mode='r')
+
+	def _load_ivf(self, iterations=10, sample_size=100000, seed=0):
+		'''
+		Load the inverted file index, building it first if it's out of date.
+		Like the matrix, it is built under a temporary path and renamed into
+		place.
+		'''
+		ivf_path = self.path + '.docvecs_ivf{}.npz'.format(self.nlist)
+		if not self._is_current(ivf_path):
+			then = time()
+			gen = np.random.RandomState(seed)
+			count = len(self.matrix)
+			sample = self.matrix[np.sort(gen.choice(count, \
+								min(count, sample_size), replace=False))]
+			centroids = sample[gen.choice(len(sample), self.nlist, replace=False)]
+			for _ in range(iterations):
+				assigned = np.argmax(sample.dot(centroids.T), axis=1)
+				for cluster in range(self.nlist):
+					members = sample[assigned == cluster]
+					if len(members):
+						centroid = members.sum(axis=0)
+						centroids[cluster] = centroid / np.linalg.norm(centroid)
+			assigned = np.concatenate([np.argmax(self.matrix[start:start + \
+						CHUNK].dot(centroids.T), axis=1) \
+						for start in range(0, count, CHUNK)])
+			order = np.argsort(assigned, kind='stable')
+			offsets = np.searchsorted(assigned[order], np.arange(self.nlist + 1))
+			tmp_path = self._tmp_path(ivf_path)
+			np.savez(tmp_path, centroids=centroids, order=order, offsets=offsets)
+			os.rename(tmp_path, ivf_path)
+			msg = 'Built doc2vec IVF index with {} clusters in {:.1f}s'
+			logger.info(msg.format(self.nlist, time() - then))
+		with np.load(ivf_path) as ivf:
+			self.centroids = ivf['centroids']
+			self.order = ivf['order']
+			self.offsets = ivf['offsets']
+
+	def _normalize(self, vectors):
+		'''
+		Normalize the query vectors exactly like most_similar does.
+		'''
+		return np.array([matutils.unitvec(np.array([vector]).mean(axis=0)).\
+						astype(np.float32) for vector in vectors])
+
+	def _top(self, dists, topn):
+		'''
+		Return the indices of the topn highest values of every row of dists,
+		highest first (matutils.argsort(..., reverse=True) row by row).
+		'''
+		dists = -dists
+		topn = min(topn, dists.shape[1])
+		if topn < dists.shape[1]:
+			best = np.argpartition(dists, topn, axis=1)[:, :topn]
+		else:
+			best = np.tile(np.arange(dists.shape[1]), (len(dists), 1))
+		taken = np.take_along_axis(dists, best, axis=1)
+		return np.take_along_axis(best, np.argsort(taken, axis=1), axis=1)
+
+	def _to_tags(self, indices, dists):
+		return [(self.docvecs.index_to_doctag(index), float(dist)) \
+				for index, dist in zip(indices, dists)]
+
+	def _exact(self, queries, topn):
+		dists = queries.dot(self.matrix.T)
+		best = self._top(dists, topn)
+		return [self._to_tags(best[i], dists[i, best[i]]) \
+				for i in range(len(queries))]
+
+	def _approximate(self, queries, topn):
+		results = []
+		probes = self._top(queries.dot(self.centroids.T), self.nprobe)
+		for query, clusters in zip(queries, probes):
+			candidates = np.concatenate([self.order[self.offsets[cluster]: \
+							self.offsets[cluster + 1]] for cluster in clusters])
+			candidates.sort()
+			dists = self.matrix[candidates].dot(query)[np.newaxis]
+			best = self._top(dists, topn)[0]
+			results.append(self._to_tags(candidates[best], dists[0, best]))
+		return results
+
+	def most_similar(self, vectors, topn=5):
+		'''
+		Return, for every vector, a list of the (tag, similarity) of the topn
+		sentences closest to it.
+		'''
+		if not len(vectors):
+			return []
+		queries = self._normalize(vectors)
+		if self.approximate:
+			return self._approximate(queries, topn)
+		return self._exact(queries, topn)
@@ -39,10 +39,12 @@ class SentencePrediction(d2v.Document2Vector):
 			msg = msg.format(self.frsku)
 			logger.info(msg)
 			predictions = collections.OrderedDict()
-			for topic_obj in self.topic_set:
-				raw_topic = topic_obj.topic.raw_topic
-				query = topic_obj.topic.query.lower()
-				pred_sents = self.infer_vectors(topic=query, topn=self.topn)
+			queries = [obj.topic.query.lower() for obj in self.topic_set]
+			# infer and look up every topic query of the product in one batch
+			vectors = self.query_vectors(queries)
+			sims = self.similar_sentences_batch([vectors.get(query) for query \
+												in queries], topn=self.topn)
+			for topic_obj, pred_sents in zip(self.topic_set, sims):
 				predictions[topic_obj.rank] = pred_sents
 			msg = 'Finished sentence prediction for FRSKU={}\n'
 			msg = msg.format(self.frsku)
@@ -173,6 +175,14 @@ class SentencePrediction(d2v.Document2Vector):
 		logger.info(msg.format(path))
 		
 
+	def _dump_name(self, label):
+		'''
+		Return the FRSKU's model (or, with a domain model, inferred vectors)
+		filename with its MODEL/VECTORS label replaced by label.
+		'''
+		filename = (self.vectors_path or self.d2v_model_path).split('/')[-1]
+		return filename.replace('MODEL', label).replace('VECTORS', label)
+
 	def predictions_to_file(self, validation=False):
 		'''
 		Output predicted sentences to csv for analysis.
@@ -180,8 +190,7 @@ class SentencePrediction(d2v.Document2Vector):
 		'''
 		root = 'file_dump/doc2vec/analysis/'
 		ch.make_directory(logger, root)
-		filename = self.d2v_model_path.split('/')[-1].replace('MODEL', 'SENTS')
-		filename = root + filename + '.csv'
+		filename = root + self._dump_name('SENTS') + '.csv'
 		params = {
 			'frsku': self.frsku,
 		}
@@ -246,9 +255,7 @@ class SentencePrediction(d2v.Document2Vector):
 			try:
 				root = 'file_dump/doc2vec/validation/'
 				ch.make_directory(logger, root)
-				filename = self.d2v_model_path.split('/')[-1]
-				filename = filename.replace('MODEL', 'VALIDATION')
-				filename = root + filename + '_T{}.csv'
+				filename = root + self._dump_name('VALIDATION') + '_T{}.csv'
 				filename = filename.format(i+1)
 				sent_iterable = []
 				for j in range(samples):
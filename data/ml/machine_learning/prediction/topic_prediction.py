@@ -1,14 +1,112 @@
 import csv
 from datetime import timedelta
+from django.db import connection
 import fooreviews.models as f_models
+import json
+import ml.machine_learning.prediction.aggregation as aggregation
+import ml.machine_learning.prediction.convergence as convergence
+import ml.machine_learning.modeling.lda_registry as lda_registry
 import ml.machine_learning.modeling.topic_modeling as tm
 import ml.models as m_models
+from multiprocessing import Pool, cpu_count
 import numpy as np
+import os
 from scipy import stats
 from time import time
 import services.loggers as loggers
 logger = loggers.Loggers(__name__).get_logger()
 
+# documents per lda.inference call
+INFERENCE_CHUNK = 2000
+
+# model, corpus and coherent-topic mask of the current worker process; set by
+# _init_worker
+_lda = None
+_corpus = None
+_coherent = None
+
+def topic_frequencies(lda, corpus, coherent, chunk_size=INFERENCE_CHUNK):
+	'''
+	Run one prediction iteration over corpus with array operations and return
+	the same {topic_num: [freq, w_avg]} as TopicPrediction._freq_mean does for
+	the per-document path.
+
+	lda.inference returns the gamma matrix of a whole chunk in one call; its
+	normalized rows are the document-topic distributions, from which the
+	predictions are selected (see aggregation.select_predictions) with the 
+	boolean coherent vector.
+	'''
+	freq = np.zeros(lda.num_topics, dtype=np.int64)
+	prob_sum = np.zeros(lda.num_topics)
+	for start in range(0, len(corpus), chunk_size):
+		gamma, _ = lda.inference(corpus[start:start + chunk_size])
+		probs = gamma / gamma.sum(axis=1, keepdims=True)
+		topic_nums, values = aggregation.select_predictions(probs, coherent)
+		chunk_freq, chunk_prob_sum, _ = aggregation.group_predictions(topic_nums, \
+													values, lda.num_topics)
+		freq += chunk_freq
+		prob_sum += chunk_prob_sum
+	return aggregation.freq_mean(freq, prob_sum, freq.sum())
+
+class _MeanInit(object):
+	'''
+	Stands in for an LDA model's random_state during inference. gensim draws
+	the initial gamma of every document from Gamma(100, 1/100); this returns
+	that distribution's mean (all ones) instead, which makes the inference
+	deterministic.
+	'''
+	def gamma(self, shape, scale, size):
+		return np.full(size, shape * scale)
+
+def analytic_frequencies(lda, corpus, coherent, chunk_size=INFERENCE_CHUNK):
+	'''
+	Return the expected {topic_num: [freq, w_avg]} of a prediction iteration
+	in a single deterministic pass.
+
+	The randomness the Monte Carlo iterations average over is only gensim's
+	initialization of the variational posterior, and inference iterates
+	every document to (nearly) the same document-topic distribution from any
+	initialization. Starting every document from the mean initialization 
+	yields that distribution directly, and the frequencies and weighted 
+	probabilities counted from it are the iterations' expected values up to
+	the inference tolerance.
+	'''
+	random_state = lda.random_state
+	lda.random_state = _MeanInit()
+	try:
+		return topic_frequencies(lda, corpus, coherent, chunk_size)
+	finally:
+		lda.random_state = random_state
+
+def seeded_frequencies(lda, corpus, coherent, seed, chunk_size=INFERENCE_CHUNK):
+	'''
+	Return the {topic_num: [freq, w_avg]} of one prediction iteration whose 
+	gamma initialization is drawn from seed. 
+
+	The model is shared through lda_registry by every TopicPrediction in 
+	the process, so its own random_state is put back afterwards.
+	'''
+	random_state = lda.random_state
+	lda.random_state = np.random.RandomState(seed)
+	try:
+		return topic_frequencies(lda, corpus, coherent, chunk_size)
+	finally:
+		lda.random_state = random_state
+
+def _init_worker(lda_name, path_model, corpus, coherent):
+	global _lda, _corpus, _coherent
+	_lda = lda_registry.get_model(lda_name, path_model)
+	_corpus = corpus
+	_coherent = coherent
+
+def _predict_iterations(seeds):
+	'''
+	Run one prediction iteration per seed in a worker process. Workers
+	inherit the same random state, so each iteration draws its own gamma
+	initialization from its seed.
+	'''
+	return [seeded_frequencies(_lda, _corpus, _coherent, seed) for seed in seeds]
+
 class TopicPrediction(tm.TopicModeling):
 	'''
 	Predicts LDA topics using the trained model for given
@@ -20,18 +118,50 @@ class TopicPrediction(tm.TopicModeling):
 		3. Get a frequency distribution of the topic numbers run 
 			a regression modeling to predict new probabilities
 		4. Rank the regression-modeled frequency-probability pair
+
+	With batch=True the iterations run through topic_frequencies instead of
+	one get_document_topics call per document, spread across a pool of
+	workers processes. Every iteration is seeded (seed + iteration number), 
+	so batch predictions are reproducible.
+
+	With ranking='analytic' the iterations are skipped altogether: the 
+	expected frequencies and probabilities are computed in one deterministic
+	pass (see analytic_frequencies) and ranked the same way. Use 
+	compare_rankings to check a product's analytic ranking against the 
+	iterated one before switching it over.
+
+	The iterations feed a convergence.ConvergenceMonitor. With early_stop=True
+	they stop as soon as the top_k ranking is stable and its confidence 
+	intervals are tight (see the monitor for the patience, min_iterations, 
+	ci_tolerance and z options); max_seconds caps their wall-clock time 
+	either way. The iterations run and the final stability metrics are saved
+	to ml/lda_regression/<frsku>_<LDARegression pk>.json.
 	'''
 	def __init__(self, **kwargs):
 		super(TopicPrediction, self).__init__(**kwargs)
 		self.clear_db = kwargs.get('clear_db')
+		self.batch = kwargs.get('batch')
+		self.workers = kwargs.get('workers') or cpu_count()
+		self.ranking = kwargs.get('ranking') or 'iterations'
+		self.convergence_params = {
+			'early_stop': kwargs.get('early_stop'),
+			'top_k': kwargs.get('top_k'),
+			'patience': kwargs.get('patience'),
+			'min_iterations': kwargs.get('min_iterations'),
+			'ci_tolerance': kwargs.get('ci_tolerance'),
+			'max_seconds': kwargs.get('max_seconds'),
+		}
+		self.monitor = None
+		self.regression_obj = None
 		self.lda_model = self.train_lda_model()
 		self.pred_exists = self._pred_exists()
 		self.incoherent = []
 		self.corpus = []
-		if not self.pred_exists:
+		if not self.pred_exists or self.clear_db:
 			self.incoherent = self._get_inchorent_topic_nums()
-			self.corpus = self._get_lda_bow(prediction=True)
-		self.freq_mean_fin = {}
+			if self.lda_model:
+				self.corpus = self._get_prediction_corpus(self.lda_model)
+		self.freq_mean_fin = self._new_accumulator()
 		self.final_avged = {}
 
 	def _pred_exists(self):
@@ -75,13 +205,16 @@ class TopicPrediction(tm.TopicModeling):
 			msg = 'Initiating LDA topic prediction for FRSKU={}\n'
 			msg = msg.format(self.frsku)
 			logger.info(msg)
-			for i in range(ITERATIONS):
-				logger.info('Prediction iteration number {}'.format(i+1))
-				self._predict()
-			final_avged = self._final_pred_avg(self.freq_mean_fin)
+			if self.ranking == 'analytic':
+				ITERATIONS = 0
+				final_avged = self._analytic_pred_avg()
+			else:
+				ITERATIONS = self._iterate_predictions(ITERATIONS)
+				final_avged = self._final_pred_avg(self.freq_mean_fin)
 			logger.info('Ranking predicted LDA topics')
 			pred_ranked = self._rank_predictions(final_avged)
 			logger.info('Done with topic ranking')
+			self._convergence_to_file()
 			logger.info('Saving predictions to db')
 			self._predictions_to_db(pred_ranked)
 			now = time()
@@ -102,20 +235,197 @@ class TopicPrediction(tm.TopicModeling):
 		'''	
 		# get raw predictions
 		logger.info('Getting raw predictions')
-		raw_predictions = self._get_raw_predictions(self.corpus)
+		topic_nums, probs = self._get_raw_predictions(self.corpus)
 
 		# group the predictions by their topic_num
 		logger.info('Grouping raw predictions')
-		params = {'pred_list': raw_predictions}
-		predictions_grouped, count = self._group_predictions(**params)
+		freq, prob_sum, count = self._group_predictions(topic_nums, probs)
 
 		# generate a frequency-mean probability for each group
 		logger.info('Calculating group frequency and mean probability')
-		freq_mean = self._freq_mean(predictions_grouped, count)
+		freq_mean = self._freq_mean(freq, prob_sum, count)
+
+		return freq_mean
 
-		# append group averages to a master dictionary
+	def _record(self, freq_mean):
+		'''
+		Append an iteration's group averages to the master dictionary and
+		return True if the iterations should stop.
+		'''
 		logger.info('Caching group frequency and average probability \n')
 		self._append_freq_mean(freq_mean, self.freq_mean_fin)
+		self.monitor.update(freq_mean)
+		return self.monitor.should_stop()
+
+	def _iterate_predictions(self, iterations):
+		'''
+		Run up to iterations prediction iterations and return the number run.
+		'''
+		self.monitor = convergence.ConvergenceMonitor(**self.convergence_params)
+		if self.batch:
+			self._predict_batch(iterations)
+		else:
+			for i in range(iterations):
+				logger.info('Prediction iteration number {}'.format(i+1))
+				if self._record(self._predict()):
+					break
+		summary = self.monitor.summary()
+		msg = 'Prediction iterations for FRSKU={} stopped: {}'
+		logger.info(msg.format(self.frsku, summary))
+		return summary.get('iterations')
+
+	def _convergence_to_file(self):
+		'''
+		Save the iteration count and stability metrics of the last prediction
+		next to its LDARegression entry. They are kept out of 
+		LDARegression.data, which data_generator reads as is.
+		'''
+		if not self.regression_obj:
+			return
+		summary = {'stopped_by': 'analytic', 'iterations': 0}
+		if self.monitor:
+			summary = self.monitor.summary()
+		summary.update({
+			'frsku': self.frsku,
+			'regression_id': self.regression_obj.id,
+		})
+		dir_regression = 'ml/lda_regression/'
+		if not os.path.exists(dir_regression):
+			os.makedirs(dir_regression)
+		path = dir_regression + '{}_{}.json'.format(self.frsku, self.regression_obj.id)
+		with open(path, 'w') as json_out:
+			json.dump(summary, json_out)
+		msg = 'Saved prediction convergence metrics for FRSKU={} to {}'
+		logger.info(msg.format(self.frsku, path))
+
+	def _analytic_pred_avg(self):
+		'''
+		Return the analytic counterpart of _final_pred_avg's averages.
+		'''
+		if not self.lda_model:
+			logger.debug('Failed to load a trained LDA model from disk')
+			return {}
+		coherent = self._get_coherent_mask()
+		return analytic_frequencies(self.lda_model, self.corpus, coherent)
+
+	def _get_ranks(self, averaged_predictions):
+		'''
+		Rank predictions like _rank_predictions without saving the regression.
+		'''
+		x = [freq_prob[0] for freq_prob in averaged_predictions.values()]
+		y = [freq_prob[1] for freq_prob in averaged_predictions.values()]
+		slope, intercept = stats.linregress(x, y)[:2]
+		pred_sorted = self._get_regression_probs(averaged_predictions, slope, \
+													intercept)
+		return self._get_ranked_topic_nums(pred_sorted)
+
+	def compare_rankings(self, iterations=1000, top_k=10):
+		'''
+		Rank the product's topics with both the iterated and the analytic 
+		method and report how well they agree. Nothing is saved to the db.
+
+		Topics missing from one ranking are ranked after its last topic. The
+		report (Spearman and Kendall rank correlations, and the share of the
+		iterated top_k found in the analytic top_k) is logged and returned; a 
+		per-topic comparison is written to 
+		ml/lda_topics/trials/<frsku>_ranking_comparison.csv.
+		'''
+		then = time()
+		self.freq_mean_fin = self._new_accumulator()
+		self._iterate_predictions(iterations)
+		iterated = self._final_pred_avg(self.freq_mean_fin)
+		iterated_secs = time() - then
+		then = time()
+		analytic = self._analytic_pred_avg()
+		analytic_secs = time() - then
+		iterated_ranks = self._get_ranks(iterated)
+		analytic_ranks = self._get_ranks(analytic)
+		topic_nums = sorted(set(iterated_ranks) | set(analytic_ranks))
+		worst = len(topic_nums) + 1
+		x = [iterated_ranks.get(num, [0, worst])[1] for num in topic_nums]
+		y = [analytic_ranks.get(num, [0, worst])[1] for num in topic_nums]
+		top_iterated = set(num for num in topic_nums \
+						if iterated_ranks.get(num, [0, worst])[1] <= top_k)
+		top_analytic = set(num for num in topic_nums \
+						if analytic_ranks.get(num, [0, worst])[1] <= top_k)
+		report = {
+			'frsku': self.frsku,
+			'iterations': iterations,
+			'topics': len(topic_nums),
+			'spearman': stats.spearmanr(x, y)[0],
+			'kendall': stats.kendalltau(x, y)[0],
+			'top_k': top_k,
+			'top_k_overlap': len(top_iterated & top_analytic) \
+								/ float(len(top_iterated) or 1),
+			'iterated_seconds': round(iterated_secs, 1),
+			'analytic_seconds': round(analytic_secs, 1),
+		}
+		dir_trials = 'ml/lda_topics/trials/'
+		if not os.path.exists(dir_trials):
+			os.makedirs(dir_trials)
+		path = dir_trials + '{}_ranking_comparison.csv'.format(self.frsku)
+		fields = ['topic_num', 'iterated_rank', 'analytic_rank', 'iterated_freq',
+					'analytic_freq', 'iterated_prob', 'analytic_prob']
+		with open(path, 'w') as csv_out:
+			writer = csv.DictWriter(csv_out, fieldnames=fields)
+			writer.writeheader()
+			for i, num in enumerate(topic_nums):
+				writer.writerow({
+					'topic_num': num,
+					'iterated_rank': x[i],
+					'analytic_rank': y[i],
+					'iterated_freq': iterated.get(num, [0, 0])[0],
+					'analytic_freq': analytic.get(num, [0, 0])[0],
+					'iterated_prob': iterated.get(num, [0, 0])[1],
+					'analytic_prob': analytic.get(num, [0, 0])[1],
+				})
+		msg = 'Ranking comparison for FRSKU={}: {}. Per-topic ranks saved to {}'
+		logger.info(msg.format(self.frsku, report, path))
+		return report
+
+	def _get_coherent_mask(self):
+		coherent = np.ones(self.lda_model.num_topics, dtype=bool)
+		incoherent = [num for num in self.incoherent if num < len(coherent)]
+		coherent[incoherent] = False
+		return coherent
+
+	def _predict_batch(self, iterations):
+		'''
+		Run the prediction iterations in batch mode and append their results
+		to freq_mean_fin, in iteration order.
+		'''
+		if not self.lda_model:
+			logger.debug('Failed to load a trained LDA model from disk')
+			return
+		coherent = self._get_coherent_mask()
+		seeds = [self.seed + i for i in range(iterations)]
+		if self.workers == 1:
+			for seed in seeds:
+				freq_mean = seeded_frequencies(self.lda_model, self.corpus, \
+												coherent, seed)
+				if self._record(freq_mean):
+					return
+			return
+		# a few tasks per worker keeps the pool busy without much overhead
+		step = max(1, iterations // (4 * self.workers))
+		tasks = [seeds[i:i + step] for i in range(0, iterations, step)]
+		# forked workers must not share the parent's db socket
+		connection.close()
+		initargs = (self.lda_name, self.path_model, self.corpus, coherent)
+		pool = Pool(self.workers, initializer=_init_worker, initargs=initargs)
+		done = 0
+		try:
+			for results in pool.imap(_predict_iterations, tasks):
+				for freq_mean in results:
+					done += 1
+					if self._record(freq_mean):
+						# the workers still running are terminated below
+						return
+				msg = 'Prediction iterations done: {}/{}'
+				logger.info(msg.format(done, iterations))
+		finally:
+			pool.terminate()
+			pool.join()
 
 	def _get_raw_predictions(self, corpus_bow):
 		'''
@@ -131,149 +441,61 @@ class TopicPrediction(tm.TopicModeling):
 			(12, 0.030923076923076932),
 			(13, 0.030923076923076932),
 			...]
+		Return the topic numbers and probabilities of the valid predictions of
+		every document as two arrays (see aggregation.select_predictions).
 		'''
-		raw_predictions = []
 		if self.lda_model:
-			for doc_corpus in corpus_bow:
-				predictions = self.lda_model.get_document_topics(doc_corpus)
-				predictions_list = self._sort_predictions(predictions)
-				highest = ()
-				INDEX = -1
-				for i in range(len(predictions_list)):
-					highest = predictions_list[i]
-					topic_num = highest[0]
-					if topic_num not in self.incoherent:
-						INDEX = i
-						break
-					else:
-						highest = ()
-				if highest:
-					# add all valid predictions
-					valid_preds = self._adjacent_probs(INDEX, predictions_list)
-					raw_predictions.extend(valid_preds)
-			if raw_predictions:
-				sorted_predictions = self._sort_predictions(raw_predictions)
-				return sorted_predictions
+			doc_topics = [self.lda_model.get_document_topics(doc_corpus) \
+							for doc_corpus in corpus_bow]
+			num_topics = self.lda_model.num_topics
+			probs = aggregation.dense_predictions(doc_topics, num_topics)
+			return aggregation.select_predictions(probs, self._get_coherent_mask())
 		else:
 			msg = 'Failed to load a trained LDA model from disk'
 			logger.debug(msg)
+			return np.zeros(0, dtype=np.int64), np.zeros(0)
 
 	def _sort_predictions(self, pred_list, col_num=1, regression_probs=False):
 		'''
 		Sort a list of 2-column tuples on the specified column in descending
 		order and convert the resulting numpy array to a nested list.
 		'''
-		COL_NUM = col_num
-		pred_array = np.array(pred_list)
-		pred_array = pred_array[np.argsort(-pred_array[:,COL_NUM])]
-		reformed_list = []
-		for p in pred_array:
-			topic_num = int(p[0])
-			prob = p[1]
-			to_append = [topic_num, prob]
-			if regression_probs:
-				freq = int(p[1])
-				prob_old = p[2]
-				prob_new = p[3]
-				to_append = [topic_num, freq, prob_old, prob_new]
-			reformed_list.append(to_append)
-		return reformed_list
-
-
-	def _adjacent_probs(self, index, predictions):
-		''' 
-		Return all predictions whose topic_nums are not incoherent 
-		and whose probabilities are equal to the highest valid prediction. 
-		'''
-		# use a defined precision; this is the default in the probs
-		PRECISION = 17
-		highest_prop = round(predictions[index][1], PRECISION)
-		valid_preds = [predictions[index]]
-		for i in range(len(predictions)):
-			try:
-				pred = predictions[index+i]
-				topic_num = pred[0]
-				prob = round(pred[1],PRECISION) 
-				if prob == highest_prop:
-					if topic_num not in self.incoherent:
-						valid_preds.append(pred)
-			except IndexError:
-				pass
-		return valid_preds
-
-	
-	def _group_predictions(self, pred_list=[]):
-		'''
-		Group predicted topic probabilities by by their topic numbers.
-		E.g. [[topic_num_x, a], [topic_num_y, b], [topic_num_x, c]]
-				to
-			{topic_num_x: [a, b, c], topic_num_y: [b]}
-		'''
-		pred_dict = {}
-		count = 0
-		for pred in pred_list:
-			topic_num = pred[0]
-			prob = pred[1]
-			if topic_num in pred_dict:
-				pred_dict[topic_num].append(prob)
-			else:
-				pred_dict[topic_num] = [prob]
-			count += 1
-		return pred_dict, count
+		return aggregation.sort_predictions(pred_list, col_num, regression_probs)
 
-	def _freq_mean(self, pred_dict, total_pred_count):
+	def _group_predictions(self, topic_nums, probs):
+		'''
+		Group predicted topic probabilities by by their topic numbers: return
+		the prediction count and probability sum of every topic (indexed by 
+		topic_num) and the total number of predictions.
+		'''
+		num_topics = self.lda_model.num_topics
+		return aggregation.group_predictions(topic_nums, probs, num_topics)
+
+	def _freq_mean(self, freq, prob_sum, total_pred_count):
 		'''
 		Calculate the frequency and weighted average for each group of 
 		probabilities. To do so, take the arithmetic mean of the probabilities 
 		for each group and normalize it by weighting the resulting value using
 		the group's weighting factor.
-		E.g. {topic_num: [a, b, c,..]}, where a,b,c, etc. are the probablities
-
 		'''
-		freq_mean_dict = {}
-		for topic_num, probs in pred_dict.items():
-			freq = len(probs)
-			w_factor = freq/float(total_pred_count)
-			group_avg =  sum(probs)/float(freq)
-			w_avg = w_factor*group_avg
-			freq_mean_dict[topic_num] = [freq, w_avg]
-		return freq_mean_dict
+		return aggregation.freq_mean(freq, prob_sum, total_pred_count)
 
-	def _append_freq_mean(self, freq_mean_dict, master_dict):
-		'''
-		Append a list of [freq, mean] by topic_num to a master dictionary.
+	def _new_accumulator(self):
+		num_topics = self.lda_model.num_topics if self.lda_model else 0
+		return aggregation.new_accumulator(num_topics)
 
-		We're not returning anything because we're working with references
-		to global variables.
+	def _append_freq_mean(self, freq_mean_dict, accumulator):
 		'''
-		for topic_num, freq_mean_list in freq_mean_dict.items():
-			if topic_num in master_dict:
-				master_dict[topic_num].append(freq_mean_list)
-			else:
-				master_dict[topic_num] = [freq_mean_list]
+		Add an iteration's [freq, mean] by topic_num to the running totals.
+		'''
+		aggregation.append_freq_mean(freq_mean_dict, accumulator)
 
-	def _final_pred_avg(self, master_dict):
+	def _final_pred_avg(self, accumulator):
 		'''
 		Get the final frequency and probability averages from all 
 		the iterations.
 		'''
-		averaged_dict = {}
-		for topic_num, freq_mean_nested in master_dict.items():
-			freq_total = 0
-			prob_total = 0
-			count = 0
-			for val in freq_mean_nested:
-				# the size of the nested list should equal the number of 
-				# iterations
-				freq = val[0]
-				prob = val[1]
-				freq_total += freq
-				prob_total += prob
-				count += 1
-			avg_freq = freq_total/count
-			avg_prob = prob_total/float(count)
-			averaged_dict[topic_num] = [avg_freq, avg_prob]
-		return averaged_dict
+		return aggregation.final_pred_avg(accumulator)
 
 	def _rank_predictions(self, averaged_predictions):
 		'''
@@ -331,6 +553,7 @@ class TopicPrediction(tm.TopicModeling):
 			'data': data,
 		}
 		obj = m_models.LDARegression.objects.create(**entry)
+		self.regression_obj = obj
 		msg = 'Created new regression data with pk={} for FRSKU={}'
 		msg = msg.format(obj.id, self.frsku)
 		logger.info(msg)
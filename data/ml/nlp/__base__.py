@@ -12,6 +12,7 @@ class BaseNLP(object):
 		self.domain = kwargs.get('domain')
 		self.subdomain = kwargs.get('subdomain')
 		self.training = kwargs.get('training')
+		self.incremental = kwargs.get('incremental')
 
 	def get_review_set(self, **kwargs):
 		review_mapper = kwargs.get('review_mapper')
@@ -78,6 +79,10 @@ class BaseNLP(object):
 				# 'bow_parsed': False,
 				'review_raw__crawl_cache__crawl_queue__product_raw__product__frsku': self.frsku,
 				}
+				if self.incremental:
+					# NLPreprocessor narrows this down to new, changed and 
+					# outdated reviews
+					params['unique'] = True
 				review_set = self.m_models.AnalysisCorpus.objects.filter(**params)
 				msg = 'Retrieved review objects from AnalysisCorpus for NLP ' 
 				msg += 'preprocessing. FRSKU={}'.format(self.frsku)
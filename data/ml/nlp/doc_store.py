@@ -0,0 +1,233 @@
+import ml.nlp.spacy_registry as spacy_registry
+import ml.nlp.text_hash as text_hash
+import os
+import sqlite3
+from uuid import uuid4
+import services.common_helper as ch
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+# token attributes kept for every doc; sentence boundaries and noun chunks
+# are derived from HEAD/DEP (spaCy refuses SENT_START alongside HEAD)
+ATTRS = ['ORTH', 'LEMMA', 'TAG', 'POS', 'HEAD', 'DEP']
+# shards with a smaller share of their docs still indexed are rewritten
+MIN_LIVE = 0.5
+
+def available():
+	'''
+	Return whether the installed spaCy can serialize docs in DocBin shards.
+	DocBin was added in spaCy 2.2; with an older release nothing is stored 
+	and every lookup is a miss, so all stages parse as they did before the 
+	store existed.
+	'''
+	try:
+		from spacy.tokens import DocBin
+	except ImportError:
+		return False
+	return True
+
+def pipeline_version(model=spacy_registry.MODEL, disable=spacy_registry.DISABLED):
+	'''
+	Return a string identifying the spaCy release, the model package version
+	and the disabled components. Docs parsed under a different pipeline
+	version are never served. The version is read from package metadata so
+	the model doesn't have to be loaded to compute it.
+	'''
+	import pkg_resources
+	import spacy
+	try:
+		model_version = pkg_resources.get_distribution(model).version
+	except pkg_resources.DistributionNotFound:
+		model_version = 'unknown'
+	version = 'spacy{}_{}{}_no-{}'.format(spacy.__version__, model, \
+							model_version, '-'.join(sorted(disable or ())))
+	return version
+
+class DocStore(object):
+	'''
+	Stores parsed spaCy docs on disk so that later pipeline stages can
+	read tokens, POS tags, lemmas and sentence boundaries without running
+	the model again.
+
+	Docs are written in DocBin shards, one per batch parsed by NLPEngine,
+	under root/corpus/pipeline_version/. A sqlite index maps every review id
+	to its shard, its position in the shard and the hash of the text it
+	was parsed from. A doc is only served if the hash matches the current
+	review text, so edited reviews are treated as misses; a new pipeline
+	version starts from an empty directory, so stale parses are never read.
+	Old version directories can be deleted at will. Docs that were parsed
+	again leave dead entries in their old shards; compact() deletes and
+	rewrites those shards.
+
+	corpus is 'analysis' or 'training' since review ids are only unique
+	within their corpus table.
+	'''
+	def __init__(self, **kwargs):
+		root = kwargs.get('root') or 'ml/doc_store/'
+		self.corpus = kwargs.get('corpus') or 'analysis'
+		model = kwargs.get('model') or spacy_registry.MODEL
+		disable = kwargs.get('disable') or spacy_registry.DISABLED
+		self.version = kwargs.get('version') or pipeline_version(model, disable)
+		self.path = os.path.join(root, self.corpus, self.version)
+		ch.make_directory(logger, self.path)
+		self.index_path = os.path.join(self.path, 'index.sqlite3')
+		self._vocab = None
+		with self._connect() as conn:
+			query = 'CREATE TABLE IF NOT EXISTS docs (review_id INTEGER '
+			query += 'PRIMARY KEY, content_hash TEXT, shard TEXT, '
+			query += 'position INTEGER)'
+			conn.execute(query)
+			query = 'CREATE TABLE IF NOT EXISTS shards (shard TEXT PRIMARY KEY, '
+			query += 'size INTEGER)'
+			conn.execute(query)
+
+	def _connect(self):
+		return sqlite3.connect(self.index_path)
+
+	def _get_vocab(self):
+		'''
+		Docs are deserialized against a blank English vocab; all the attributes
+		we need are stored with the docs.
+		'''
+		if self._vocab is None:
+			import spacy
+			self._vocab = spacy.blank('en').vocab
+		return self._vocab
+
+	def _read_shard(self, shard):
+		from spacy.tokens import DocBin
+		with open(os.path.join(self.path, shard), 'rb') as shard_in:
+			doc_bin = DocBin().from_bytes(shard_in.read())
+		return doc_bin.get_docs(self._get_vocab())
+
+	def write(self, shard_bytes, entries):
+		'''
+		Save a serialized DocBin shard and index its docs. entries is a list
+		of (review_id, content_hash) in shard order.
+		'''
+		shard = '{}.spacy'.format(uuid4())
+		with open(os.path.join(self.path, shard), 'wb') as shard_out:
+			shard_out.write(shard_bytes)
+		rows = [(review_id, content_hash, shard, position) \
+					for position, (review_id, content_hash) in enumerate(entries)]
+		with self._connect() as conn:
+			query = 'INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?)'
+			conn.executemany(query, rows)
+			query = 'INSERT OR REPLACE INTO shards VALUES (?, ?)'
+			conn.execute(query, (shard, len(rows)))
+		msg = 'Stored {} parsed docs in shard={}'.format(len(rows), shard)
+		logger.info(msg)
+
+	def _remove_shards(self, conn, shards):
+		conn.executemany('DELETE FROM shards WHERE shard = ?', \
+							[(shard,) for shard in shards])
+		for shard in shards:
+			try:
+				os.remove(os.path.join(self.path, shard))
+			except OSError:
+				# already removed by another process
+				pass
+
+	def _rewrite_shard(self, shard):
+		'''
+		Copy the docs of shard that are still indexed to a new shard and 
+		point their index entries at it. Entries another process moved in 
+		the meantime are left alone.
+		'''
+		with self._connect() as conn:
+			query = 'SELECT position, review_id FROM docs WHERE shard = ?'
+			live = dict(conn.execute(query, (shard,)))
+		try:
+			docs = self._read_shard(shard)
+		except (IOError, OSError):
+			return
+		kept = []
+		review_ids = []
+		for position, doc in enumerate(docs):
+			if position in live:
+				kept.append(doc)
+				review_ids.append(live.get(position))
+		new_shard = '{}.spacy'.format(uuid4())
+		with open(os.path.join(self.path, new_shard), 'wb') as shard_out:
+			shard_out.write(serialize(kept))
+		with self._connect() as conn:
+			query = 'UPDATE docs SET shard = ?, position = ? WHERE review_id = ? '
+			query += 'AND shard = ?'
+			conn.executemany(query, [(new_shard, position, review_id, shard) \
+								for position, review_id in enumerate(review_ids)])
+			query = 'INSERT OR REPLACE INTO shards VALUES (?, ?)'
+			conn.execute(query, (new_shard, len(kept)))
+			self._remove_shards(conn, [shard])
+
+	def compact(self, min_live=MIN_LIVE):
+		'''
+		Reclaim the space held by docs that were parsed again after they were
+		stored. Shards with none of their docs indexed any more are deleted;
+		shards with fewer than min_live of them are rewritten with just the
+		live docs, like token_corpus.compact does for token segments.
+
+		A reader that finds a shard gone treats its docs as misses.
+		'''
+		with self._connect() as conn:
+			query = 'SELECT shards.shard, shards.size, COUNT(docs.review_id) '
+			query += 'FROM shards LEFT JOIN docs ON docs.shard = shards.shard '
+			query += 'GROUP BY shards.shard'
+			rows = list(conn.execute(query))
+			dead = [shard for shard, size, live in rows if not live]
+			self._remove_shards(conn, dead)
+		sparse = [shard for shard, size, live in rows \
+					if live and live < min_live * size]
+		for shard in sparse:
+			self._rewrite_shard(shard)
+		if dead or sparse:
+			msg = 'Compacted parsed doc store {}: removed {} dead shards and '
+			msg += 'rewrote {} sparse ones'
+			logger.info(msg.format(self.path, len(dead), len(sparse)))
+
+	def get_docs(self, texts):
+		'''
+		Return a dictionary of review_id: Doc for every review in texts (a
+		dictionary of review_id: review_body) whose stored doc was parsed from
+		the same text. Reviews without a valid stored doc are left out.
+		'''
+		if not available():
+			return {}
+		wanted = {}
+		review_ids = list(texts.keys())
+		# stay below sqlite's limit on the number of query parameters
+		CHUNK = 500
+		with self._connect() as conn:
+			for start in range(0, len(review_ids), CHUNK):
+				chunk = review_ids[start:start + CHUNK]
+				query = 'SELECT review_id, content_hash, shard, position FROM '
+				query += 'docs WHERE review_id IN ({})'
+				query = query.format(', '.join('?' * len(chunk)))
+				for row in conn.execute(query, chunk):
+					review_id, content_hash, shard, position = row
+					text = texts.get(review_id)
+					if content_hash != text_hash.content_hash(text):
+						continue
+					wanted.setdefault(shard, {})[position] = review_id
+		docs = {}
+		for shard, positions in wanted.items():
+			try:
+				shard_docs = self._read_shard(shard)
+			except (IOError, OSError):
+				# removed by compact() since the index was read
+				continue
+			for position, doc in enumerate(shard_docs):
+				if position in positions:
+					docs[positions.get(position)] = doc
+		msg = 'Loaded {} of {} docs from the parsed doc store'
+		logger.info(msg.format(len(docs), len(texts)))
+		return docs
+
+def serialize(docs):
+	'''
+	Return the DocBin bytes of a list of docs.
+	'''
+	from spacy.tokens import DocBin
+	doc_bin = DocBin(attrs=ATTRS)
+	for doc in docs:
+		doc_bin.add(doc)
+	return doc_bin.to_bytes()
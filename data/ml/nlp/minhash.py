@@ -0,0 +1,223 @@
+from collections import defaultdict
+import numpy as np
+import ml.nlp.text_hash as text_hash
+import random
+from time import time
+import services.loggers as loggers
+import zlib
+logger = loggers.Loggers(__name__).get_logger()
+
+MAX_HASH = (1 << 32) - 1
+
+class MinHashLSH(object):
+	'''
+	Finds near-duplicate reviews with MinHash signatures and locality
+	sensitive hashing (LSH).
+
+	Each review is reduced to a set of word shingles, i.e. overlapping runs
+	of shingle_size words. The Jaccard similarity of two shingle sets is
+	estimated by the fraction of positions at which their MinHash signatures
+	agree. Signatures are split into bands of rows = num_perm/bands values;
+	two reviews become candidates when any one of their bands hashes to the
+	same bucket. Only candidates are compared, which keeps the search
+	sub-quadratic.
+
+	The similarity at which a pair has a 50% chance of becoming a candidate
+	is roughly (1/bands)^(1/rows); with the defaults (128 permutations, 16
+	bands of 8 rows) that's ~0.71, comfortably below the default threshold
+	of 0.8 so few true near-duplicates are missed.
+
+	Syndicated reviews usually differ by a few words (merchant name, a
+	trailing sentence, etc.), which is exactly what exact-body
+	deduplication misses.
+	'''
+	def __init__(self, **kwargs):
+		self.num_perm = kwargs.get('num_perm') or 128
+		self.bands = kwargs.get('bands') or 16
+		self.shingle_size = kwargs.get('shingle_size') or 3
+		self.threshold = kwargs.get('threshold') or 0.8
+		self.chunk_size = kwargs.get('chunk_size') or 1000
+		self.rows = self.num_perm // self.bands
+		if self.rows * self.bands != self.num_perm:
+			msg = 'num_perm={} is not divisible by bands={}'
+			raise ValueError(msg.format(self.num_perm, self.bands))
+		# multiply-shift hash functions h(x) = ((a*x + b) mod 2**64) >> 32;
+		# uint64 arithmetic wraps around so no explicit modulo is needed
+		gen = np.random.RandomState(kwargs.get('seed') or 1)
+		size = (self.num_perm, 2)
+		halves = gen.randint(0, 1 << 32, size=size).astype(np.uint64)
+		self.a = (halves[:, 0] << np.uint64(32)) | halves[:, 1] | np.uint64(1)
+		halves = gen.randint(0, 1 << 32, size=size).astype(np.uint64)
+		self.b = (halves[:, 0] << np.uint64(32)) | halves[:, 1]
+
+	def shingles(self, text):
+		'''
+		Return the unique 32-bit hashes of the word shingles of text.
+		'''
+		words = text_hash.normalize_body(text).split()
+		k = self.shingle_size
+		if not words:
+			return np.empty(0, dtype=np.uint64)
+		if len(words) <= k:
+			grams = [' '.join(words)]
+		else:
+			grams = [' '.join(words[i:i + k]) for i in range(len(words) - k + 1)]
+		hashes = set(zlib.crc32(g.encode('utf-8')) & MAX_HASH for g in grams)
+		return np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+
+	def _chunk_signatures(self, shingle_list):
+		'''
+		Return the signature matrix of a chunk of documents.
+
+		All the shingles of the chunk are hashed by every permutation in one
+		(num_perm x total shingles) array operation and then reduced to their
+		per-document minima with np.minimum.reduceat. Documents without
+		shingles get a signature of MAX_HASH, which never matches a real one.
+		'''
+		count = len(shingle_list)
+		signatures = np.full((count, self.num_perm), MAX_HASH, dtype=np.uint32)
+		lengths = np.array([len(s) for s in shingle_list], dtype=np.int64)
+		non_empty = np.nonzero(lengths)[0]
+		if not len(non_empty):
+			return signatures
+		x = np.concatenate([shingle_list[i] for i in non_empty])
+		hashed = np.outer(self.a, x)
+		hashed += self.b[:, None]
+		hashed >>= np.uint64(32)
+		offsets = np.concatenate(([0], np.cumsum(lengths[non_empty])[:-1]))
+		minima = np.minimum.reduceat(hashed, offsets, axis=1)
+		signatures[non_empty] = minima.T.astype(np.uint32)
+		return signatures
+
+	def signatures(self, texts):
+		'''
+		Return an (n x num_perm) uint32 signature matrix for an iterable of
+		texts, processed chunk_size documents at a time so that the
+		intermediate hash matrix stays small.
+		'''
+		chunks = []
+		shingle_list = []
+		for text in texts:
+			shingle_list.append(self.shingles(text))
+			if len(shingle_list) == self.chunk_size:
+				chunks.append(self._chunk_signatures(shingle_list))
+				shingle_list = []
+		if shingle_list:
+			chunks.append(self._chunk_signatures(shingle_list))
+		if not chunks:
+			return np.empty((0, self.num_perm), dtype=np.uint32)
+		return np.vstack(chunks)
+
+	def candidate_pairs(self, signatures):
+		'''
+		Return a set of (i, j) row index pairs, i < j, that share at least
+		one LSH band bucket.
+		'''
+		pairs = set()
+		valid = np.nonzero(signatures[:, 0] != MAX_HASH)[0]
+		for band in range(self.bands):
+			cols = slice(band * self.rows, (band + 1) * self.rows)
+			band_rows = np.ascontiguousarray(signatures[valid, cols])
+			keys = band_rows.view([('', band_rows.dtype)] * self.rows).ravel()
+			_, inverse, counts = np.unique(keys, return_inverse=True, \
+											return_counts=True)
+			inverse = inverse.ravel()
+			shared = np.nonzero(counts[inverse] > 1)[0]
+			if not len(shared):
+				continue
+			buckets = defaultdict(list)
+			for pos in shared:
+				buckets[inverse[pos]].append(valid[pos])
+			for members in buckets.values():
+				for m, i in enumerate(members):
+					for j in members[m + 1:]:
+						pairs.add((i, j) if i < j else (j, i))
+		return pairs
+
+	def similarity(self, signatures, i, j):
+		'''
+		Return the estimated Jaccard similarity of rows i and j.
+		'''
+		return np.mean(signatures[i] == signatures[j])
+
+	def duplicates(self, signatures):
+		'''
+		Return the row indexes of near-duplicates, i.e. rows whose estimated
+		Jaccard similarity with a lower row is at least threshold. Matches
+		are clustered transitively and the lowest row of every cluster is
+		kept.
+		'''
+		parent = {}
+
+		def find(i):
+			root = i
+			while parent.get(root, root) != root:
+				root = parent[root]
+			while parent.get(i, i) != root:
+				parent[i], i = root, parent[i]
+			return root
+
+		for i, j in self.candidate_pairs(signatures):
+			if self.similarity(signatures, i, j) >= self.threshold:
+				root_i, root_j = find(i), find(j)
+				if root_i != root_j:
+					parent[max(root_i, root_j)] = min(root_i, root_j)
+		return sorted(i for i in parent if find(i) != i)
+
+
+def _synthetic_corpus(review_count, near_dup_rate=0.1, seed=0):
+	'''
+	Return a list of synthetic reviews where about near_dup_rate of them are
+	copies of earlier reviews with one or two words replaced or appended.
+	'''
+	gen = random.Random(seed)
+	vocab = ['word{}'.format(i) for i in range(5000)]
+	reviews = []
+	for i in range(review_count):
+		if reviews and gen.random() < near_dup_rate:
+			words = gen.choice(reviews).split()
+			for _ in range(gen.randint(1, 2)):
+				words[gen.randrange(len(words))] = gen.choice(vocab)
+			if gen.random() < 0.5:
+				words.append(gen.choice(vocab))
+		else:
+			words = [gen.choice(vocab) for _ in range(gen.randint(30, 120))]
+		reviews.append(' '.join(words))
+	return reviews
+
+def benchmark(review_count=100000):
+	'''
+	Compare the throughput of exact-body deduplication (the hash pass used
+	by Deduplicate) against MinHash/LSH near-duplicate detection on a
+	synthetic corpus.
+
+	Usage (from the project root):
+		python -m ml.nlp.minhash
+	'''
+	reviews = _synthetic_corpus(review_count)
+	then = time()
+	seen = set()
+	exact = 0
+	for body in reviews:
+		digest = text_hash.body_hash(body)
+		if digest in seen:
+			exact += 1
+		seen.add(digest)
+	exact_time = time() - then
+
+	lsh = MinHashLSH()
+	then = time()
+	signatures = lsh.signatures(reviews)
+	sig_time = time() - then
+	near = lsh.duplicates(signatures)
+	near_time = time() - then
+
+	msg = '{} exact duplicates in {:.2f}s ({:.0f} reviews/sec)'
+	logger.info(msg.format(exact, exact_time, review_count/exact_time))
+	msg = '{} MinHash/LSH near-duplicates in {:.2f}s ({:.0f} reviews/sec); '
+	msg += 'signatures took {:.2f}s'
+	logger.info(msg.format(len(near), near_time, review_count/near_time, \
+							sig_time))
+
+if __name__ == '__main__':
+	benchmark()
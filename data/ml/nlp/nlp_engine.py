@@ -0,0 +1,178 @@
+from collections import deque
+from functools import partial
+import ml.nlp.doc_store as doc_store
+import ml.nlp.spacy_registry as spacy_registry
+import ml.nlp.text_hash as text_hash
+from multiprocessing import Pool
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+# sentence injected by merchants into promotional reviews
+AD = '[This review was collected as part of a promotion.]'
+
+# spaCy pipeline of the current worker process; set by _init_worker
+_nlp = None
+
+def get_sentences(doc):
+	'''
+	Return the sentence spans of a parsed doc, minus the promotional 
+	disclaimer.
+	'''
+	return [sent for sent in doc.sents if sent.text != AD]
+
+def get_words(span):
+	'''
+	Return the lower-cased tokens of a span without punctuation and 
+	whitespace (spaCy keeps runs of extra spaces and line breaks as tokens);
+	these are the words doc2vec is trained on.
+	'''
+	return [token.lower_ for token in span \
+			if not (token.is_punct or token.is_space)]
+
+def get_nouns(doc):
+	nouns = []
+	for np in doc.noun_chunks:
+		for token in np:
+			# ignore stop words and other non-nouns in the noun phrase
+			lemma = token.lemma_
+			if token.pos_ == 'NOUN' and len(lemma) > 1:
+				# only add nouns longer than one letter
+				# e.g. the 'c' in the noun phrase 'usb c' is dropped
+				nouns.append(lemma)
+	return nouns
+
+def doc_features(doc, review_id):
+	'''
+	Reduce a parsed doc to the plain values NLPreprocessor persists. Docs
+	can't be pickled cheaply, so this is what worker processes send back.
+	'''
+	sents = get_sentences(doc)
+	sent_list = [sent.text for sent in sents]
+	features = {
+		'review_id': review_id,
+		'content_hash': text_hash.content_hash(doc.text),
+		'sent_list': sent_list,
+		'sent_tokens': [get_words(sent) for sent in sents],
+		'sent_count': len(sent_list),
+		'word_count': len(doc.text.split()),
+		'nouns': get_nouns(doc),
+	}
+	return features
+
+def _init_worker(model, disable):
+	global _nlp
+	_nlp = spacy_registry.get_pipeline(model=model, disable=disable)
+
+def _parse_batch(batch, store_docs=False):
+	'''
+	Parse a batch of (review_body, review_id) tuples in a worker process.
+
+	Return the features of every doc and, if store_docs is set, the batch
+	serialized as a DocBin shard along with its (review_id, content_hash)
+	index entries; otherwise the last two values are None.
+	'''
+	params = {
+		'as_tuples': True,
+		'batch_size': len(batch),
+	}
+	features = []
+	docs = []
+	entries = []
+	for doc, review_id in _nlp.pipe(batch, **params):
+		features.append(doc_features(doc, review_id))
+		if store_docs:
+			docs.append(doc)
+			entries.append((review_id, text_hash.content_hash(doc.text)))
+	if not store_docs:
+		return features, None, None
+	return features, doc_store.serialize(docs), entries
+
+class NLPEngine(object):
+	'''
+	Parses reviews with spaCy across a pool of worker processes.
+
+	Reviews are sharded into batches of batch_size (review_body, review_id)
+	tuples. The pipeline, without the components we don't need, is loaded 
+	through spacy_registry before the pool is forked so that every worker 
+	shares the parent's copy instead of loading its own. The parsed
+	features stream back to the calling process as batches complete so a
+	single writer can persist them while the workers keep parsing.
+
+	spaCy parsing is CPU-bound and holds the GIL, so threads (nlp.pipe's
+	n_threads) don't help; processes scale with the number of cores. With
+	workers=1 everything runs in the calling process.
+
+	If a doc_store (see doc_store.DocStore) is given, the parsed docs are 
+	also serialized by the workers and written to the store here so that 
+	later stages can reuse the parses.
+
+	NB: Worker processes must not touch the db. Close the db connection
+	before calling parse() so that forked workers don't share its socket.
+	'''
+	def __init__(self, **kwargs):
+		self.workers = kwargs.get('workers') or 1
+		self.batch_size = kwargs.get('batch_size') or 100
+		self.model = kwargs.get('model') or spacy_registry.MODEL
+		self.disable = kwargs.get('disable') or spacy_registry.DISABLED
+		self.doc_store = kwargs.get('doc_store')
+		# batches submitted to the pool but not yet consumed
+		self.max_pending = kwargs.get('max_pending') or 2 * self.workers
+
+	def _batches(self, docs):
+		batch = []
+		for doc in docs:
+			batch.append(doc)
+			if len(batch) == self.batch_size:
+				yield batch
+				batch = []
+		if batch:
+			yield batch
+
+	def _collect(self, results):
+		'''
+		Write a parsed batch to the doc store, if any, and return its 
+		features.
+		'''
+		features, shard_bytes, entries = results
+		if self.doc_store and entries:
+			self.doc_store.write(shard_bytes, entries)
+		return features
+
+	def parse(self, docs):
+		'''
+		Yield the features (see doc_features) of every (review_body,
+		review_id) tuple in docs.
+
+		docs can be any iterable, including a generator streaming from the 
+		db. It is consumed lazily: at most max_pending batches are in flight 
+		at any time (Pool.imap would read it to the end up front), so memory 
+		stays flat no matter how many reviews there are.
+		'''
+		msg = 'Parsing reviews with {} NLP worker(s) and batch_size={}'
+		logger.info(msg.format(self.workers, self.batch_size))
+		_init_worker(self.model, self.disable)
+		parse_batch = partial(_parse_batch, store_docs=bool(self.doc_store))
+		if self.workers == 1:
+			for batch in self._batches(docs):
+				for features in self._collect(parse_batch(batch)):
+					yield features
+			return
+		pool = Pool(self.workers, initializer=_init_worker, \
+						initargs=(self.model, self.disable))
+		batches = self._batches(docs)
+		pending = deque()
+		try:
+			for batch in batches:
+				pending.append(pool.apply_async(parse_batch, (batch,)))
+				if len(pending) < self.max_pending:
+					continue
+				for features in self._collect(pending.popleft().get()):
+					yield features
+			while pending:
+				for features in self._collect(pending.popleft().get()):
+					yield features
+		finally:
+			# all results have been consumed (or the consumer gave up); the 
+			# workers are idle or no longer needed
+			pool.terminate()
+			pool.join()
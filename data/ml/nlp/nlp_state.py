@@ -0,0 +1,69 @@
+import ml.nlp.doc_store as doc_store
+import os
+import sqlite3
+import services.common_helper as ch
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+# bump whenever the BoW/sentence extraction in NLPreprocessor changes in a
+# way that should invalidate earlier results
+NLP_VERSION = 2
+
+def nlp_version():
+	'''
+	Return the version of the full preprocessing pipeline: the spaCy
+	pipeline version plus NLP_VERSION.
+	'''
+	return '{}_nlp{}'.format(doc_store.pipeline_version(), NLP_VERSION)
+
+class ProcessingState(object):
+	'''
+	Keeps track of which reviews NLPreprocessor has processed, from which
+	text (content hash) and under which pipeline version.
+
+	The state lives in a sqlite file under root/ (one per corpus since review
+	ids are only unique within their corpus table) rather than on the corpus
+	tables themselves.
+	'''
+	def __init__(self, **kwargs):
+		root = kwargs.get('root') or 'ml/nlp_state/'
+		corpus = kwargs.get('corpus') or 'analysis'
+		ch.make_directory(logger, root)
+		self.path = os.path.join(root, '{}.sqlite3'.format(corpus))
+		with self._connect() as conn:
+			query = 'CREATE TABLE IF NOT EXISTS state (review_id INTEGER '
+			query += 'PRIMARY KEY, content_hash TEXT, version TEXT)'
+			conn.execute(query)
+
+	def _connect(self):
+		return sqlite3.connect(self.path)
+
+	def get(self, review_ids):
+		'''
+		Return a dictionary of review_id: (content_hash, version) for every
+		review in review_ids that has been processed before.
+		'''
+		state = {}
+		review_ids = list(review_ids)
+		# stay below sqlite's limit on the number of query parameters
+		CHUNK = 500
+		with self._connect() as conn:
+			for start in range(0, len(review_ids), CHUNK):
+				chunk = review_ids[start:start + CHUNK]
+				query = 'SELECT review_id, content_hash, version FROM state '
+				query += 'WHERE review_id IN ({})'
+				query = query.format(', '.join('?' * len(chunk)))
+				for row in conn.execute(query, chunk):
+					review_id, content_hash, version = row
+					state[review_id] = (content_hash, version)
+		return state
+
+	def record(self, entries, version):
+		'''
+		Record a list of (review_id, content_hash) as processed under version.
+		'''
+		rows = [(review_id, content_hash, version) \
+					for review_id, content_hash in entries]
+		with self._connect() as conn:
+			query = 'INSERT OR REPLACE INTO state VALUES (?, ?, ?)'
+			conn.executemany(query, rows)
@@ -1,10 +1,17 @@
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
 import copy
+from django.db import connection, transaction
 import fooreviews.models as f_models
 import ml.nlp.__base__ as base_nlp
+import ml.nlp.doc_store as doc_store
+import ml.nlp.minhash as minhash
+import ml.nlp.nlp_engine as nlp_engine
+import ml.nlp.nlp_state as nlp_state
+import ml.nlp.text_hash as text_hash
+import ml.nlp.token_corpus as token_corpus
 import parsers.models as p_models
 import re
-import spacy
+from time import time
 from uuid import uuid4
 
 
@@ -12,10 +19,16 @@ class CorpusDataMapper(base_nlp.BaseNLP):
 	'''
 	Maps raw reviews found in ReviewRaw to either TrainingCorpus or 
 	AnalysisCorpus through ForeignKey relations.
+
+	With bulk=True, mapping is set-based: the unmapped review ids are 
+	computed with a single anti-join and the corpus rows are inserted with
+	bulk_create in batches of BATCH_SIZE, each batch in its own transaction.
 	'''
 
 	def __init__(self, **kwargs):
 		super(CorpusDataMapper, self).__init__(**kwargs)
+		self.bulk = kwargs.get('bulk')
+		self.BATCH_SIZE = kwargs.get('batch_size') or 5000
 		self.raw_set = super(CorpusDataMapper, self).\
 						get_review_set(review_mapper=True)
 
@@ -45,8 +58,7 @@ class CorpusDataMapper(base_nlp.BaseNLP):
 		'''
 		overlap_obj_list = []
 		field = 'crawl_cache__crawl_queue__crawl_corpus_parsed__product_id'
-		prset = f_models.ProductRaw.objects.filter(product__frsku=self.frsku)
-		merchant_id_list = [obj.source_product_id for obj in prset]
+		merchant_id_list = self._get_merchant_ids()
 		for mer_id in merchant_id_list:
 			params = {
 				field: mer_id
@@ -57,7 +69,90 @@ class CorpusDataMapper(base_nlp.BaseNLP):
 		self.logger.info(msg)
 		return overlap_obj_list, len(overlap_obj_list)
 
+	def _get_merchant_ids(self):
+		prset = f_models.ProductRaw.objects.filter(product__frsku=self.frsku)
+		merchant_id_list = [obj.source_product_id for obj in prset]
+		return merchant_id_list
+
+	def _get_overlap_queryset(self):
+		'''
+		Return the same reviews as _get_overlap_set() as a single queryset
+		so that they can be anti-joined and mapped in bulk.
+		'''
+		field = 'crawl_cache__crawl_queue__crawl_corpus_parsed__product_id'
+		params = {
+			field + '__in': self._get_merchant_ids(),
+		}
+		overlap_set = p_models.ReviewRaw.objects.filter(**params)
+		return overlap_set
+
+	def _get_corpus_model(self):
+		corpus_model = None
+		if self.training:
+			corpus_model = self.m_models.TrainingCorpus
+		elif self.frsku:
+			corpus_model = self.m_models.AnalysisCorpus
+		return corpus_model
+
+	def _get_unmapped_ids(self, raw_set, corpus_model):
+		'''
+		Return the ids of the reviews in raw_set that don't have a corpus 
+		entry yet. 
+
+		The reverse relation from ReviewRaw to the corpus model is filtered
+		on isnull, which the db evaluates as a LEFT JOIN anti-join in a 
+		single query. exclude(id__in=...) would compile to NOT IN over the 
+		whole corpus table instead.
+		'''
+		field = corpus_model._meta.get_field('review_raw')
+		params = {
+			field.related_query_name() + '__isnull': True,
+		}
+		unmapped_set = raw_set.filter(**params).order_by('id')
+		return list(unmapped_set.values_list('id', flat=True))
+
+	def _bulk_map(self, raw_set, flag_mapped=True):
+		'''
+		Map every unmapped review in raw_set in batches of BATCH_SIZE. 
+
+		Each batch is committed in its own transaction so a failure only 
+		rolls back the batch at hand; a rerun picks up where we left off 
+		since the anti-join skips whatever has already been mapped. ml_mapped 
+		is flipped for the whole set with a single UPDATE at the end.
+		'''
+		corpus_model = self._get_corpus_model()
+		id_list = self._get_unmapped_ids(raw_set, corpus_model)
+		total = len(id_list)
+		msg = 'About to bulk map {} reviews to {}'
+		self.logger.info(msg.format(total, corpus_model.__name__))
+		then = time()
+		for start in range(0, total, self.BATCH_SIZE):
+			batch = id_list[start:start + self.BATCH_SIZE]
+			batch_then = time()
+			with transaction.atomic():
+				bulk = [corpus_model(review_raw_id=pk) for pk in batch]
+				corpus_model.objects.bulk_create(bulk)
+			diff = max(time() - batch_then, 1e-6)
+			msg = 'Bulk mapped batch of {} reviews ({}/{}) at {:.0f} rows/sec'
+			msg = msg.format(len(batch), start + len(batch), total, len(batch)/diff)
+			self.logger.info(msg)
+		if flag_mapped:
+			raw_set.update(ml_mapped=True)
+		diff = max(time() - then, 1e-6)
+		msg = 'Bulk mapped {} reviews for domain={} subdomain={} FRSKU={} '
+		msg += 'at {:.0f} rows/sec'
+		msg = msg.format(total, self.domain, self.subdomain, self.frsku, \
+							total/diff)
+		self.logger.info(msg)
+		return total
+
 	def mapper(self):
+		if self.bulk:
+			if not self._bulk_map(self.raw_set):
+				self.logger.info('No reviews have been mapped')
+			if self.frsku:
+				self._map_overlap()
+			return
 		sorted_raw_set = self.raw_set.order_by('id')
 		for index in range(len(sorted_raw_set)):
 			obj = sorted_raw_set[index]
@@ -80,6 +175,11 @@ class CorpusDataMapper(base_nlp.BaseNLP):
 			self._map_overlap()
 
 	def _map_overlap(self):
+		if self.bulk:
+			# overlapping reviews are training reviews, which already have 
+			# ml_mapped set by the training mapper
+			self._bulk_map(self._get_overlap_queryset(), flag_mapped=False)
+			return
 		overlapping_set, count = self._get_overlap_set()
 		if count:
 			msg = 'About to map {} overlapping reviews for FRSKU={}'
@@ -98,37 +198,109 @@ class CorpusDataMapper(base_nlp.BaseNLP):
 class Deduplicate(base_nlp.BaseNLP):
 	'''
 	Removes duplicate reviews from a corpus. 
+
+	Duplicates are found in a single streamed pass over the domain's (or the 
+	FRSKU's) reviews: each body is normalized and hashed (see text_hash) and 
+	any review whose hash has already been seen is marked for deletion. 
+	Reviews are streamed in id order so the lowest id of every hash is the 
+	one that survives. Memory grows with the number of distinct hashes, not 
+	with the size of the review bodies, and no threads are involved.
+
+	With near_dupes=True, the exact pass is followed by a MinHash/LSH pass
+	(see minhash.MinHashLSH) that also removes reviews whose estimated 
+	Jaccard similarity to a lower-id review is at least jaccard, e.g. 
+	reviews syndicated across merchants with small edits.
 	'''
 
 	def __init__(self, **kwargs):
 		super(Deduplicate, self).__init__(**kwargs)
-		self.THREAD_COUNT = 10
-		
-	def dedupe(self):
+		self.BATCH_SIZE = 5000
+		self.near_dupes = kwargs.get('near_dupes')
+		self.jaccard = kwargs.get('jaccard') or 0.8
+
+	def _get_scope_set(self):
 		'''
-		Perform a shallow deduplication by removing reviews whose body matches
-		exactly that of another review. 
+		Return every corpus review the new reviews should be deduplicated 
+		against, i.e. the whole domain/subdomain for training or the whole 
+		FRSKU for analysis, including reviews that were already marked unique.
 		'''
-		field = 'review_raw__review_body'
-		model_sets = {
-				'training': self.m_models.TrainingCorpus.objects,
-				'analysis': self.m_models.AnalysisCorpus.objects,
-		}
-		# sets QuerySet to return a list instead of a tuple
-		params = {'flat':True} 
+		scope_set = None
 		if self.training:
-			model_set = model_sets.get('training')
+			params = {
+				'review_raw__domain': self.domain,
+				'review_raw__subdomain': self.subdomain,
+			}
+			scope_set = self.m_models.TrainingCorpus.objects.filter(**params)
 		elif self.frsku:
-			model_set = model_sets.get('analysis')
+			key = 'review_raw__crawl_cache__crawl_queue__product_raw__product'
+			key += '__frsku'
+			params = {key: self.frsku}
+			scope_set = self.m_models.AnalysisCorpus.objects.filter(**params)
+		return scope_set
+
+	def _get_duplicate_ids(self, scope_set):
+		'''
+		Return the ids of all reviews whose normalized body hash matches that 
+		of a review with a lower id.
+		'''
+		seen = set()
+		duplicate_ids = []
+		fields = ('id', 'review_raw__review_body')
+		rows = scope_set.order_by('id').values_list(*fields).iterator()
+		for pk, body in rows:
+			digest = text_hash.body_hash(body)
+			if digest in seen:
+				duplicate_ids.append(pk)
+			else:
+				seen.add(digest)
+		msg = 'Found {} duplicate reviews among {} distinct review bodies'
+		self.logger.info(msg.format(len(duplicate_ids), len(seen)))
+		return duplicate_ids
+
+	def _get_near_duplicate_ids(self, scope_set):
+		'''
+		Return the ids of all reviews that are near-duplicates of a review 
+		with a lower id. Only the MinHash signatures are kept in memory, not 
+		the review bodies.
+		'''
+		id_list = []
+		fields = ('id', 'review_raw__review_body')
+		rows = scope_set.order_by('id').values_list(*fields)
+
+		def bodies():
+			for pk, body in rows.iterator():
+				id_list.append(pk)
+				yield body
+
+		lsh = minhash.MinHashLSH(threshold=self.jaccard)
+		signatures = lsh.signatures(bodies())
+		duplicate_ids = [id_list[i] for i in lsh.duplicates(signatures)]
+		msg = 'Found {} near-duplicate reviews with Jaccard >= {} among {} '
+		msg += 'reviews'
+		msg = msg.format(len(duplicate_ids), self.jaccard, len(id_list))
+		self.logger.info(msg)
+		return duplicate_ids
 
-		# process the deduplication asynchronously
-		# Can confirm the threading makes some noticeable improvement 
+	def _delete_duplicates(self, scope_set, duplicate_ids):
+		model = scope_set.model
+		for start in range(0, len(duplicate_ids), self.BATCH_SIZE):
+			batch = duplicate_ids[start:start + self.BATCH_SIZE]
+			with transaction.atomic():
+				model.objects.filter(id__in=batch).delete()
+
+	def dedupe(self):
+		'''
+		Perform a shallow deduplication by removing reviews whose normalized 
+		body matches exactly that of another review. 
+		'''
 		review_set = super(Deduplicate, self).get_review_set(dedupe=True)
 		if review_set.count() > 0:
-			with ThreadPoolExecutor(max_workers=self.THREAD_COUNT) as executor:
-				# original code from StackOverflow
-				for body in model_set.values_list(field, **params).distinct():
-					executor.submit(self._async, body, field, model_set)
+			scope_set = self._get_scope_set()
+			duplicate_ids = self._get_duplicate_ids(scope_set)
+			self._delete_duplicates(scope_set, duplicate_ids)
+			if self.near_dupes:
+				duplicate_ids = self._get_near_duplicate_ids(scope_set)
+				self._delete_duplicates(scope_set, duplicate_ids)
 			review_set.update(unique=True)
 			if self.frsku:
 				msg = 'Updated reviews to unique for AnalysisCorpus'
@@ -143,101 +315,140 @@ class Deduplicate(base_nlp.BaseNLP):
 				msg = msg.format(self.domain, self.subdomain)
 		self.logger.info(msg)
 
-
-	def _async(self, body, field, model_set):
-		# TODO: this looks at all the reviews in the db; could 
-		# become slow of millions of reviews
-		msg = 'New thread initiated for deduplication. '
-		if self.training:
-			msg += 'Corpus=True Domain={} Subdomain={}'
-			msg = msg.format(self.domain, self.subdomain)
-		elif self.frsku:
-			msg += 'FRSKU={}'.format(self.frsku)
-		self.logger.info(msg)
-		model_set.filter(pk__in=model_set.filter(**{field:body}).\
-								values_list('id', flat=True)[1:]).delete()
-
 class NLPreprocessor(base_nlp.BaseNLP):
 	'''
 	Performs NLP analysis such as tokenization, lemmatization, stop word
 	identification, etc. using the spaCy NLP framework. 
+
+	Reviews are piped through spaCy as (review_body, review_id) tuples so 
+	that every parsed doc comes back with the id of the corpus review it 
+	belongs to. All db writes are keyed off that id.
+
+	Parsing is done by nlp_engine.NLPEngine, which shards the reviews 
+	across worker processes in batches of batch_size. The spaCy model is 
+	loaded in this process before the pool is forked and the workers share
+	it copy-on-write, so adding workers doesn't add model copies. Without 
+	workers, reviews are parsed in this process (workers=1); 
+	AnalysisWorkflow runs one worker per core by default. This process is 
+	the single writer that persists the results as they stream back.
+
+	Writes are buffered: BagofWords rows, SentenceTable rows and the 
+	corpus counter updates (bow_parsed, bow_count, sentence_count, 
+	word_count) are collected and flushed in a single transaction every 
+	flush_size documents. Rows that already exist (BagofWords by review,
+	SentenceTable by (review, sentence)) are looked up with one query per 
+	flush and left out, instead of being looked up one at a time.
+
+	With incremental=True (analysis only), only the reviews that have never 
+	been parsed, whose text changed since they were parsed, or that were 
+	parsed under an older pipeline version (see nlp_state) are processed. 
+	Their earlier BoW and SentenceTable rows are removed and their 
+	bow_parsed flag is cleared first. The content hash and version of every
+	analysis review are recorded on every run, incremental or not, so the
+	first incremental run after a full one only picks up what changed.
 	'''
 
 	def __init__(self, **kwargs):
 		super(NLPreprocessor, self).__init__(**kwargs)
 		self.review_set = super(NLPreprocessor, self).get_review_set(nlp=True)
-		self.doc_list = self._get_docs()
+		self.state = None
+		self.version = None
+		self.state_buffer = []
+		if self.frsku:
+			self.state = nlp_state.ProcessingState(corpus='analysis')
+			self.version = nlp_state.nlp_version()
+			if self.incremental:
+				self.review_set = self._get_incremental_set(self.review_set)
 		self.bow_str = ''
-
-		# load the more comprehensive English model
-		if len(self.doc_list):
-			self.logger.info('Loading spaCy NLP model...')
-			self.nlp = spacy.load('en_core_web_md')
+		self.chunk_size = kwargs.get('chunk_size') or 2000
+		self.workers = kwargs.get('workers') or 1
+		self.batch_size = kwargs.get('batch_size') or 100
+		self.flush_size = kwargs.get('flush_size') or 500
+		self.bow_buffer = []
+		self.sent_buffer = []
+		self.corpus_buffer = []
 
 	def _get_docs(self):
-		docs = []
-		if self.review_set.count():
-			docs = [obj.review_raw.review_body for obj in self.review_set]
-			# for debugging
-			# docs = [self.review_set[0].review_raw.review_body] 
-		return docs
-
-	def _get_sentence(self, doc, sent_list=None, review_obj=None):
-		AD = '[This review was collected as part of a promotion.]'
-		if review_obj and sent_list:
-			bulk = []
-			for sentence in sent_list:
-				if AD not in sentence:
+		'''
+		Yield (review_body, review_id) tuples for spaCy's as_tuples piping.
+
+		The rows are read in id ranges of chunk_size, so neither the review 
+		objects nor the full list of bodies are ever held in memory.
+		'''
+		fields = ('review_raw__review_body', 'id')
+		last_id = 0
+		while True:
+			rows = self.review_set.filter(id__gt=last_id).order_by('id')
+			rows = list(rows.values_list(*fields)[:self.chunk_size])
+			for row in rows:
+				yield row
+			if len(rows) < self.chunk_size:
+				break
+			last_id = rows[-1][1]
+
+	def _get_incremental_set(self, review_set):
+		'''
+		Return the reviews in review_set that are unparsed, changed, or 
+		parsed under an older pipeline version and clear their earlier 
+		results.
+
+		The rows are deleted and the reviews flagged unparsed in the same 
+		transaction, so a run that dies before reparsing them leaves them 
+		to be picked up again instead of flagged parsed without any rows.
+		'''
+		fields = ('id', 'review_raw__review_body', 'bow_parsed')
+		rows = list(review_set.values_list(*fields))
+		state = self.state.get(row[0] for row in rows)
+		stale_ids = []
+		for review_id, body, bow_parsed in rows:
+			current = (text_hash.content_hash(body), self.version)
+			if not bow_parsed or state.get(review_id) != current:
+				stale_ids.append(review_id)
+		with transaction.atomic():
+			lookup = {'a_review__id__in': stale_ids}
+			self.m_models.BagofWords.objects.filter(**lookup).delete()
+			lookup = {'review__id__in': stale_ids}
+			self.m_models.SentenceTable.objects.filter(**lookup).delete()
+			stale_set = self.m_models.AnalysisCorpus.objects.filter(id__in=stale_ids)
+			stale_set.update(bow_parsed=False)
+		msg = 'Incremental NLP: {} of {} reviews need processing for FRSKU={}'
+		self.logger.info(msg.format(len(stale_ids), len(rows), self.frsku))
+		return review_set.filter(id__in=stale_ids)
+
+	def _get_corpus_model(self):
+		corpus_model = None
+		if self.training:
+			corpus_model = self.m_models.TrainingCorpus
+		elif self.frsku:
+			corpus_model = self.m_models.AnalysisCorpus
+		return corpus_model
+
+	def _get_sentence(self, sent_list, review_id, sent_tokens):
+		'''
+		Return a list of new SentenceTable objects and a list with the words 
+		of each of their sentences.
+		'''
+		bulk = []
+		tokens = []
+		if review_id and sent_list:
+			for sentence, words in zip(sent_list, sent_tokens):
+				if nlp_engine.AD not in sentence:
 					entry = {
-						'review': review_obj,
+						'review_id': review_id,
 						'sentence': sentence,
 						'tag': str(uuid4()),
 					}
 					bulk.append(self.m_models.SentenceTable(**entry))
+					tokens.append(words)
 			if bulk:
 				msg = 'Bulk SentenceTable object created for review_pk={}'
-				msg = msg.format(review_obj.id)
+				msg = msg.format(review_id)
 				self.logger.info(msg)
-			return bulk
-		else:
-			sent_list = []
-			for sentence in doc.sents:
-				s = sentence.text
-				if s != AD:
-					sent_list.append(s)
-					self.logger.info('New Sentence: {}'.format(s)) 
-			sent_count = len(sent_list)
-			return sent_list, sent_count
-
-	def _get_review(self, doc):
-		review = ''
-		word_count = 0
-		if doc:
-			review = doc.text
-			word_count = len(review.split())
-		return review, word_count
-
-	def _review_reverse_lookup(self, review):
-		'''
-		Locate the review object a given sentence belongs to.
-
-		NB: We have no way of keeping track of the reviews during spaCy's piped
-		parsing step
+		return bulk, tokens
+
+	def _populate_sent_table(self, features):
 		'''
-		params = {
-			'review_raw__review_body':review,
-		}
-		# expect a single match since all reviews are unique
-		if self.frsku:
-			found = self.m_models.AnalysisCorpus.objects.filter(**params)
-		elif self.training:
-			found = self.m_models.TrainingCorpus.objects.filter(**params)
-		review_obj = found[0]
-		return review_obj
-		
-	def _populate_sent_table(self, doc):
-		'''
-		Populate SentenceTable using the sentences found in doc.
+		Populate SentenceTable using the sentences found in a parsed doc.
 		This process is only used in analysis, not training. SentenceTable is 
 		used in document vectorization.
 
@@ -245,48 +456,23 @@ class NLPreprocessor(base_nlp.BaseNLP):
 		be verify that there are enough number of nouns and noun phrases in the 
 		review as a whole before its sentence table can be populated.
 		'''
-		review_obj = -1
 		bulk = []
-		sent_count = 0
-		sent_list, sent_count = self._get_sentence(doc)
-		review, word_count = self._get_review(doc)			
-		if doc and sent_list:
-			try:
-				review_obj = self._review_reverse_lookup(review)
-				if self.frsku:
-					# SentenceTable not needed for training
-					bulk = self._get_sentence(doc,
-										sent_list=sent_list,
-										 review_obj=review_obj)
-			except Exception:
-				# we're mostly catching IndexError but we may also 
-				# encounter others
-				msg = 'Could not locate {} review for \'{}...\''
-				if self.training:
-					msg = msg.format('TrainingCorpus', sent_list[0])
-				elif self.frsku:
-					msg = msg.format('AnalysisCorpus', sent_list[0])
-				self.logger.exception(msg)
+		sent_tokens = []
+		review_id = features.get('review_id')
+		if self.frsku:
+			# SentenceTable not needed for training
+			bulk, sent_tokens = self._get_sentence(features.get('sent_list'), \
+								review_id, features.get('sent_tokens'))
 		kwargs = {
-			'review_obj': review_obj,
+			'review_id': review_id,
+			'content_hash': features.get('content_hash'),
 			'bulk': bulk,
-			'sent_count': sent_count,
-			'word_count': word_count,
+			'sent_tokens': sent_tokens,
+			'sent_count': features.get('sent_count'),
+			'word_count': features.get('word_count'),
 		}
 		return kwargs
 
-	def _get_nouns(self, doc):
-		nouns = []
-		for np in doc.noun_chunks:
-			for token in np:
-				# ignore stop words and other non-nouns in the noun phrase
-				lemma = token.lemma_
-				if token.pos_ == 'NOUN' and len(lemma) > 1:
-					# only add nouns longer than one letter
-					# e.g. the 'c' in the noun phrase 'usb c' is dropped
-					nouns.append(lemma)
-		return nouns
-
 	def _clean_bow(self, nouns):
 		'''
 		Return a single bag of words string after removing any non-alphanumeric
@@ -300,118 +486,180 @@ class NLPreprocessor(base_nlp.BaseNLP):
 
 	def _no_bow(self, **kwargs):
 		'''
-		Update the status field of review objects lacking any bag of words.
+		Buffer the status update of a review lacking any bag of words.
 
 		NB: Lack of bag of words is an indication of thin content review.
 		'''
-		try:
-			review_obj = kwargs.get('review_obj')
-			review_obj.bow_parsed = True 
-			if self.frsku:
-				word_count = kwargs.get('word_count')
-				sent_count = kwargs.get('sent_count')
-				review_obj.bow_count = 0
-				review_obj.sentence_count = sent_count
-				review_obj.word_count = word_count
-			review_obj.save()
-			msg = 'No bag of words found for {} review pk={}\n'
-			if self.training:
-				msg = msg.format('TrainingCorpus', review_obj.id)
-			elif self.frsku:
-				msg = msg.format('AnalysisCorpus', review_obj.id)
-			self.logger.info(msg)
-		except AttributeError:
-			msg = 'Sorry, no valid review_obj found to update bow status\n'
-			self.logger.info(msg)
+		review_id = kwargs.get('review_id')
+		kwargs['bow_count'] = 0
+		self._buffer_corpus_update(**kwargs)
+		msg = 'No bag of words found for {} review pk={}\n'
+		if self.training:
+			msg = msg.format('TrainingCorpus', review_id)
+		elif self.frsku:
+			msg = msg.format('AnalysisCorpus', review_id)
+		self.logger.info(msg)
 
-	def _get_params(self, corpus, review_obj, bow_str):
+	def _get_params(self, corpus, review_id, bow_str):
 		params = {
 			'training':  {
-						'a_review': None,
-						't_review': review_obj,
+						'a_review_id': None,
+						't_review_id': review_id,
 						'bow': bow_str,
 						'is_training_bow': True,
 						'is_analysis_bow': False,
 
 				},
 			'analysis': {
-						't_review': None,
-						'a_review': review_obj,
+						't_review_id': None,
+						'a_review_id': review_id,
 						'bow': bow_str,
 						'is_training_bow': False,
 						'is_analysis_bow': True,
 				},
 			}
 		return params.get(corpus)
-	def _object_exists(self, review_obj):
-		if self.training:
-			params = {'t_review__id': review_obj.id}
-		elif self.frsku:
-			params = {'a_review__id': review_obj.id}
-		EXISTS = self.m_models.BagofWords.objects.filter(**params).exists()
-		return EXISTS
+
+	def _buffer_corpus_update(self, **kwargs):
+		'''
+		Buffer the corpus counter updates for a parsed review. Counters are 
+		only kept for analysis reviews.
+		'''
+		fields = {
+			'bow_parsed': True,
+		}
+		if self.frsku:
+			fields['bow_count'] = kwargs.get('bow_count')
+			fields['sentence_count'] = kwargs.get('sent_count')
+			fields['word_count'] = kwargs.get('word_count')
+		self.corpus_buffer.append((kwargs.get('review_id'), fields))
+		if self.state:
+			entry = (kwargs.get('review_id'), kwargs.get('content_hash'))
+			self.state_buffer.append(entry)
 
 	def _save_BoW(self, **kwargs):
 		'''
-		Save the bag of words along with its proper domain/subdomain if for 
+		Buffer the bag of words along with its proper domain/subdomain if for 
 		training or frsku if for analysis.
 		'''
-		msg = 'Could not save BoW to db'
-		review_obj = kwargs.get('review_obj')
+		review_id = kwargs.get('review_id')
 		bow_str = kwargs.get('bow_str')
-		bow_count = kwargs.get('bow_count')
-		sent_count = kwargs.get('sent_count')
-		word_count = kwargs.get('word_count')
-		if not self._object_exists(review_obj):
-			if self.training:
-				params = self._get_params('training', review_obj, bow_str)
-				bow_obj = self.m_models.BagofWords.objects.create(**params)
-				msg = 'Saved BoW for TRAINING. Domain={} Subdomain={}'
-				msg += 'BoW pk={}\n'
-				msg = msg.format(self.domain, self.subdomain, bow_obj.id)
-			elif self.frsku:
-				params = self._get_params('analysis', review_obj, bow_str)
-				bow_obj = self.m_models.BagofWords.objects.create(**params)
-				review_obj.bow_count = bow_count
-				review_obj.sentence_count = sent_count
-				review_obj.word_count = word_count
-				msg = 'Saved BoW for ANALYSIS. FRSKU={} BoW pk={}\n'
-				msg = msg.format(self.frsku, -999) #bow_obj.id)
-			review_obj.bow_parsed = True
-			review_obj.save()
-			self.logger.info(msg)
-		else:
-			msg = 'Bag of words already exists for {} pk={}\n'
-			if self.training:
-				msg = msg.format('TrainingCorpus', review_obj.id)
-			elif self.frsku:
-				msg = msg.format('AnalysisCorpus', review_obj.id)
-			self.logger.info(msg)
+		if self.training:
+			params = self._get_params('training', review_id, bow_str)
+		elif self.frsku:
+			params = self._get_params('analysis', review_id, bow_str)
+		# same tokenization as TopicModeling._tokenize
+		tokens = bow_str.lower().split()
+		self.bow_buffer.append((self.m_models.BagofWords(**params), tokens))
+		self._buffer_corpus_update(**kwargs)
 
-	def _save_sentences(self, bulk):
-		'''
-		Inspect SentenceTable bulk object to make sure no table 
-		entry exists for a given object and then create a new 
-		entry.
-		'''
-		for index, obj in enumerate(bulk):
-			# check to see if the sentence exists; NB; we cannot use the 
-			# sentence tag even though it's unique because a unique one is 
-			# generated every time we run the script; Instead, we use a 
-			# deterministic pair of values that are guaranteed to be unique, 
-			# independent of however many times we run the script. If the 
-			# uniqueness fails, then the problem lies in our dependency parser
-			lookup = {
-				'sentence': obj.sentence,
-				'review__id': obj.review.id,
-			}
-			if self.m_models.SentenceTable.objects.filter(**lookup).exists():
+	def _save_sentences(self, bulk, sent_tokens):
+		'''
+		Buffer SentenceTable entries. 
+
+		NB: we cannot rely on the sentence tag even though it's unique because 
+		a new one is generated every time we run the script. _flush checks 
+		the deterministic (review, sentence) pair instead, which holds no 
+		matter how many times we run the script. The db doesn't enforce it, 
+		so if a duplicate slips through, the problem lies in our dependency 
+		parser.
+		'''
+		self.sent_buffer.extend(zip(bulk, sent_tokens))
+
+	def _new_bows(self):
+		'''
+		Return the buffered (BagofWords, tokens) whose review has no BoW in 
+		the db yet.
+		'''
+		if self.training:
+			field, key = 't_review_id', 't_review__id'
+		else:
+			field, key = 'a_review_id', 'a_review__id'
+		review_ids = [getattr(bow_obj, field) for bow_obj, _ in self.bow_buffer]
+		bow_set = self.m_models.BagofWords.objects.filter(**{key + '__in': review_ids})
+		existing = set(bow_set.values_list(key, flat=True))
+		new_bows = []
+		for bow_obj, tokens in self.bow_buffer:
+			review_id = getattr(bow_obj, field)
+			if review_id in existing:
+				msg = 'Bag of words already exists for review pk={}'
+				self.logger.info(msg.format(review_id))
+				continue
+			existing.add(review_id)
+			new_bows.append((bow_obj, tokens))
+		return new_bows
+
+	def _new_sentences(self):
+		'''
+		Return the buffered (SentenceTable, words) whose (review, sentence) 
+		pair isn't in the db yet.
+		'''
+		review_ids = set(sent_obj.review_id for sent_obj, _ in self.sent_buffer)
+		lookup = {'review__id__in': review_ids}
+		sent_set = self.m_models.SentenceTable.objects.filter(**lookup)
+		existing = set(sent_set.values_list('review__id', 'sentence'))
+		new_sents = []
+		for sent_obj, words in self.sent_buffer:
+			key = (sent_obj.review_id, sent_obj.sentence)
+			if key in existing:
 				msg = 'SentenceTable entry already exists for sentence={} '
 				msg += 'review_pk={}'
-				self.logger.info(msg.format(obj.sentence, obj.review.id))
-				bulk.pop(index)
-		if bulk:
-			self.m_models.SentenceTable.objects.bulk_create(bulk)
+				self.logger.info(msg.format(sent_obj.sentence, sent_obj.review_id))
+				continue
+			existing.add(key)
+			new_sents.append((sent_obj, words))
+		return new_sents
+
+	def _corpus_updates(self):
+		'''
+		Return the buffered corpus updates as (fields, review_ids) pairs, one 
+		per distinct set of field values, so that reviews with the same 
+		counters are updated by a single UPDATE.
+		'''
+		groups = defaultdict(list)
+		for review_id, fields in self.corpus_buffer:
+			groups[tuple(sorted(fields.items()))].append(review_id)
+		return [(dict(fields), review_ids) for fields, review_ids in groups.items()]
+
+	def _flush(self):
+		'''
+		Write all buffered rows to the db in a single transaction and clear
+		the buffers. Only the rows that were inserted are added to the token
+		corpora.
+
+		The buffers are cleared even if the transaction fails; the affected 
+		reviews are still flagged bow_parsed=False and get picked up by the 
+		next run.
+		'''
+		if not self.corpus_buffer:
+			return
+		try:
+			corpus_model = self._get_corpus_model()
+			with transaction.atomic():
+				new_bows = self._new_bows()
+				new_sents = self._new_sentences()
+				self.m_models.BagofWords.objects.\
+					bulk_create([bow_obj for bow_obj, _ in new_bows])
+				self.m_models.SentenceTable.objects.\
+					bulk_create([sent_obj for sent_obj, _ in new_sents])
+				for fields, review_ids in self._corpus_updates():
+					corpus_model.objects.filter(pk__in=review_ids).update(**fields)
+			for bow_obj, tokens in new_bows:
+				review_id = bow_obj.t_review_id or bow_obj.a_review_id
+				self.bow_writer.add(review_id, tokens)
+			for sent_obj, words in new_sents:
+				self.sent_writer.add(sent_obj.tag, words)
+			if self.state:
+				self.state.record(self.state_buffer, self.version)
+			msg = 'Flushed {} BoW, {} SentenceTable and {} corpus rows to db'
+			msg = msg.format(len(new_bows), len(new_sents), \
+								len(self.corpus_buffer))
+			self.logger.info(msg)
+		finally:
+			self.bow_buffer = []
+			self.sent_buffer = []
+			self.corpus_buffer = []
+			self.state_buffer = []
 
 	def parse_BoW(self):
 		'''
@@ -427,22 +675,70 @@ class NLPreprocessor(base_nlp.BaseNLP):
 		of errors because they can show up in the final trained model and 
 		make it difficult to optimize the hyperparameters.  
 		'''
-		for doc in self.nlp.pipe(self.doc_list, n_threads=4, batch_size=100):
+		params = {
+			'workers': self.workers,
+			'batch_size': self.batch_size,
+		}
+		store = None
+		if self.frsku and doc_store.available():
+			# keep the parses around for dependency parsing and doc2vec
+			store = doc_store.DocStore(corpus='analysis')
+			params['doc_store'] = store
+		engine = nlp_engine.NLPEngine(**params)
+		# forked workers must not inherit an open db connection; it's 
+		# reopened on the next query
+		connection.close()
+		self._open_token_corpora()
+		try:
+			self._parse(engine)
+		finally:
+			self._close_token_corpora()
+		if store:
+			store.compact()
+
+	def _open_token_corpora(self):
+		'''
+		Open new token corpus segments (see token_corpus) for the bags of 
+		words and, in analysis, for the sentences.
+		'''
+		scope = {
+			'frsku': self.frsku,
+			'domain': self.domain,
+			'subdomain': self.subdomain,
+		}
+		path = token_corpus.corpus_path('bow', **scope)
+		self.bow_writer = token_corpus.TokenCorpusWriter(path)
+		self.sent_writer = None
+		if self.frsku:
+			path = token_corpus.corpus_path('sentences', **scope)
+			self.sent_writer = token_corpus.TokenCorpusWriter(path)
+
+	def _close_token_corpora(self):
+		for writer in [self.bow_writer, self.sent_writer]:
+			if writer:
+				writer.close()
+				token_corpus.compact(writer.path)
+
+	def _parse(self, engine):
+		for features in engine.parse(self._get_docs()):
 			try:
-				kwargs =self._populate_sent_table(doc)
-				doc_bow = ''
-				nouns = self._get_nouns(doc)
+				kwargs = self._populate_sent_table(features)
+				nouns = features.get('nouns')
 				if nouns:
 					bow_str, bow_count = self._clean_bow(nouns)
 					self.logger.info('New BoW: {}'.format(bow_str))
 					if self.frsku:
-						self._save_sentences(kwargs.pop('bulk'))
+						self._save_sentences(kwargs.pop('bulk'), \
+												kwargs.pop('sent_tokens'))
 					kwargs['bow_str'] = bow_str
 					kwargs['bow_count'] = bow_count
 					self._save_BoW(**kwargs)
 				else:
 					self._no_bow(**kwargs)
+				if len(self.corpus_buffer) >= self.flush_size:
+					self._flush()
 			except Exception as e:
 				msg = '{}: {}'.format(type(e).__name__, e.args[0])
 				self.logger.exception(msg)
+		self._flush()
 
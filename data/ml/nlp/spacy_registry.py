@@ -0,0 +1,87 @@
+import os
+import resource
+import threading
+from time import time
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+# default model and the components none of our stages use; tokenization, POS
+# tagging, lemmatization (part of the tagger) and the dependency parse (noun
+# chunks and sentence boundaries) are all we need
+MODEL = 'en_core_web_md'
+DISABLED = ('ner',)
+
+_pipelines = {}
+_load_stats = {}
+_lock = threading.Lock()
+
+def resident_memory():
+	'''
+	Return the resident memory of the current process in MB.
+
+	/proc is only available on Linux; elsewhere we fall back to the peak
+	resident memory reported by getrusage.
+	'''
+	try:
+		with open('/proc/self/statm') as statm:
+			pages = int(statm.read().split()[1])
+		return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+	except (IOError, OSError, ValueError, IndexError):
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def get_pipeline(model=MODEL, disable=DISABLED):
+	'''
+	Return the spaCy pipeline for model with the disable components turned
+	off, loading it on first use.
+
+	Each (model, disabled components) configuration is loaded at most once
+	per process; loading en_core_web_md takes seconds and hundreds of MB
+	every time. Worker processes forked after the parent has loaded a
+	pipeline inherit it copy-on-write, so load the pipeline before creating
+	a process pool.
+	'''
+	key = (model, tuple(sorted(disable or ())))
+	with _lock:
+		nlp = _pipelines.get(key)
+		if nlp is None:
+			import spacy
+			rss = resident_memory()
+			then = time()
+			nlp = spacy.load(model, disable=list(key[1]))
+			stats = {
+				'seconds': time() - then,
+				'memory_mb': resident_memory() - rss,
+			}
+			_pipelines[key] = nlp
+			_load_stats[key] = stats
+			msg = 'Loaded spaCy pipeline={} disabled={} in {:.1f}s; resident '
+			msg += 'memory +{:.0f}MB (pid={} total={:.0f}MB)'
+			msg = msg.format(model, list(key[1]), stats.get('seconds'), \
+							stats.get('memory_mb'), os.getpid(), resident_memory())
+			logger.info(msg)
+	return nlp
+
+def get_tokenizer():
+	'''
+	Return a tokenizer-only English pipeline, created on first use.
+
+	The tokenizer of a blank English pipeline applies the same rules as the
+	full model's, and lexical attributes such as lower_ and is_punct don't
+	need the tagger or parser, so splitting text into words this way takes 
+	none of the model's load time or memory.
+	'''
+	key = ('blank_en', ())
+	with _lock:
+		nlp = _pipelines.get(key)
+		if nlp is None:
+			import spacy
+			nlp = spacy.blank('en')
+			_pipelines[key] = nlp
+	return nlp.tokenizer
+
+def load_stats():
+	'''
+	Return the load time (seconds) and resident memory increase (MB) of every
+	pipeline loaded by this process, keyed by (model, disabled components).
+	'''
+	return dict(_load_stats)
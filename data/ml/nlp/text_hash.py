@@ -0,0 +1,32 @@
+import hashlib
+import re
+
+WHITESPACE = re.compile(r'\s+', re.UNICODE)
+
+def normalize_body(text):
+	'''
+	Return a canonical form of a review body: lower-cased with all runs of 
+	whitespace collapsed into a single space. Two reviews whose bodies differ 
+	only in case or spacing normalize to the same string.
+	'''
+	if not text:
+		return ''
+	return WHITESPACE.sub(' ', text).strip().lower()
+
+def body_hash(text):
+	'''
+	Return the md5 hex digest of the normalized review body.
+
+	md5 is used as a content fingerprint only, not for anything security 
+	related; it's fast and its 32-character digest fits comfortably in an 
+	indexed column.
+	'''
+	normalized = normalize_body(text)
+	return hashlib.md5(normalized.encode('utf-8')).hexdigest()
+
+def content_hash(text):
+	'''
+	Return the md5 hex digest of the text exactly as given. Unlike body_hash,
+	any edit to the text, including case and spacing, changes the digest.
+	'''
+	return hashlib.md5((text or '').encode('utf-8')).hexdigest()
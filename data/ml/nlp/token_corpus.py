@@ -0,0 +1,199 @@
+from datetime import datetime
+import json
+import numpy as np
+import os
+import shutil
+import services.common_helper as ch
+import services.loggers as loggers
+logger = loggers.Loggers(__name__).get_logger()
+
+ROOT = 'ml/token_corpus/'
+# segments a corpus may have before compact() merges them
+MAX_SEGMENTS = 8
+
+def corpus_path(kind, frsku=None, domain=None, subdomain=None, root=ROOT):
+	'''
+	Return the directory of a token corpus.
+
+	kind is 'bow' (one document per review, keyed by corpus review id),
+	'sentences' (one document per sentence, keyed by SentenceTable tag) or
+	'reviews' (doc2vec words of one review, keyed by corpus review id).
+	Analysis corpora are scoped by FRSKU, training corpora by domain and
+	subdomain.
+	'''
+	if frsku:
+		scope = os.path.join('analysis', str(frsku))
+	else:
+		scope = os.path.join('training', '{}_{}'.format(domain, subdomain))
+	return os.path.join(root, scope, kind)
+
+def _load_vocab(path):
+	vocab = []
+	vocab_path = os.path.join(path, 'vocab.json')
+	if os.path.exists(vocab_path):
+		with open(vocab_path) as vocab_in:
+			vocab = json.load(vocab_in)
+	return vocab
+
+def _save_vocab(path, vocab):
+	'''
+	Replace the vocabulary of a corpus with a rename so that readers never 
+	see a partly written file.
+	'''
+	vocab_path = os.path.join(path, 'vocab.json')
+	tmp_path = '{}.tmp{}'.format(vocab_path, os.getpid())
+	with open(tmp_path, 'w') as vocab_out:
+		json.dump(vocab, vocab_out)
+	os.rename(tmp_path, vocab_path)
+
+class TokenCorpusWriter(object):
+	'''
+	Writes documents to a token corpus.
+
+	A corpus directory holds a vocabulary (vocab.json, a JSON list of tokens;
+	a token's id is its position) shared by all of its segments. Tokens are
+	arbitrary strings, including ones with line breaks in them. Every
+	writer adds one segment:
+		tokens.bin	all token ids of the segment back to back (uint32)
+		offsets.npy	start of every document in tokens.bin plus the end of
+					the last one (int64, n+1 values)
+		ids.npy		review id or sentence tag of every document
+	Token ids are streamed to tokens.bin as documents are added so the
+	writer's memory only grows with the vocabulary and the document count.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.vocab = _load_vocab(path)
+		self.token2id = dict((token, i) for i, token in enumerate(self.vocab))
+		self.new_tokens = []
+		segment = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+		self.segment_path = os.path.join(path, segment)
+		ch.make_directory(logger, self.segment_path)
+		self.tokens_out = open(os.path.join(self.segment_path, 'tokens.bin'), 'wb')
+		self.offsets = [0]
+		self.ids = []
+
+	def add(self, doc_id, tokens):
+		token_ids = []
+		for token in tokens:
+			token_id = self.token2id.get(token)
+			if token_id is None:
+				token_id = len(self.token2id)
+				self.token2id[token] = token_id
+				self.new_tokens.append(token)
+			token_ids.append(token_id)
+		self.tokens_out.write(np.array(token_ids, dtype=np.uint32).tobytes())
+		self.offsets.append(self.offsets[-1] + len(token_ids))
+		self.ids.append(doc_id)
+
+	def close(self):
+		'''
+		Finish the segment and append any new tokens to the vocabulary. A
+		segment without documents is removed.
+		'''
+		self.tokens_out.close()
+		if not self.ids:
+			os.remove(os.path.join(self.segment_path, 'tokens.bin'))
+			os.rmdir(self.segment_path)
+			return
+		if self.new_tokens:
+			_save_vocab(self.path, self.vocab + self.new_tokens)
+		np.save(os.path.join(self.segment_path, 'offsets.npy'), \
+				np.array(self.offsets, dtype=np.int64))
+		np.save(os.path.join(self.segment_path, 'ids.npy'), np.array(self.ids))
+		msg = 'Wrote token corpus segment={} with {} documents and {} new tokens'
+		logger.info(msg.format(self.segment_path, len(self.ids), \
+								len(self.new_tokens)))
+
+class TokenCorpus(object):
+	'''
+	Reads a token corpus written by TokenCorpusWriter.
+
+	Token ids are memory-mapped, so a document is a zero-copy uint32 view
+	into tokens.bin. When the same id was written to several segments (e.g.
+	a review that was processed again), the latest segment wins.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.vocab = _load_vocab(path)
+		self.segments = []
+		self.index = {}
+		names = []
+		if os.path.isdir(path):
+			names = sorted(name for name in os.listdir(path) \
+				if os.path.exists(os.path.join(path, name, 'ids.npy')))
+		self.segment_names = names
+		for seg_num, name in enumerate(names):
+			segment_path = os.path.join(path, name)
+			tokens_path = os.path.join(segment_path, 'tokens.bin')
+			if os.path.getsize(tokens_path):
+				tokens = np.memmap(tokens_path, dtype=np.uint32, mode='r')
+			else:
+				tokens = np.empty(0, dtype=np.uint32)
+			offsets = np.load(os.path.join(segment_path, 'offsets.npy'))
+			ids = np.load(os.path.join(segment_path, 'ids.npy'))
+			self.segments.append((tokens, offsets))
+			for position, doc_id in enumerate(ids.tolist()):
+				self.index[doc_id] = (seg_num, position)
+
+	def exists(self):
+		return bool(self.index)
+
+	def restrict(self, doc_ids):
+		'''
+		Leave only the documents in doc_ids in this reader, e.g. to drop 
+		documents whose db rows no longer exist.
+		'''
+		doc_ids = set(doc_ids)
+		self.index = dict((doc_id, location) for doc_id, location in \
+							self.index.items() if doc_id in doc_ids)
+
+	def __len__(self):
+		return len(self.index)
+
+	def __contains__(self, doc_id):
+		return doc_id in self.index
+
+	def token_ids(self, doc_id):
+		'''
+		Return the uint32 token ids of a document as a view into tokens.bin.
+		'''
+		seg_num, position = self.index[doc_id]
+		tokens, offsets = self.segments[seg_num]
+		return tokens[offsets[position]:offsets[position + 1]]
+
+	def words(self, doc_id):
+		return [self.vocab[i] for i in self.token_ids(doc_id)]
+
+	def doc_ids(self):
+		return list(self.index.keys())
+
+	def __iter__(self):
+		'''
+		Yield (doc_id, token_ids) for every live document.
+		'''
+		for doc_id in self.index:
+			yield doc_id, self.token_ids(doc_id)
+
+def compact(path, max_segments=MAX_SEGMENTS):
+	'''
+	Merge the live documents of a corpus with more than max_segments 
+	segments into a single new segment and remove the old ones. Documents
+	overwritten by a later segment are dropped.
+
+	Readers that already have the old segments open keep their mappings of
+	the removed files.
+	'''
+	corpus = TokenCorpus(path)
+	if len(corpus.segment_names) <= max_segments:
+		return
+	writer = TokenCorpusWriter(path)
+	try:
+		for doc_id, token_ids in corpus:
+			writer.add(doc_id, [corpus.vocab[i] for i in token_ids])
+	finally:
+		writer.close()
+	for name in corpus.segment_names:
+		shutil.rmtree(os.path.join(path, name))
+	msg = 'Compacted {} token corpus segments of {} into one with {} documents'
+	logger.info(msg.format(len(corpus.segment_names), path, len(corpus)))
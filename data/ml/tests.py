@@ -1,3 +1,269 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from gensim import matutils
+import ml.machine_learning.prediction.aggregation as aggregation
+from ml.machine_learning.prediction.convergence import ConvergenceMonitor
+from ml.machine_learning.prediction.retrieval import InferredDocvecs, \
+													SentenceIndex
+from ml.nlp.minhash import MinHashLSH
+import ml.nlp.text_hash as text_hash
+import ml.nlp.token_corpus as token_corpus
+import numpy as np
+import os
+import random
+import shutil
+import tempfile
 
-# Create your tests here.
+class TextHashTests(SimpleTestCase):
+	def test_normalize_body_collapses_case_and_whitespace(self):
+		self.assertEqual(text_hash.normalize_body('  Great\tBLENDER,\n\nworks  '), \
+							'great blender, works')
+		self.assertEqual(text_hash.normalize_body(None), '')
+
+	def test_body_hash_ignores_case_and_spacing(self):
+		self.assertEqual(text_hash.body_hash('Great blender'), \
+							text_hash.body_hash('  great\n BLENDER '))
+		self.assertNotEqual(text_hash.body_hash('Great blender'), \
+							text_hash.body_hash('Great toaster'))
+
+	def test_content_hash_sees_every_edit(self):
+		self.assertNotEqual(text_hash.content_hash('Great blender'), \
+							text_hash.content_hash('great blender'))
+		self.assertEqual(text_hash.content_hash(None), text_hash.content_hash(''))
+
+class MinHashLSHTests(SimpleTestCase):
+	def setUp(self):
+		gen = random.Random(0)
+		vocab = ['word{}'.format(i) for i in range(1000)]
+		self.reviews = [' '.join(gen.choice(vocab) for _ in range(100)) \
+						for _ in range(3)]
+		self.lsh = MinHashLSH()
+
+	def _edited(self, text, position, word='edited'):
+		words = text.split()
+		words[position] = word
+		return ' '.join(words)
+
+	def test_exact_and_near_duplicates_are_found(self):
+		texts = [self.reviews[0], self.reviews[1], self.reviews[0].upper(), \
+				self._edited(self.reviews[1], 50), self.reviews[2]]
+		signatures = self.lsh.signatures(texts)
+		self.assertEqual(self.lsh.duplicates(signatures), [2, 3])
+
+	def test_distinct_and_empty_reviews_are_kept(self):
+		signatures = self.lsh.signatures(self.reviews + ['', ''])
+		self.assertEqual(self.lsh.duplicates(signatures), [])
+
+	def test_matches_are_clustered_under_the_lowest_row(self):
+		near = self._edited(self.reviews[0], 30)
+		nearer = self._edited(near, 60)
+		signatures = self.lsh.signatures([self.reviews[1], self.reviews[0], \
+											near, nearer])
+		self.assertEqual(self.lsh.duplicates(signatures), [2, 3])
+
+	def test_signatures_do_not_depend_on_chunk_size(self):
+		texts = self.reviews + ['', 'short one']
+		chunked = MinHashLSH(chunk_size=2).signatures(texts)
+		np.testing.assert_array_equal(chunked, self.lsh.signatures(texts))
+
+class TokenCorpusTests(SimpleTestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def _write(self, docs):
+		writer = token_corpus.TokenCorpusWriter(self.path)
+		for doc_id, tokens in docs:
+			writer.add(doc_id, tokens)
+		writer.close()
+
+	def test_round_trip(self):
+		docs = [(1, ['great', 'blender']), (2, []), (3, ['a\nb', 'great', ' '])]
+		self._write(docs)
+		corpus = token_corpus.TokenCorpus(self.path)
+		self.assertEqual(len(corpus), 3)
+		for doc_id, tokens in docs:
+			self.assertEqual(corpus.words(doc_id), tokens)
+		self.assertEqual(corpus.vocab, ['great', 'blender', 'a\nb', ' '])
+
+	def test_later_segments_extend_the_vocabulary_and_win(self):
+		self._write([(1, ['old', 'words']), (2, ['kept'])])
+		self._write([(1, ['new', 'words\n'])])
+		corpus = token_corpus.TokenCorpus(self.path)
+		self.assertEqual(corpus.words(1), ['new', 'words\n'])
+		self.assertEqual(corpus.words(2), ['kept'])
+		self.assertEqual(len(corpus.segment_names), 2)
+
+	def test_empty_writer_leaves_no_segment(self):
+		self._write([])
+		self.assertFalse(token_corpus.TokenCorpus(self.path).exists())
+
+	def test_compact_keeps_the_live_documents(self):
+		self._write([(1, ['old']), (2, ['two'])])
+		self._write([(1, ['new'])])
+		token_corpus.compact(self.path, max_segments=1)
+		corpus = token_corpus.TokenCorpus(self.path)
+		self.assertEqual(len(corpus.segment_names), 1)
+		self.assertEqual(sorted(corpus.doc_ids()), [1, 2])
+		self.assertEqual(corpus.words(1), ['new'])
+		self.assertEqual(corpus.words(2), ['two'])
+
+class ConvergenceMonitorTests(SimpleTestCase):
+	def _monitor(self, **kwargs):
+		return ConvergenceMonitor(min_iterations=5, patience=3, top_k=2, **kwargs)
+
+	def test_stable_ranking_converges(self):
+		monitor = self._monitor(early_stop=True)
+		freq_mean = {0: [10, 0.5], 1: [4, 0.2], 2: [1, 0.1]}
+		for iteration in range(1, 6):
+			monitor.update(freq_mean)
+			self.assertEqual(monitor.should_stop(), iteration == 5)
+		summary = monitor.summary()
+		self.assertEqual(summary['stopped_by'], 'converged')
+		self.assertEqual(summary['top_k'], [0, 1])
+		self.assertEqual(summary['iterations'], 5)
+
+	def test_convergence_only_stops_with_early_stop(self):
+		monitor = self._monitor()
+		for _ in range(10):
+			monitor.update({0: [10, 0.5], 1: [4, 0.2]})
+		self.assertTrue(monitor.converged())
+		self.assertFalse(monitor.should_stop())
+		self.assertEqual(monitor.summary()['stopped_by'], 'max_iterations')
+
+	def test_changing_ranking_does_not_converge(self):
+		monitor = self._monitor(early_stop=True)
+		for iteration in range(20):
+			lead = [10 + iteration, 0.5] if iteration % 2 else [1, 0.1]
+			monitor.update({0: lead, 1: [8, 0.3], 2: [6, 0.2]})
+			self.assertFalse(monitor.should_stop())
+
+	def test_running_statistics_match_numpy(self):
+		monitor = self._monitor()
+		gen = np.random.RandomState(0)
+		freqs, probs = gen.randint(1, 20, 30), gen.rand(30)
+		for freq, prob in zip(freqs, probs):
+			monitor.update({3: [freq, prob]})
+		count, freq, freq_m2, prob, prob_m2 = monitor.stats[3]
+		self.assertEqual(count, 30)
+		self.assertAlmostEqual(freq, freqs.mean())
+		self.assertAlmostEqual(freq_m2 / (count - 1), freqs.var(ddof=1))
+		self.assertAlmostEqual(prob, probs.mean())
+		self.assertAlmostEqual(prob_m2 / (count - 1), probs.var(ddof=1))
+
+	def test_time_budget_stops_without_convergence(self):
+		monitor = self._monitor(max_seconds=1)
+		monitor.started -= 2
+		self.assertTrue(monitor.should_stop())
+		self.assertEqual(monitor.stopped_by, 'time_budget')
+
+class AggregationTests(SimpleTestCase):
+	def _array_iteration(self, doc_topics, coherent, accumulator):
+		num_topics = len(coherent)
+		probs = aggregation.dense_predictions(doc_topics, num_topics)
+		topic_nums, values = aggregation.select_predictions(probs, coherent)
+		freq, prob_sum, total = aggregation.group_predictions(topic_nums, \
+															values, num_topics)
+		freq_mean = aggregation.freq_mean(freq, prob_sum, total)
+		aggregation.append_freq_mean(freq_mean, accumulator)
+		return freq_mean
+
+	def _assert_freq_mean(self, freq_mean, expected):
+		self.assertEqual(sorted(freq_mean), sorted(expected))
+		for topic_num, (freq, prob) in expected.items():
+			self.assertEqual(freq_mean[topic_num][0], freq)
+			self.assertAlmostEqual(freq_mean[topic_num][1], prob)
+
+	def test_arrays_match_the_list_based_aggregation(self):
+		num_topics = 30
+		incoherent = random.Random(0).sample(range(num_topics), 6)
+		coherent = np.ones(num_topics, dtype=bool)
+		coherent[incoherent] = False
+		accumulator = aggregation.new_accumulator(num_topics)
+		master_dict = {}
+		for seed in range(3):
+			doc_topics = aggregation._synthetic_predictions(200, num_topics, seed)
+			aggregation._legacy_iteration(doc_topics, incoherent, master_dict)
+			freq_mean = self._array_iteration(doc_topics, coherent, accumulator)
+			self._assert_freq_mean(freq_mean, dict((num, vals[-1]) for num, \
+									vals in master_dict.items()))
+		averaged = aggregation.final_pred_avg(accumulator)
+		for topic_num, iterations in master_dict.items():
+			expected = np.mean(iterations, axis=0)
+			np.testing.assert_allclose(averaged[topic_num], expected)
+
+	def test_ties_and_incoherent_topics(self):
+		doc_topics = [[(0, 0.4), (1, 0.4), (2, 0.2)], [(2, 0.9), (3, 0.1)], \
+						[(3, 0.005)]]
+		coherent = np.array([True, True, False, True])
+		accumulator = aggregation.new_accumulator(4)
+		freq_mean = self._array_iteration(doc_topics, coherent, accumulator)
+		# the first of the topics tied at a document's highest probability is
+		# predicted twice, like the list-based helpers did
+		self._assert_freq_mean(freq_mean, {0: [2, 0.8/5], 1: [1, 0.4/5], \
+								3: [2, 0.2/5]})
+		master_dict = {}
+		aggregation._legacy_iteration(doc_topics[:2], [2], master_dict)
+		self._assert_freq_mean(freq_mean, dict((num, vals[0]) for num, vals \
+								in master_dict.items()))
+
+	def test_sort_predictions(self):
+		preds = [[0, 0.1], [1, 0.3], [2, 0.3], [3, 0.2]]
+		self.assertEqual(aggregation.sort_predictions(preds), \
+						[[1, 0.3], [2, 0.3], [3, 0.2], [0, 0.1]])
+		self.assertEqual(aggregation.sort_predictions([]), [])
+
+class SentenceIndexTests(SimpleTestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'vectors.npy')
+		gen = np.random.RandomState(0)
+		self.vectors = gen.randn(500, 20).astype(np.float32)
+		np.save(self.path, self.vectors)
+		self.queries = gen.randn(8, 20).astype(np.float32)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _brute_force(self, query, topn):
+		'''
+		docvecs.most_similar for a single positive vector.
+		'''
+		norms = self.vectors / np.linalg.norm(self.vectors, axis=1)[:, None]
+		query = matutils.unitvec(np.array([query]).mean(axis=0)).astype(np.float32)
+		dists = norms.dot(query)
+		best = matutils.argsort(dists, topn=topn, reverse=True)
+		return [(int(i), float(dists[i])) for i in best]
+
+	def test_exact_mode_matches_most_similar(self):
+		index = SentenceIndex(InferredDocvecs(self.path), self.path)
+		self.assertFalse(index.approximate)
+		for topn in (1, 5, 500, 600):
+			results = index.most_similar(self.queries, topn=topn)
+			for query, result in zip(self.queries, results):
+				expected = self._brute_force(query, topn)
+				self.assertEqual([tag for tag, _ in result], \
+								[tag for tag, _ in expected])
+				np.testing.assert_allclose([dist for _, dist in result], \
+								[dist for _, dist in expected], atol=1e-6)
+		self.assertEqual(index.most_similar([]), [])
+
+	def test_matrix_is_reused_until_the_vectors_change(self):
+		SentenceIndex(InferredDocvecs(self.path), self.path)
+		matrix_path = self.path + '.docvecs_norm.npy'
+		built = os.path.getmtime(matrix_path)
+		SentenceIndex(InferredDocvecs(self.path), self.path)
+		self.assertEqual(os.path.getmtime(matrix_path), built)
+		self.assertEqual(sorted(os.listdir(self.dir)), \
+						['vectors.npy', 'vectors.npy.docvecs_norm.npy'])
+
+	def test_approximate_mode_probing_every_cluster_is_exact(self):
+		exact = SentenceIndex(InferredDocvecs(self.path), self.path)
+		approximate = SentenceIndex(InferredDocvecs(self.path), self.path, \
+									approximate=True, nlist=10, nprobe=10)
+		expected = exact.most_similar(self.queries, topn=5)
+		results = approximate.most_similar(self.queries, topn=5)
+		for result, exact_result in zip(results, expected):
+			self.assertEqual([tag for tag, _ in result], \
+							[tag for tag, _ in exact_result])
@@ -8,11 +8,13 @@ import ml.discourse.summarizer as summ
 import ml.meta.data_generator as dgen
 import ml.nlp.preprocessor as preprocessor
 import ml.machine_learning.modeling.topic_modeling as topic_modeling
+import ml.machine_learning.modeling.lda_sweep as lda_sweep
 import ml.machine_learning.modeling.document2vector as d2v
 import ml.machine_learning.prediction.sent_prediction as spred
 import ml.machine_learning.prediction.topic_prediction as tpred
 import fooreviews.models as f_models
 import ml.models as m_models
+from multiprocessing import cpu_count
 import services.loggers as loggers
 logger = loggers.Loggers(__name__).get_logger()
 
@@ -62,7 +64,10 @@ class AnalysisWorkflow(object):
 					we do about 1000 iterations)
 			Doc2vec models are trained on a product review corpus so 
 				no domain training required. It usually takes about 5 
-				minutes with our optimtized iteration count of 20. 
+				minutes with our optimtized iteration count of 20.
+				With d2v_domain, a doc2vec model is trained once per
+				domain during corpus training instead and a product's
+				sentence vectors are only inferred from it.
 			Sentence prediction and db population takes about 10 minutes 
 				for 50 features. Could take a lot longer with more features.
 			Summarization and data generation:
@@ -86,7 +91,25 @@ class AnalysisWorkflow(object):
 		self.finished_crawling = kwargs.get('finished_crawling')
 		self.finished_parsing = kwargs.get('finished_parsing')
 		self.run_nlp = kwargs.get('run_nlp')
+		self.bulk_map = kwargs.get('bulk_map')
+		self.near_dedupe = kwargs.get('near_dedupe')
+		self.nlp_workers = kwargs.get('nlp_workers') or cpu_count()
+		self.nlp_batch_size = kwargs.get('nlp_batch_size')
+		self.incremental = kwargs.get('incremental')
 		self.run_ml = kwargs.get('run_ml')
+		self.stream_lda = kwargs.get('stream_lda')
+		self.lda_seed = kwargs.get('lda_seed')
+		self.sweep_lda = kwargs.get('sweep_lda')
+		self.update_lda = kwargs.get('update_lda')
+		self.batch_predict = kwargs.get('batch_predict')
+		self.predict_workers = kwargs.get('predict_workers')
+		self.topic_ranking = kwargs.get('topic_ranking')
+		self.early_stop = kwargs.get('early_stop')
+		self.predict_seconds = kwargs.get('predict_seconds')
+		self.d2v_mode = kwargs.get('d2v_mode')
+		self.d2v_workers = kwargs.get('d2v_workers')
+		self.d2v_domain = kwargs.get('d2v_domain')
+		self.sweep_grid = kwargs.get('sweep_grid')
 		self.update_topics = kwargs.get('update_topics')
 		self.domain = kwargs.get('domain')
 		self.subdomain = kwargs.get('subdomain')
@@ -355,8 +378,14 @@ class AnalysisWorkflow(object):
 		'''
 		Initiate LDA, topic prediction, and document vectorization.
 		'''
-		if self.corpus_training:
+		if self.corpus_training and self.sweep_lda:
+			self._sweep_lda(params)
+		elif self.corpus_training:
 			self._train_lda(params)
+			if self.d2v_domain:
+				logger.info('Workflow staging domain doc2vec model training')
+				self._train_domain_doc2vec(params)
+				logger.info('Workflow finished domain doc2vec model training')
 		elif self.frsku:
 			logger.info('Workflow staging topic prediction')
 			self._predict_topics()
@@ -409,9 +438,10 @@ class AnalysisWorkflow(object):
 		without transferring any real data between the tables.
 		'''
 		if self.corpus_training:
-			cdm = preprocessor.CorpusDataMapper(**params)
+			cdm = preprocessor.CorpusDataMapper(bulk=self.bulk_map, **params)
 		elif self.frsku:
-			cdm = preprocessor.CorpusDataMapper(frsku=self.frsku)
+			cdm = preprocessor.CorpusDataMapper(frsku=self.frsku, \
+												bulk=self.bulk_map)
 		if cdm.raw_set.count():
 			cdm.mapper()
 		else:
@@ -430,11 +460,12 @@ class AnalysisWorkflow(object):
 		'''
 		msg = 'Deduplication initiated for review '
 		if self.corpus_training:
-			dd = preprocessor.Deduplicate(**params)
+			dd = preprocessor.Deduplicate(near_dupes=self.near_dedupe, **params)
 			msg += 'training. Domain={} Subdomain={}'
 			msg = msg.format(self.domain, self.subdomain)
 		elif self.frsku:
-			dd = preprocessor.Deduplicate(frsku=self.frsku)
+			dd = preprocessor.Deduplicate(frsku=self.frsku, \
+											near_dupes=self.near_dedupe)
 			msg += 'analysis. FRSKU={}'.format(self.frsku)
 		dd.dedupe()
 		logger.info(msg)
@@ -448,11 +479,18 @@ class AnalysisWorkflow(object):
 		and sentence_count, which will be used later in classification
 		and metadata generation.
 		'''
+		engine_params = {
+			'workers': self.nlp_workers,
+			'batch_size': self.nlp_batch_size,
+			'incremental': self.incremental,
+		}
 		while True:
 			if self.corpus_training:
-				nlpp = preprocessor.NLPreprocessor(**params)
+				engine_params.update(params)
+				nlpp = preprocessor.NLPreprocessor(**engine_params)
 			elif self.frsku:
-				nlpp = preprocessor.NLPreprocessor(frsku=self.frsku) 
+				nlpp = preprocessor.NLPreprocessor(frsku=self.frsku, \
+													**engine_params)
 			if nlpp.review_set.count() > 0:
 				nlpp.parse_BoW()
 				msg = 'Parsed bag of words for '
@@ -469,8 +507,28 @@ class AnalysisWorkflow(object):
 				logger.info(msg)
 			break
 
+	def _sweep_lda(self, params):
+		'''
+		Score LDA candidates over sweep_grid instead of training the domain's
+		model (see lda_sweep.LDASweep).
+		'''
+		sweep_params = {
+			'grid': self.sweep_grid,
+			'seed': self.lda_seed,
+		}
+		sweep_params.update(params)
+		sweep = lda_sweep.LDASweep(**sweep_params)
+		sweep.run()
+
 	def _train_lda(self, params):
-		tm = topic_modeling.TopicModeling(**params)
+		lda_params = {
+			'streaming': self.stream_lda,
+			'seed': self.lda_seed,
+		}
+		lda_params.update(params)
+		tm = topic_modeling.TopicModeling(**lda_params)
+		if self.update_lda:
+			tm.update_lda_model()
 		lda = tm.train_lda_model()
 		if not lda:
 			lda = tm.train_lda_model(new_model=True)
@@ -483,17 +541,47 @@ class AnalysisWorkflow(object):
 		'''
 		Initiate LDA topic prediction.
 		'''
-		tp = tpred.TopicPrediction(frsku=self.frsku, clear_db=self.clear_db)
+		params = {
+			'frsku': self.frsku,
+			'clear_db': self.clear_db,
+			'batch': self.batch_predict,
+			'workers': self.predict_workers,
+			'ranking': self.topic_ranking,
+			'early_stop': self.early_stop,
+			'max_seconds': self.predict_seconds,
+		}
+		tp = tpred.TopicPrediction(**params)
 		tp.stage_prediction()
 		if self.dump_to_csv:
 			# for debugging
 			tp.predictions_to_csv() 
 
+	def _train_domain_doc2vec(self, params):
+		'''
+		Train the domain's doc2vec model, which products analyzed with
+		d2v_domain infer their sentence vectors from.
+		'''
+		d2v_params = {
+			# a whole domain's reviews; read in parallel from a corpus file
+			'mode': self.d2v_mode or 'corpus_file',
+			'workers': self.d2v_workers,
+		}
+		d2v_params.update(params)
+		d = d2v.Document2Vector(**d2v_params)
+		d.train_d2v_model(new_model=True)
+
 	def _train_doc2vec(self):
 		'''
-		Initiate a new doc2vec model training for FRSKU.
+		Initiate a new doc2vec model training for FRSKU, or, with d2v_domain,
+		infer its sentence vectors with the domain's model.
 		'''
-		d = d2v.Document2Vector(frsku=self.frsku)
+		params = {
+			'frsku': self.frsku,
+			'mode': self.d2v_mode,
+			'workers': self.d2v_workers,
+			'domain_model': self.d2v_domain,
+		}
+		d = d2v.Document2Vector(**params)
 		d.train_d2v_model(new_model=True)
 		
 	def _predict_sents(self):
@@ -501,7 +589,12 @@ class AnalysisWorkflow(object):
 		Initiate doc2vec sentence prediction for FRSKU. Output the results 
 		for analysis and validation.
 		'''
-		sp = spred.SentencePrediction(frsku=self.frsku, clear_db=self.clear_db)
+		params = {
+			'frsku': self.frsku,
+			'clear_db': self.clear_db,
+			'domain_model': self.d2v_domain,
+		}
+		sp = spred.SentencePrediction(**params)
 		sp.predict()
 		sp.predictions_to_file()
 		sp.get_validation_files()